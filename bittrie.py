@@ -10,8 +10,14 @@ log = logging.getLogger(__name__)
 none_found = object()
 
 class BitTrie(object):
+    __slots__ = ("trie", "_size")
+
     def __init__(self):
         self.trie = [None] * 0x10
+        self._size = 0
+
+    def __len__(self):
+        return self._size
 
     def get(self, key, default=None):
         r = self._get(key)
@@ -46,10 +52,7 @@ class BitTrie(object):
         return buf
 
     def __iter__(self):
-        for item in self.find(ZeroKey()):
-            if item is none_found:
-                continue
-            yield item
+        return self._iterate_next([self.trie])
 
     def __delitem__(self, key):
         self._del(key)
@@ -79,21 +82,30 @@ class BitTrie(object):
         keylen = len(key)
         for i in range(keylen):
             char = key[i]
-            for j in range(4, -1, -4):
+            for j in (4, 0):
                 bit = (char >> j) & 0x0F
                 next_node = node[bit]
 
                 if not next_node:
                     node[bit] = TrieLeaf(key, value)
+                    self._size += 1
                     return None
 
                 if type(next_node) is TrieLeaf:
                     other = next_node
 
                     o_key = other.key
+                    if o_key == key:
+                        if replace:
+                            node[bit] = TrieLeaf(key, value)
+                        return other.value
+
+                    # Push the existing leaf down one level; we will keep
+                    # doing so until our keys diverge.
                     if j == 0:
                         ii = i + 1
                         if ii == keylen:
+                            # Only reachable with keys of differing lengths.
                             if replace:
                                 node[bit] = TrieLeaf(key, value)
                             return other.value
@@ -113,14 +125,13 @@ class BitTrie(object):
                 node = next_node
 
     def _del(self, key):
-        #FIXME: Make this code prune empty trees more than one deep.
-        prev_node = None
-        prev_node_bit = None
+        # Stack of (parent, bit) for each interior node we descend into.
+        path = []
         node = self.trie
 
         for i in range(len(key)):
             char = key[i]
-            for j in range(4, -1, -4):
+            for j in (4, 0):
                 bit = (char >> j) & 0x0F
                 next_node = node[bit]
 
@@ -128,31 +139,51 @@ class BitTrie(object):
                     return None
 
                 if type(next_node) is TrieLeaf:
-                    node[bit] = None
+                    if next_node.key != key:
+                        return None
 
-                    empty = True
-                    for n in node:
-                        if n:
-                            empty = False
-                            break;
+                    node[bit] = None
+                    self._size -= 1
 
-                    if empty and prev_node:
-                        prev_node[prev_node_bit] = None
+                    self._prune(node, path)
 
                     return next_node.value
 
                 assert type(next_node) is list, type(next_node)
 
-                prev_node = node
-                prev_node_bit = bit
+                path.append((node, bit))
                 node = next_node
 
+    def _prune(self, node, path):
+        "Collapse node and its ancestors after a leaf was removed from node."
+
+        # put() only ever splits a leaf as deep as is needed to tell it apart
+        # from its neighbor, so an interior node always has at least two
+        # leaves beneath it. We restore that here by removing empty nodes and
+        # lifting lone leaves up into the parent, all the way up the path.
+        while path:
+            only = None
+            for child in node:
+                if not child:
+                    continue
+                if only is not None:
+                    return
+                only = child
+
+            if only is not None and type(only) is not TrieLeaf:
+                # A lone interior child still holds two or more leaves.
+                return
+
+            parent, bit = path.pop()
+            parent[bit] = only
+            node = parent
+
     def _get(self, key):
         node = self.trie
 
         for i in range(len(key)):
             char = key[i]
-            for j in range(4, -1, -4):
+            for j in (4, 0):
                 bit = (char >> j) & 0x0F
                 next_node = node[bit]
 
@@ -182,12 +213,10 @@ class BitTrie(object):
             while j >= 0:
                 bit = (char >> j) & 0x0F
 
-                rng = range(0x0F, bit, -1) if forward else range(0, bit)
-
-                for obit in rng:
-                    other = node[obit]
-                    if other:
-                        branches.append(other)
+                # Stack the siblings on the far side of our path, nearest
+                # last, so they are popped in order once we bottom out.
+                rng = node[:bit:-1] if forward else node[:bit]
+                branches.extend([x for x in rng if x])
 
                 next_node = node[bit]
 
@@ -248,7 +277,7 @@ class BitTrie(object):
 
             assert type(node) is list, type(node)
 
-            branches.extend(reversed([x for x in node if x]))
+            branches.extend([x for x in node[::-1] if x])
 
     def _iterate_prev(self, branches):
         while True:
@@ -266,20 +295,16 @@ class BitTrie(object):
             branches.extend([x for x in node if x])
 
 class TrieLeaf(object):
+    __slots__ = ("key", "value")
+
     def __init__(self, key, value):
         self.key = key
         self.value = value
 
-class XorKey(object):
-    def __init__(self, key1, key2):
-        self.key1 = key1
-        self.key2 = key2
-
-    def __getitem__(self, idx):
-        return self.key1[idx] ^ self.key2[idx]
-
-    def __len__(self):
-        return len(self.key1)
+def XorKey(key1, key2):
+    "Returns the XOR distance between two keys, computed once as bytes."
+    distance = int.from_bytes(key1, "big") ^ int.from_bytes(key2, "big")
+    return distance.to_bytes(len(key1), "big")
 
 max_len_value = 0xFFFFFFFF
 
@@ -338,51 +363,149 @@ def _del_test():
 
     print(bt)
 
-def _speed_test():
-    bt = BitTrie()
-#    bt = {}
+def _check_pruned(bt):
+    "Verify no empty or single leaf interior nodes were left behind."
+    leaves = 0
+    nodes = [(bt.trie, True)]
+
+    while nodes:
+        node, root = nodes.pop()
 
-    rval = os.urandom(512>>3)
+        children = [x for x in node if x]
 
-    for i in range(500000):
-        val = os.urandom(512>>3)
+        if not root:
+            assert children, "Empty interior node."
+            assert len(children) > 1 or type(children[0]) is list,\
+                "Interior node with a single leaf."
+
+        for child in children:
+            if type(child) is TrieLeaf:
+                leaves += 1
+            else:
+                nodes.append((child, False))
+
+    assert leaves == len(bt), "Size mismatch: {} != {}."\
+        .format(leaves, len(bt))
+
+def _prune_test(cycles=1000000, keysize=4, keyspace=1024):
+    print("prune..")
+
+    bt = BitTrie()
+    ref = {}
 
-        xval = [rvalc ^ valc for rvalc, valc in zip(rval, val)]
-        xiv = int.from_bytes(xval, "big")
+    rval = os.urandom(keysize)
+    keys = [os.urandom(keysize) for i in range(keyspace)]
 
+    for i in range(cycles):
+        val = random.choice(keys)
         k = XorKey(rval, val)
+        xk = bytes(k[x] for x in range(keysize))
 
-        now = datetime.today()
-        #r = bt.put(k, xiv)
-        r = bt[k] = xiv
-        if not i % 5000:
-            print("put took: {}".format(datetime.today() - now))
+        if random.random() < 0.5:
+            bt[k] = xk
+            ref[xk] = xk
+        else:
+            r = bt.pop(XorKey(rval, val), None)
+            assert r == ref.pop(xk, None), (r, xk)
 
-    n = XorKey(os.urandom(512>>3), os.urandom(512>>3))
-    bt[n] = int.from_bytes(n, "big")
+        if not i % 100000:
+            _check_pruned(bt)
+            assert list(bt) == sorted(ref.values())
+            print("{} cycles, len={}.".format(i, len(bt)))
 
-    now = datetime.today()
-    print("get: {}".format(bt.get(int(0).to_bytes(512>>3, "big"))))
-    print("took: {}".format(datetime.today() - now))
-    now = datetime.today()
-    print("get: {}".format(bt.get(int(42).to_bytes(512>>3, "big"))))
-    print("took: {}".format(datetime.today() - now))
-    now = datetime.today()
-    print("get: {}".format(bt.get(int(88).to_bytes(512>>3, "big"))))
-    print("took: {}".format(datetime.today() - now))
+    _check_pruned(bt)
+    assert len(bt) == len(ref)
+    assert list(bt) == sorted(ref.values())
 
-    print("find speed test:")
+    for xk in list(ref.keys()):
+        del bt[xk]
 
-    cnt = 42
-    now = datetime.today()
+    _check_pruned(bt)
+    assert len(bt) == 0
+    assert not [x for x in bt.trie if x], "Trie not empty."
 
-    for i in bt.find(int(100).to_bytes(512>>3, "big")):
-        print("find: {}".format(i))
-        print("took: {}".format(datetime.today() - now))
-        cnt -= 1
-        if not cnt:
-            break
+    print("prune ok.")
+
+def _best_time(func, repeat):
+    "Returns the fastest of repeat runs of func, in seconds."
+    best = None
+
+    for i in range(repeat):
         now = datetime.today()
+        func()
+        took = (datetime.today() - now).total_seconds()
+
+        if best is None or took < best:
+            best = took
+
+    return best
+
+def _speed_test(count=100000, finds=1000, peers=64, closest=8, repeat=5):
+    "Benchmark the operations chord_tasks performs on 512 bit node ids."
+
+    keysize = 512 >> 3
+
+    rval = os.urandom(keysize)
+    vals = [os.urandom(keysize) for i in range(count)]
+    targets = [os.urandom(keysize) for i in range(finds)]
+
+    def report(name, took, ops):
+        print("{}: {:.2f}us/op ({} ops in {:.3f}s)."\
+            .format(name, took / ops * 1000000, ops, took))
+
+    bt = BitTrie()
+
+    def do_put():
+        nonlocal bt
+        bt = BitTrie()
+        for val in vals:
+            bt[XorKey(rval, val)] = val
+
+    def do_get():
+        for val in vals:
+            bt.get(XorKey(rval, val))
+
+    def do_find():
+        # Like send_find_node() walking the peer_trie for the closest peers.
+        for target in targets:
+            cnt = closest
+            for r in bt.find(XorKey(rval, target)):
+                if r is none_found:
+                    continue
+                cnt -= 1
+                if not cnt:
+                    break
+
+    def do_build():
+        # Like process_find_node_request() answering a FIND_NODE.
+        pvals = vals[:peers]
+        for target in targets:
+            pt = BitTrie()
+            for val in pvals:
+                pt[XorKey(target, val)] = val
+            cnt = closest
+            for r in pt:
+                cnt -= 1
+                if not cnt:
+                    break
+
+    def do_pop():
+        for val in vals:
+            bt.pop(XorKey(rval, val), None)
+
+    print("speed test ({} keys, best of {}):".format(count, repeat))
+
+    report("XorKey", _best_time(lambda: [XorKey(rval, val) for val in vals],\
+        repeat), count)
+    report("put", _best_time(do_put, repeat), count)
+    report("get", _best_time(do_get, repeat), count)
+    report("find {} closest".format(closest), _best_time(do_find, repeat),\
+        finds)
+    report("build {} and find {} closest".format(peers, closest),\
+        _best_time(do_build, repeat), finds)
+
+    do_put()
+    report("pop", _best_time(do_pop, 1), count)
 
 def _validity_test():
     bt = BitTrie()
@@ -428,6 +551,7 @@ def _validity_test():
 
 def main():
     _del_test()
+    _prune_test()
     _validity_test()
     _speed_test()
 
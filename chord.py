@@ -25,6 +25,7 @@ import rsakey
 import mn1
 import mutil
 import peer as mnpeer
+import routingtable
 import shell
 import enc
 from db import Peer
@@ -55,6 +56,8 @@ class ChordEngine():
         self.peers = {} # {protocol.address: Peer}.
         self.peer_buckets = [{} for i in range(NODE_ID_BITS)] # [{addr: Peer}]
         self.peer_trie = bittrie.BitTrie() # {node_id, Peer}
+        self.routing_table = routingtable.RoutingTable() # {node_id, Peer}
+        self.known_peers = routingtable.KBucketTable(NODE_ID_BITS) # {id: Peer}
 
         self.protocol_ready = asyncio.Event(loop=self.loop)
 
@@ -81,6 +84,9 @@ class ChordEngine():
 
         self.tasks = ct.ChordTasks(self)
 
+        # Lets reconnects to peers skip the key exchange and authentication.
+        self.resumption_tickets = mn1.ResumptionTickets()
+
         self.furthest_data_block = b""
 
     @property
@@ -92,25 +98,20 @@ class ChordEngine():
         self._bind_address = value
         self._bind_port = int(value.split(':')[1])
 
-    @asyncio.coroutine
-    def __rebuild_peer_trie(self):
-        "Recycle self.peer_trie because I didn't fully implement pruning."
-
-        #FIXME: Fix bittrie.py to prune itself properly, this is a temp hack
-        # to prevent it from leaking memory.
+    def get_transport_stats(self):
+        "Returns the mn1 transport stats of each connected Peer."
+        stats = []
 
-        node_id = self.node_id
-
-        while True:
-
-            new_trie = bittrie.BitTrie()
+        for peer in self.peers.values():
+            if not peer.protocol:
+                continue
 
-            for peer in self.peers.values():
-                xorkey = bittrie.XorKey(node_id, peer.node_id)
-                new_trie[xorkey] = peer
+            pstats = peer.protocol.get_stats()
+            pstats["peer_id"] = peer.dbid
+            pstats["rtt"] = peer.rtt.get_stats()
+            stats.append(pstats)
 
-            self.peer_trie = new_trie
-            yield from asyncio.sleep(3600) # Only do every hour.
+        return stats
 
     @asyncio.coroutine
     def connect_peer(self, addr):
@@ -234,6 +235,9 @@ class ChordEngine():
 
         added = yield from self.loop.run_in_executor(None, dbcall)
 
+        for dbpeer in added:
+            self.known_peers.add(dbpeer)
+
         if process_check_connections and added and self.running:
             yield from self.process_connection_count()
 
@@ -257,6 +261,8 @@ class ChordEngine():
 
         log.info("Node listening on [{}:{}].".format(host, port))
 
+        yield from self._load_known_peers()
+
         if self.connect_peers:
             log.info("Connecting first to: [{}].".format(self.connect_peers))
             for address in self.connect_peers:
@@ -267,8 +273,28 @@ class ChordEngine():
         # Let _async_process_connection_count() connect some connections first.
         self.loop.call_later(7, self._async_do_stabilize)
 
-        # Temp hack to fix memory leak due to incomplete BitTrie prune impl.
-        asyncio.async(self.__rebuild_peer_trie(), loop=self.loop)
+    @asyncio.coroutine
+    def _load_known_peers(self):
+        "Load the Peer table into self.known_peers; from then on it is kept"\
+        " in sync as we add PeerS to the database."
+
+        def dbcall():
+            with self.node.db.open_session() as sess:
+                r = sess.query(Peer)\
+                    .filter(Peer.distance != None, Peer.distance != 0)\
+                    .all()
+
+                sess.expunge_all()
+
+                return r
+
+        dbpeers = yield from self.loop.run_in_executor(None, dbcall)
+
+        for dbpeer in dbpeers:
+            self.known_peers.add(dbpeer)
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Loaded {} known PeerS.".format(len(self.known_peers)))
 
     def _async_do_stabilize(self):
         self._do_stabilize_handle =\
@@ -341,99 +367,26 @@ class ChordEngine():
     def _process_connection_count(self):
         log.info("Processing connection count.")
 
-        def dbcall():
-            with self.node.db.open_session() as sess:
-                st = sess.query(Peer)\
-                    .statement.with_only_columns(\
-                        [func.count('*')])
-
-                peer_cnt = sess.execute(st).scalar()
+        self.last_db_peer_count = len(self.known_peers)
 
-                min_dist = sess.query(func.min_(Peer.distance))\
-                    .filter(Peer.distance != None)\
-                    .filter(Peer.distance != 0)\
-                    .filter(Peer.connected == False)\
-                    .scalar()
+        def bucket_needs(distance):
+            # Divide by two in order to reserve space for connecting nodes.
+            return (BUCKET_SIZE >> 1) - len(self.peer_buckets[distance - 1])
 
-                return peer_cnt, min_dist
+        now = mutil.utc_datetime()
+        grace = now - timedelta(minutes=5)
 
-        self.last_db_peer_count, closestdistance =\
-            yield from self.loop.run_in_executor(None, dbcall)
+        pbuffer = self.known_peers.select(bucket_needs, grace, now)
 
         if log.isEnabledFor(logging.INFO):
-            log.info("Database Peer count=[{}], closestdistance=[{}]."\
-                .format(self.last_db_peer_count, closestdistance))
-
-        if not closestdistance:
-            return
+            log.info("Known Peer count=[{}], candidates=[{}]."\
+                .format(self.last_db_peer_count, len(pbuffer)))
 
         MAX_CONCURRENT_CONNECTIONS = 7
 
-        pbuffer = []
         connect_futures = []
 
-        fetched = False
-        distance = closestdistance
-        while True:
-            if distance >= NODE_ID_BITS + 1:
-                break
-
-            peer_bucket = self.peer_buckets[distance - 1]
-            # Divide by two in order to reserve space for connecting nodes.
-            bucket_needs = (BUCKET_SIZE >> 1) - len(peer_bucket)
-            if bucket_needs <= 0:
-                distance += 1
-                continue
-
-            def dbcall():
-                with self.node.db.open_session() as sess:
-                    grace = mutil.utc_datetime() - timedelta(minutes=5)
-
-                    q = sess.query(Peer)\
-                        .filter(Peer.distance == distance,\
-                            Peer.connected == False,\
-                            or_(Peer.last_connect_attempt == None,\
-                                Peer.last_connect_attempt < grace))\
-                        .order_by(Peer.last_connect_attempt != None)\
-                        .order_by(func.random())\
-                        .limit(bucket_needs)
-
-                    r = q.all()
-
-                    sess.expunge_all()
-
-                    return r
-
-            rs = yield from self.loop.run_in_executor(None, dbcall)
-
-            distance += 1
-
-            if not len(rs):
-                continue
-
-            for dbpeer in rs:
-                pbuffer.append(dbpeer)
-
-            if len(connect_futures) == MAX_CONCURRENT_CONNECTIONS:
-                connected, pending = yield from asyncio.wait(\
-                    connect_futures, loop=self.loop,\
-                    return_when=futures.FIRST_COMPLETED)
-
-                connect_futures = list(pending)
-
-            while pbuffer\
-                    and len(connect_futures) < MAX_CONCURRENT_CONNECTIONS:
-                dbpeer = pbuffer.pop()
-                if len(self.peer_buckets[dbpeer.distance - 1]) >= BUCKET_SIZE:
-                    continue
-
-                connect_c =\
-                    asyncio.async(self._connect_peer(dbpeer), loop=self.loop)
-
-                connect_futures.append(connect_c)
-
-        while pbuffer:
-            dbpeer = pbuffer.pop()
+        for dbpeer in pbuffer:
             if len(self.peer_buckets[dbpeer.distance - 1]) >= BUCKET_SIZE:
                 continue
 
@@ -530,6 +483,7 @@ class ChordEngine():
     def _create_server_protocol(self):
         ph = mn1.SshServerProtocol(self.loop)
         ph.server_key = self.node.node_key
+        ph.resumption_tickets = self.resumption_tickets
 
         p = mnpeer.Peer(self)
         p.protocol = ph
@@ -541,6 +495,7 @@ class ChordEngine():
     def _create_client_protocol(self, peer):
         ph = mn1.SshClientProtocol(self.loop)
         ph.client_key = self.node.node_key
+        ph.resumption_tickets = self.resumption_tickets
 
         if peer.node_key:
             ph.server_key = peer.node_key
@@ -780,19 +735,52 @@ class ChordEngine():
         xorkey = bittrie.XorKey(self.node_id, peer.node_id)
         self.peer_trie[xorkey] = peer
 
+        self.routing_table.add(peer.node_id, peer)
+
+        if peer.dbid:
+            if peer.dbid not in self.known_peers:
+                # An incoming or manually added Peer we just learned about.
+                dbpeer = Peer()
+                dbpeer.id = peer.dbid
+                dbpeer.node_id = peer.node_id
+                dbpeer.pubkey = peer.node_key.asbytes()
+                dbpeer.distance = peer.distance
+                dbpeer.direction = peer.direction
+                dbpeer.address = peer.address
+                dbpeer.connected = True
+                dbpeer.last_connect_attempt = None
+
+                self.known_peers.add(dbpeer)
+
+            self.known_peers.set_connected(peer.dbid, True)
+
         return True
 
     def remove_from_peers(self, peer):
         address = "{}:{}".format(\
             peer.protocol.address[0], peer.protocol.address[1])
 
-        self.peers.pop(address, None)
+        if self.peers.get(address) is peer:
+            del self.peers[address]
+
+            if peer.dbid:
+                self.known_peers.set_connected(peer.dbid, False)
+
+        # A duplicate or replaced connection must not evict the Peer that
+        # is still connected under the same address or node_id.
         if peer.distance:
-            self.peer_buckets[peer.distance - 1].pop(address, None)
+            bucket = self.peer_buckets[peer.distance - 1]
+            if bucket.get(address) is peer:
+                del bucket[address]
 
         if peer.node_id:
             xorkey = bittrie.XorKey(self.node_id, peer.node_id)
-            self.peer_trie.pop(xorkey, None)
+            if self.peer_trie.get(xorkey) is peer:
+                del self.peer_trie[xorkey]
+
+            self.routing_table.remove(peer.node_id, peer)
+
+        self.tasks.lookup_cache.peer_disconnected(peer)
 
     def is_peer_connection_desirable(self, peer):
         peercnt = len(self.peers)
@@ -1074,6 +1062,10 @@ class ChordEngine():
         else:
             return
 
+        dbpeer = self.known_peers.get(peer.dbid)
+        if dbpeer:
+            dbpeer.address = peer.address
+
         def dbcall():
             with self.node.db.open_session() as sess:
                 dbp = sess.query(Peer).get(peer.dbid);
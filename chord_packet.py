@@ -77,28 +77,93 @@ class ChordRelay(ChordMessage):
 
     def encode(self):
         nbuf = super().encode()
-        nbuf += struct.pack(">L", self.index)
+        nbuf += struct.pack(">LL", self.index, len(self.packets))
 
-        nbuf += struct.pack(">L", len(self.packets))
         for packet in self.packets:
-            nbuf += sshtype.encodeBinary(packet)
+            nbuf += struct.pack(">L", len(packet))
+            nbuf += packet
 
         return nbuf
 
     def parse(self):
         super().parse()
         i = 1
-        self.index = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
+        self.index, cnt = struct.unpack_from(">LL", self.buf, i)
+        i += 8
 
-        cnt = struct.unpack(">L", self.buf[i:i+4])[0]
-        i += 4
         self.packets = []
         for n in range(cnt):
-            l, packet = sshtype.parseBinary(self.buf[i:])
-            i += l
+            i, packet = sshtype.parse_binary_from(self.buf, i)
             self.packets.append(packet)
 
+    @staticmethod
+    def encode_path(path, payload=None):
+        "Returns the ChordRelay packets for path (first index outermost)"\
+        " nested around payload, built in one pass."
+
+        # A nested relay is just the header of each hop followed by the
+        # payload, so we size the headers from the inside out and then copy
+        # the payload only once.
+        if payload:
+            cnt = 1
+            size = len(payload)
+        else:
+            cnt = 0
+            size = 0
+
+        headers = []
+        for idx in reversed(path):
+            if cnt:
+                header = struct.pack(">BLLL", CHORD_MSG_RELAY, idx, cnt, size)
+            else:
+                header = struct.pack(">BLL", CHORD_MSG_RELAY, idx, cnt)
+
+            headers.append(header)
+            size += len(header)
+            cnt = 1
+
+        headers.reverse()
+        if payload:
+            headers.append(payload)
+
+        return b"".join(headers)
+
+    @staticmethod
+    def unwrap(buf):
+        "Returns the path and the inner most packets of nested ChordRelay"\
+        " packets. Only the inner most packets are copied out of buf."
+
+        path = []
+        i = 0
+
+        while True:
+            packet_type = buf[i]
+            if packet_type != CHORD_MSG_RELAY:
+                raise ChordException("Expecting packet type [{}] but got [{}]."\
+                    .format(CHORD_MSG_RELAY, packet_type))
+
+            index, cnt = struct.unpack_from(">LL", buf, i + 1)
+            i += 9
+
+            path.append(index)
+
+            if cnt == 1:
+                length = struct.unpack_from(">L", buf, i)[0]
+                i += 4
+
+                if length and buf[i] == CHORD_MSG_RELAY:
+                    # Descend into the embedded relay without copying it.
+                    continue
+
+                return path, [buf[i:i+length]]
+
+            packets = []
+            for n in range(cnt):
+                i, packet = sshtype.parse_binary_from(buf, i)
+                packets.append(packet)
+
+            return path, packets
+
 class ChordNodeInfo(ChordMessage):
     def __init__(self, buf = None):
         self.sender_address = ""
@@ -4,12 +4,11 @@
 import llog
 
 import asyncio
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from concurrent import futures
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import math
-import os
 import random
 
 from sqlalchemy import func
@@ -18,11 +17,13 @@ import bittrie
 import chord
 import chord_packet as cp
 from chordexception import ChordException
-from db import Peer, DataBlock, NodeState
+from db import Peer, DataBlock, DataBlockJournal, NodeState
 import mbase32
+import mn1
 import multipart as mp
 import mutil
 import enc
+import latency
 import node as mnnode
 import peer as mnpeer
 import rsakey
@@ -30,6 +31,28 @@ import sshtype
 
 log = logging.getLogger(__name__)
 
+# Maximum buckets perform_stabilize(..) refreshes concurrently.
+STABILIZE_CONCURRENCY = 8
+# Buckets we have performed a FindNode within are not refreshed again until
+# this much time has passed (as with Kademlia).
+BUCKET_REFRESH_INTERVAL = timedelta(hours=1)
+
+# Maximum entries and lifetime of LookupCache entries.
+LOOKUP_CACHE_SIZE = 1024
+LOOKUP_CACHE_TTL = timedelta(minutes=2)
+# Lifetime of RelayDataCache entries, counted from when they were cached.
+RELAY_CACHE_TTL = timedelta(minutes=10)
+
+# Relayed FindNode round trip times are estimated per depth upto this; deeper
+# ones share the last estimate.
+RELAY_RTT_DEPTHS = 8
+# Maximum extra root level FindNode queries sent to the next closest PeerS
+# when initial ones are slower than their Peer's p95.
+MAX_HEDGED_QUERIES = 3
+
+# Maximum StoreJobS _process_store_queue(..) writes in one transaction.
+MAX_STORE_BATCH = 64
+
 class Counter(object):
     def __init__(self, value=None):
         self.value = value
@@ -60,6 +83,41 @@ class TunnelMeta(object):
         self.local_cid = None
         self.jobs = jobs
         self.task_running = False
+        # When each FindNode relayed through this tunnel was sent, by path,
+        # to sample ChordTasks.relay_rtts when (or if ever) it responds.
+        self.sent_times = {}
+
+class _StoreBatchAborted(Exception):
+    "The transaction of a batch of StoreJobS failed; see __cause__."
+
+class StoreJob(object):
+    "A ChordStoreData being stored, see ChordTasks._store_data(..)."
+
+    def __init__(self, data_id, dmsg, need_pruning):
+        self.data_id = data_id
+        self.dmsg = dmsg
+        self.need_pruning = need_pruning
+        self.future = None
+
+        # Set by _prepare_store(..).
+        self.distance = None
+        self.original_size = None
+        self.datas = None # The encrypted data, for data_store.put(..).
+        self.epubkey = None
+        self.target_key = None
+
+        # Set by _write_store_batch(..). data_block_id stays None if we
+        # already have the data, or is False if there was no room for it.
+        self.reset()
+
+    def reset(self):
+        "Clear what _write_store_batch(..) sets, to retry the StoreJob."
+        self.data_block_id = None
+        self.size_diff = 0
+        self.pruned_block_ids = []
+        self.pruned_data_ids = []
+        self.failed = False
+        self.error = None
 
 class VPeer(object):
     def __init__(self, peer=None, path=None, tun_meta=None):
@@ -74,6 +132,213 @@ class VPeer(object):
         self.will_store = False
         self.data_present = False
 
+class LookupCacheEntry(object):
+    def __init__(self, first_hops):
+        self.first_hops = first_hops # [mnpeer.Peer]
+        self.time = datetime.today()
+
+class LookupCache(object):
+    "TTL'd, size bounded cache of the route a successful GetData lookup"\
+    " took: the immediate PeerS whose tunnels reached the closest nodes that"\
+    " had the data. It only chooses which PeerS a repeat lookup starts from;"\
+    " the walk from them is performed as usual, as the tunnels are closed"\
+    " after each lookup. Entries are dropped when any of those PeerS"\
+    " disconnect."
+
+    def __init__(self, max_entries=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = OrderedDict() # {key: LookupCacheEntry}
+        self._by_peer = {} # {mnpeer.Peer: {key}}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+
+        if not entry:
+            return None
+
+        if datetime.today() - entry.time > self.ttl:
+            self.remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+
+        return entry
+
+    def put(self, key, first_hops):
+        self.remove(key)
+
+        self._entries[key] = LookupCacheEntry(first_hops)
+
+        for peer in first_hops:
+            self._by_peer.setdefault(peer, set()).add(key)
+
+        while len(self._entries) > self.max_entries:
+            self.remove(next(iter(self._entries)))
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if not entry:
+            return
+
+        for peer in entry.first_hops:
+            keys = self._by_peer.get(peer)
+            if not keys:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._by_peer[peer]
+
+    def peer_disconnected(self, peer):
+        keys = self._by_peer.pop(peer, None)
+
+        if not keys:
+            return
+
+        for key in keys:
+            self.remove(key)
+
+class RelayDataCache(object):
+    "Byte bounded, TTL'd LRU cache of the ChordDataResponse packets we"\
+    " relayed back from the immediate Peer of our tunnels, so that we can"\
+    " answer later GetData requests to that same Peer ourselves. We can't"\
+    " verify the data, so entries are keyed by the Peer's node_id as well"\
+    " as the data_id; bad data is then only ever served in place of the"\
+    " Peer that sent it."
+
+    def __init__(self, max_size, ttl=RELAY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+
+        # {(node_id, data_id): (time, ChordDataResponse packet)}
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, node_id, data_id):
+        key = (bytes(node_id), data_id)
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if datetime.today() - entry[0] > self.ttl:
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+
+        return entry[1]
+
+    def put(self, node_id, data_id, pkt):
+        if len(pkt) > self.max_size:
+            return
+
+        key = (bytes(node_id), data_id)
+
+        self._remove(key)
+
+        self._entries[key] = (datetime.today(), pkt)
+        self.size += len(pkt)
+
+        while self.size > self.max_size:
+            key, old = self._entries.popitem(last=False)
+            self.size -= len(old[1])
+
+    def _remove(self, key):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[1])
+
+class DataBlockCache(object):
+    "Byte bounded LRU cache of the blocks in our data store, as returned by"\
+    " ChordTasks._retrieve_data(..), so that popular ones are served without"\
+    " touching the database or the disk."
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        # Bumped by remove(..), so that a read that was in progress meanwhile
+        # does not put back what was removed.
+        self.generation = 0
+
+        self._entries = OrderedDict() # {data_id: (size, entry)}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, data_id):
+        return data_id in self._entries
+
+    def get(self, data_id):
+        item = self._entries.get(data_id)
+
+        if item is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(data_id)
+
+        return item[1]
+
+    def put(self, data_id, entry, generation):
+        "entry: the tuple _retrieve_data(..) returns. generation: the value"\
+        " of self.generation from before the entry was read."
+
+        if generation != self.generation:
+            return
+
+        enc_data, original_size, version, signature, epubkey, pubkeylen =\
+            entry
+
+        size = len(enc_data)
+        if signature:
+            size += len(signature)
+        if epubkey:
+            size += len(epubkey)
+
+        if size > self.max_size:
+            return
+
+        old = self._entries.pop(data_id, None)
+        if old is not None:
+            self.size -= old[0]
+
+        self._entries[data_id] = (size, entry)
+        self.size += size
+
+        while self.size > self.max_size:
+            data_id, old = self._entries.popitem(last=False)
+            self.size -= old[0]
+
+    def remove(self, data_id):
+        self.generation += 1
+
+        old = self._entries.pop(data_id, None)
+        if old is not None:
+            self.size -= old[0]
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {\
+            "entries": len(self._entries),\
+            "size": self.size,\
+            "max_size": self.max_size,\
+            "hits": self.hits,\
+            "misses": self.misses,\
+            "hit_rate": self.hits / lookups if lookups else None}
+
 EMPTY_PEER_LIST_MESSAGE = cp.ChordPeerList(peers=[])
 EMPTY_PEER_LIST_PACKET = EMPTY_PEER_LIST_MESSAGE.encode()
 EMPTY_GET_DATA_MESSAGE = cp.ChordGetData()
@@ -87,6 +352,34 @@ class ChordTasks(object):
         self.last_peer_add_time = None
         self.add_peer_memory_cache = {} # {Peer.address, Peer}
 
+        self.bucket_refresh_times = [None] * chord.NODE_ID_BITS
+
+        self.lookup_cache = LookupCache()
+
+        self._compacting_data_store = False
+        self._store_queue = [] # [StoreJob], see _store_data(..).
+        self._processing_store_queue = False
+        self.relay_cache = None # RelayDataCache, see enable_relay_cache(..).
+        self.data_cache = None # DataBlockCache, see enable_data_cache(..).
+
+        # Round trip times of relayed FindNode by depth; the initial second
+        # is what send_find_node(..) always used to wait.
+        self.relay_rtts = [latency.RttEstimator(1, 0.1, 10)\
+            for i in range(RELAY_RTT_DEPTHS)]
+        # Duration of whole send_find_node(..) calls, by DataMode.
+        self.lookup_latency =\
+            {mode: latency.LatencyHistogram() for mode in cp.DataMode}
+        # Response times of root level FindNode queries to all PeerS.
+        self.hop_latency = latency.LatencyHistogram()
+
+    def enable_relay_cache(self, max_size):
+        "Cache up to max_size bytes of the data we relay for others."
+        self.relay_cache = RelayDataCache(max_size)
+
+    def enable_data_cache(self, max_size):
+        "Cache up to max_size bytes of the blocks we serve from our store."
+        self.data_cache = DataBlockCache(max_size)
+
     @asyncio.coroutine
     def send_node_info(self, peer):
         log.info("Sending ChordNodeInfo message.")
@@ -130,24 +423,30 @@ class ChordTasks(object):
             log.info("No connected nodes, unable to perform stabilize.")
             return
 
-        # Fetch closest to ourselves.
-        closest_nodes, new_nodes = yield from\
-            self._perform_stabilize(self.engine.node_id, self.engine.peer_trie)
-
-        found_new_nodes |= new_nodes
-
-        closest_found_distance =\
-            closest_nodes[0].distance if closest_nodes else None
-
-        # Fetch furthest from ourselves.
+        # Fetch closest to ourselves, and at the same time furthest from
+        # ourselves.
         node_id = bytearray(self.engine.node_id)
         for i in range(len(node_id)):
             node_id[i] = (~node_id[i]) & 0xFF
 
-        furthest_nodes, new_nodes = yield from self._perform_stabilize(node_id)
+        closest_c = asyncio.async(\
+            self._perform_stabilize(\
+                self.engine.node_id, self.engine.peer_trie),\
+            loop=self.loop)
+        furthest_c = asyncio.async(\
+            self._perform_stabilize(node_id), loop=self.loop)
+
+        yield from asyncio.wait([closest_c, furthest_c], loop=self.loop)
+
+        closest_nodes, new_nodes = closest_c.result()
+        found_new_nodes |= new_nodes
 
+        furthest_nodes, new_nodes = furthest_c.result()
         found_new_nodes |= new_nodes
 
+        closest_found_distance =\
+            closest_nodes[0].distance if closest_nodes else None
+
         if not closest_found_distance:
             closest_found_distance = chord.NODE_ID_BITS
             if furthest_nodes:
@@ -160,63 +459,97 @@ class ChordTasks(object):
                     " searching inbetween closest and furthest.")
                 return
 
-#        closest_found_distance = 0
-#        log.warning("Stabilize FindNode id=[{:0512b}]."\
-#            .format(int.from_bytes(self.engine.node_id, "big")))
-
         # Fetch each bucket starting at furthest, stopping when we get to the
-        # closest that we found above.
-        orig_node_id = self.engine.node_id
+        # closest that we found above. Buckets are refreshed concurrently,
+        # skipping those that were refreshed recently.
+        now = datetime.today()
 
-        for bit in range(chord.NODE_ID_BITS-1, -1, -1):
-            if log.isEnabledFor(logging.INFO):
-                log.info("Performing FindNode for bucket [{}]."\
-                    .format(bit+1))
-
-            node_id = bytearray(orig_node_id)
-
-            # Change the most significant bit so that the resulting id is
-            # inside the bucket for said bit difference.
-            byte_ = chord.NODE_ID_BYTES - 1 - (bit >> 3)
-            bit_pos = bit % 8
-            node_id[byte_] ^= 1 << bit_pos
-
-            # Randomize the remaining less significant bits so that we are
-            # performing a FindNode for a random ID within the bucket.
-            if bit_pos:
-                bit_mask = 1 << (bit_pos - 1)
-                bit_mask ^= bit_mask - 1
-                node_id[byte_] ^= random.randint(0, 255) & bit_mask
-
-            for i in range(byte_ + 1, chord.NODE_ID_BYTES):
-                node_id[i] ^= random.randint(0, 255)
-
-#            log.warning("Stabilize FindNode id=[{:0512b}]."\
-#                .format(int.from_bytes(node_id, "big")))
-
-            assert mutil.calc_log_distance(\
-                node_id, self.engine.node_id)[0] == (bit + 1),\
-                "calc={}, bit={}, diff={}."\
-                    .format(\
-                        mutil.calc_log_distance(\
-                            node_id, self.engine.node_id)[0],\
-                        bit + 1,
-                        mutil.hex_string(\
-                            mutil.calc_raw_distance(\
-                                self.engine.node_id, node_id)))
+        tasks = []
 
-            nodes, new_nodes = yield from self._perform_stabilize(node_id)
-            found_new_nodes |= new_nodes
+        for bit in range(chord.NODE_ID_BITS-1, closest_found_distance-2, -1):
+            last_refresh = self.bucket_refresh_times[bit]
+            if last_refresh and now - last_refresh < BUCKET_REFRESH_INTERVAL:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Skipping recently refreshed bucket [{}]."\
+                        .format(bit+1))
+                continue
 
-            if not closest_found_distance and not nodes:
-                break
-            elif bit+1 == closest_found_distance:
-                break;
+            if len(tasks) == STABILIZE_CONCURRENCY:
+                done, pending = yield from asyncio.wait(\
+                    tasks, loop=self.loop,\
+                    return_when=futures.FIRST_COMPLETED)
 
-        if new_nodes:
+                for task in done:
+                    found_new_nodes |= task.result()
+
+                tasks = list(pending)
+
+            tasks.append(\
+                asyncio.async(self._refresh_bucket(bit), loop=self.loop))
+
+        if tasks:
+            done, pending = yield from asyncio.wait(tasks, loop=self.loop)
+
+            for task in done:
+                found_new_nodes |= task.result()
+
+        if found_new_nodes:
             log.info("Finished total stabilize, checking connections.")
             yield from self.engine.process_connection_count()
 
+    @asyncio.coroutine
+    def _refresh_bucket(self, bit):
+        "Perform a FindNode for a random ID within the bucket for bit."\
+        " returns: if any found nodes were new."
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Performing FindNode for bucket [{}].".format(bit+1))
+
+        node_id = bytearray(self.engine.node_id)
+
+        # Change the most significant bit so that the resulting id is
+        # inside the bucket for said bit difference.
+        byte_ = chord.NODE_ID_BYTES - 1 - (bit >> 3)
+        bit_pos = bit % 8
+        node_id[byte_] ^= 1 << bit_pos
+
+        # Randomize the remaining less significant bits so that we are
+        # performing a FindNode for a random ID within the bucket.
+        if bit_pos:
+            bit_mask = 1 << (bit_pos - 1)
+            bit_mask ^= bit_mask - 1
+            node_id[byte_] ^= random.randint(0, 255) & bit_mask
+
+        for i in range(byte_ + 1, chord.NODE_ID_BYTES):
+            node_id[i] ^= random.randint(0, 255)
+
+        assert mutil.calc_log_distance(\
+            node_id, self.engine.node_id)[0] == (bit + 1),\
+            "calc={}, bit={}, diff={}."\
+                .format(\
+                    mutil.calc_log_distance(\
+                        node_id, self.engine.node_id)[0],\
+                    bit + 1,
+                    mutil.hex_string(\
+                        mutil.calc_raw_distance(\
+                            self.engine.node_id, node_id)))
+
+        try:
+            nodes, new_nodes = yield from self._perform_stabilize(node_id)
+        except Exception:
+            log.exception("_perform_stabilize(..) for bucket [{}]."\
+                .format(bit+1))
+            return False
+
+        if new_nodes:
+            # Let the lookups still running benefit from the new nodes as
+            # soon as possible; connecting to them grows the set of PeerS
+            # each following FindNode starts from.
+            asyncio.async(self.engine.process_connection_count(),\
+                loop=self.loop)
+
+        return new_nodes
+
     @asyncio.coroutine
     def _perform_stabilize(self, node_id, input_trie=None):
         "returns: conn_nods, new_nodes"\
@@ -237,6 +570,12 @@ class ChordTasks(object):
         new_nodes = yield from self.engine.add_peers(\
             conn_nodes, process_check_connections=False)
 
+        # Only once it succeeded, as a failed lookup must not keep the bucket
+        # from being refreshed for BUCKET_REFRESH_INTERVAL.
+        distance = mutil.calc_log_distance(node_id, self.engine.node_id)[0]
+        if distance:
+            self.bucket_refresh_times[distance - 1] = datetime.today()
+
         return conn_nodes, bool(new_nodes)
 
     @asyncio.coroutine
@@ -498,6 +837,39 @@ class ChordTasks(object):
         " currently returns the count of nodes that claim to have stored the"\
         " data."
 
+        start = self.loop.time()
+
+        r = yield from self._send_find_node_request(\
+            node_id, significant_bits, input_trie, for_data, data_msg,\
+            data_key, path_hash, targeted, target_key, scan_only,\
+            retry_factor)
+
+        if for_data:
+            data_mode = cp.DataMode.get if data_msg is None\
+                else cp.DataMode.store
+        else:
+            data_mode = cp.DataMode.none
+
+        self.lookup_latency[data_mode].add(self.loop.time() - start)
+
+        return r
+
+    def get_lookup_stats(self):
+        "Returns the lookup latency histograms and round trip estimates."
+
+        return {\
+            "lookups": {mode.name: hist.get_stats()\
+                for mode, hist in self.lookup_latency.items()},\
+            "root_hops": self.hop_latency.get_stats(),\
+            "relay_rtts": [rtt.get_stats() for rtt in self.relay_rtts]}
+
+    def _relay_rtt(self, depth):
+        return self.relay_rtts[min(depth, RELAY_RTT_DEPTHS) - 1]
+
+    @asyncio.coroutine
+    def _send_find_node_request(self, node_id, significant_bits, input_trie,\
+            for_data, data_msg, data_key, path_hash, targeted, target_key,\
+            scan_only, retry_factor):
         assert len(node_id) == chord.NODE_ID_BYTES
         # data_key needs to be bytes for PyCrypto usage later on.
         assert data_key is None or type(data_key) is bytes, type(data_key)
@@ -512,7 +884,43 @@ class ChordTasks(object):
             log.info("No connected nodes, unable to send FindNode.")
             return self._generate_fail_response(data_mode, data_key)
 
-        if not input_trie:
+        cache_key = None
+        if data_mode is cp.DataMode.get and input_trie is None\
+                and not scan_only:
+            cache_key = (bytes(node_id), significant_bits, target_key)
+
+            entry = self.lookup_cache.get(cache_key)
+            if entry:
+                # Start from the PeerS that found this data last time.
+                input_trie = bittrie.BitTrie()
+                for peer in entry.first_hops:
+                    if not peer.ready():
+                        continue
+                    key = bittrie.XorKey(node_id, peer.node_id)
+                    input_trie[key] = peer
+
+                if input_trie:
+                    if log.isEnabledFor(logging.INFO):
+                        log.info("Using cached route of [{}] PeerS for"\
+                            " [{}]."\
+                                .format(len(input_trie),\
+                                    mbase32.encode(node_id)))
+
+                    data_rw = yield from self._send_find_node_request(\
+                        node_id, significant_bits, input_trie, for_data,\
+                        data_msg, data_key, path_hash, targeted, target_key,\
+                        scan_only, retry_factor)
+
+                    if data_rw.data is not None\
+                            or (significant_bits and data_rw.data_key):
+                        return data_rw
+
+                    log.info("Cached route failed; performing full FindNode.")
+
+                self.lookup_cache.remove(cache_key)
+                input_trie = None
+
+        if input_trie is None:
             input_trie = bittrie.BitTrie()
 #            for peer in self.engine.peer_trie:
             for peer in self.engine.peers.values():
@@ -571,27 +979,26 @@ class ChordTasks(object):
                 data_rw.targeted = True
 
         # Open the tunnels with upto max_initial_queries immediate PeerS.
+        spare_vpeers = [] # The next closest, for hedging.
+        hedges = {} # {task: (hedge_at, vpeer)}
         for peer in input_trie:
             key = bittrie.XorKey(node_id, peer.node_id)
             vpeer = VPeer(peer)
             # Store immediate PeerS in the result_trie.
             result_trie[key] = vpeer
 
+            if not peer.ready():
+                continue
             if len(tasks) == max_initial_queries:
                 # We still add all immediate PeerS so that later we can ignore
                 # them if they are included in lists returned by querying.
+                if len(spare_vpeers) < MAX_HEDGED_QUERIES:
+                    spare_vpeers.append(vpeer)
                 continue
-            if not peer.ready():
-                continue
-
-            tun_meta = TunnelMeta(peer)
-            used_tunnels[vpeer] = tun_meta
-
-            tasks.append(self._send_find_node(\
-                vpeer, fnmsg, result_trie, tun_meta, data_mode,\
-                far_peers_by_path, data_rw))
 
-            vpeer.used = True
+            tasks.append(self._start_root_find_node(\
+                vpeer, fnmsg, result_trie, data_mode, far_peers_by_path,\
+                data_rw, used_tunnels, hedges))
 
         if not tasks:
             log.info("Cannot perform FindNode, as we know no closer nodes.")
@@ -604,16 +1011,27 @@ class ChordTasks(object):
         done_cnt = 0
         max_time = 7.0 #TODO: This is probably excessive!
         diff = 0
-        start = datetime.today()
+        start = self.loop.time()
         while diff < max_time and done_cnt < max_initial_queries:
+            # Wake up when a query becomes slower than the p95 of its Peer,
+            # so that the next closest Peer can be queried as well.
+            timeout = max_time - diff
+            if spare_vpeers:
+                for task in tasks:
+                    hedge = hedges.get(task)
+                    if hedge:
+                        timeout = min(timeout, hedge[0] - start - diff)
+
             try:
                 done, pending =\
                     yield from asyncio.wait(\
                         tasks,\
                         loop=self.loop,\
-                        timeout=max_time - diff,\
+                        timeout=max(timeout, 0),\
                         return_when=futures.FIRST_COMPLETED)
             except asyncio.CancelledError:
+                for task in tasks:
+                    task.cancel()
                 self._close_channels(used_tunnels)
                 raise
 
@@ -623,7 +1041,29 @@ class ChordTasks(object):
             if not pending:
                 break
 
-            diff = (datetime.today() - start).total_seconds()
+            now = self.loop.time()
+            diff = now - start
+
+            for task in pending:
+                if not spare_vpeers:
+                    break
+
+                hedge = hedges.get(task)
+                if not hedge or hedge[0] > now:
+                    continue
+
+                del hedges[task]
+
+                vpeer = spare_vpeers.pop(0)
+
+                if log.isEnabledFor(logging.INFO):
+                    log.info("Hedging slow FindNode to Peer (dbid=[{}])"\
+                        " with Peer (dbid=[{}])."\
+                            .format(hedge[1].peer.dbid, vpeer.peer.dbid))
+
+                tasks.append(self._start_root_find_node(\
+                    vpeer, fnmsg, result_trie, data_mode,\
+                    far_peers_by_path, data_rw, used_tunnels, hedges))
 
         if not done_cnt:
             log.info("Couldn't open any tunnels in time, giving up.")
@@ -654,6 +1094,8 @@ class ChordTasks(object):
 
             direct_peers_lower = 0
             current_depth_step_query_cnt = 0
+            # Only count responses to what we send from now on.
+            done_one.clear()
             for row in result_trie:
                 if row is False:
                     # Row is ourself. Prevent infinite loops.
@@ -706,6 +1148,7 @@ class ChordTasks(object):
 
                 tun_meta.peer.protocol.write_channel_data(\
                     tun_meta.local_cid, pkt)
+                tun_meta.sent_times[row.path] = self.loop.time()
 
                 row.used = True
                 query_cntr.value += 1
@@ -737,15 +1180,21 @@ class ChordTasks(object):
 
 #            yield from done_all.wait()
 #            done_all.clear()
-            # Wait upto a second for at least one response.
+            # Wait for at least one response, but only as long as one
+            # usually takes at this depth. Past that, the next step hedges by
+            # querying the next closest nodes while these are outstanding.
+            # The responses themselves are sampled as they arrive, see
+            # __process_find_node_relay(..).
+            relay_rtt = self._relay_rtt(depth.value)
             try:
                 try:
                     yield from asyncio.wait_for(\
                         done_one.wait(),\
-                        timeout=1,\
+                        timeout=relay_rtt.p95() or relay_rtt.timeout(),\
                         loop=self.loop)
+                    responded = True
                 except asyncio.TimeoutError:
-                    pass
+                    responded = False
 
                 done_one.clear()
 
@@ -753,11 +1202,15 @@ class ChordTasks(object):
                 try:
                     yield from asyncio.wait_for(\
                         done_all.wait(),\
-                        timeout=0.1 * retry_factor,\
+                        timeout=relay_rtt.spread(0.1) * retry_factor,\
                         loop=self.loop)
+                    responded = True
                 except asyncio.TimeoutError:
                     pass
 
+                if not responded:
+                    relay_rtt.backoff()
+
                 done_all.clear()
             except asyncio.CancelledError:
                 self._close_channels(used_tunnels)
@@ -771,6 +1224,17 @@ class ChordTasks(object):
                 log.info("All tasks (tunnels) exited.")
                 break
 
+        if cache_key:
+            # Remember which immediate PeerS led to the nodes that have the
+            # data, to cache the route if the data is then fetched.
+            first_hops = []
+            for row in result_trie:
+                if not row or not row.data_present:
+                    continue
+                peer = row.tun_meta.peer if row.path else row.peer
+                if peer not in first_hops:
+                    first_hops.append(peer)
+
         # Proceed to the second stage of the request.
         # FIXME: Write this whole stuff to merge these two so it can be async.
         if data_mode.value and not scan_only:
@@ -1089,6 +1553,12 @@ class ChordTasks(object):
                         and (not significant_bits or not data_rw.data_key):
                     log.info("Failed to find the data!")
                 else:
+                    # Updateable key data changes, and the cached route could
+                    # keep leading to PeerS with an older version.
+                    if cache_key and first_hops\
+                            and data_rw.version is None:
+                        self.lookup_cache.put(cache_key, first_hops)
+
                     if data_rw.version is not None:
                         if log.isEnabledFor(logging.INFO):
                             log.info("Found updateable key data;"\
@@ -1150,10 +1620,20 @@ class ChordTasks(object):
         conn_nodes.clear()
 
     def _close_channels(self, used_tunnels):
-        for tun_meta in used_tunnels.values():
-            asyncio.async(\
-                tun_meta.peer.protocol.close_channel(tun_meta.local_cid),\
-                loop=self.loop)
+        tun_metas = [tun_meta for tun_meta in used_tunnels.values()\
+            if tun_meta.local_cid is not None]
+
+        if not tun_metas:
+            return
+
+        # One task for them all; a lookup can have dozens.
+        asyncio.async(self._close_tunnel_channels(tun_metas), loop=self.loop)
+
+    @asyncio.coroutine
+    def _close_tunnel_channels(self, tun_metas):
+        for tun_meta in tun_metas:
+            yield from\
+                tun_meta.peer.protocol.close_channel(tun_meta.local_cid)
 
     def _generate_fail_response(self, data_mode, data_key):
         if data_mode.value:
@@ -1169,36 +1649,31 @@ class ChordTasks(object):
         "path: list of indexes."\
         "payload_msg: optional packet data to wrap."
 
-        #TODO: MAYBE: replace embedded ChordRelay packets with
-        # just one that has a 'path' field. Just more simple,
-        # efficient and should be easy change. It means less work
-        # for intermediate nodes that may want to examine the deepest
-        # packet, in the case of data, in order to opportunistically
-        # store the data. This might be a less good solution for
-        # anonyminty, but it could be as easilty switched back if that
-        # is true and a priority.
-
-        #TODO: ChordRelay should be modified to allow a message payload instead
-        # of the byte 'packet' payload. This way it can recursively call
-        # encode() on the payloads that way appending data each iteration
-        # instead of the inefficient way it does it now with inserting the
-        # wrapping packet each iteration. This is an especially important
-        # improvement now that a huge data packet is tacked on the end.
-
-        pkt = None
-        for idx in reversed(path):
-            msg = cp.ChordRelay()
-            msg.index = idx
-            if pkt:
-                msg.packets = [pkt]
-            else:
-                if payload:
-                    msg.packets = [payload]
-                else:
-                    msg.packets = []
-            pkt = msg.encode()
+        return cp.ChordRelay.encode_path(path, payload)
 
-        return pkt
+    def _start_root_find_node(self, vpeer, fnmsg, result_trie, data_mode,\
+            far_peers_by_path, data_rw, used_tunnels, hedges):
+        "Starts a _send_find_node(..) task to the passed immediate Peer,"\
+        " noting in hedges when it will have been slower than usual."
+
+        peer = vpeer.peer
+
+        tun_meta = TunnelMeta(peer)
+        used_tunnels[vpeer] = tun_meta
+
+        task = asyncio.async(\
+            self._send_find_node(\
+                vpeer, fnmsg, result_trie, tun_meta, data_mode,\
+                far_peers_by_path, data_rw),\
+            loop=self.loop)
+
+        vpeer.used = True
+
+        p95 = peer.rtt.p95()
+        if p95 is not None:
+            hedges[task] = (self.loop.time() + p95, vpeer)
+
+        return task
 
     @asyncio.coroutine
     def _send_find_node(self, vpeer, fnmsg, result_trie, tun_meta,\
@@ -1211,18 +1686,26 @@ class ChordTasks(object):
 
         peer = vpeer.peer
 
-        try:
-            local_cid, queue =\
-                yield from asyncio.wait_for(\
-                    peer.protocol.open_channel("mpeer", True),\
-                    timeout=60,\
-                    loop=self.loop)
-        except asyncio.TimeoutError:
-            if log.isEnabledFor(logging.INFO):
-                log.info("Timeout opening channel to Peer (dbid=[{}])."\
-                    .format(peer.dbid))
-            peer.protocol.close()
-            queue = None
+        start = self.loop.time()
+
+        if peer.protocol.implicit_channels and peer.ready():
+            # The CHANNEL_OPEN goes out with the FindNode; there is nothing
+            # to wait for.
+            local_cid, queue = yield from peer.protocol.open_channel("mpeer")
+        else:
+            try:
+                local_cid, queue =\
+                    yield from asyncio.wait_for(\
+                        peer.protocol.open_channel("mpeer", True),\
+                        timeout=peer.rtt.timeout(),\
+                        loop=self.loop)
+            except asyncio.TimeoutError:
+                if log.isEnabledFor(logging.INFO):
+                    log.info("Timeout opening channel to Peer (dbid=[{}])."\
+                        .format(peer.dbid))
+                peer.rtt.backoff()
+                peer.protocol.close()
+                queue = None
 
         if not queue:
             if self.engine.node.tormode:
@@ -1240,6 +1723,13 @@ class ChordTasks(object):
                     done_all.set
             return
 
+        # So that _close_channels(..) closes it even if we never get a reply.
+        tun_meta.local_cid = local_cid
+
+        if data_mode.value:
+            # Keep the data from delaying the lookups of other channels.
+            peer.protocol.set_channel_priority(local_cid, mn1.PRIORITY_DATA)
+
         if log.isEnabledFor(logging.DEBUG):
             log.debug("Sending root level FindNode msg to Peer (dbid=[{}])."\
                 .format(peer.dbid))
@@ -1255,8 +1745,12 @@ class ChordTasks(object):
                     done_all.set
             return
 
+        # The channel open and the FindNode are each a round trip.
+        rtt = self.loop.time() - start
+        peer.rtt.sample(rtt)
+        self.hop_latency.add(rtt)
+
         tun_meta.queue = queue
-        tun_meta.local_cid = local_cid
 
         if data_mode.value:
             if data_mode is cp.DataMode.store:
@@ -1397,6 +1891,13 @@ class ChordTasks(object):
                 pkts, path = self.unwrap_relay_packets(pkt, data_mode)
                 path = tuple(path)
 
+                # Even if it is too late for the depth step it was sent in,
+                # so that the estimate isn't skewed towards fast responses.
+                sent_time = tun_meta.sent_times.pop(path, None)
+                if sent_time is not None:
+                    self._relay_rtt(len(path))\
+                        .sample(self.loop.time() - sent_time)
+
             pkt_type = cp.ChordMessage.parse_type(pkts[0])
 
             if data_mode.value and pkt_type != cp.CHORD_MSG_PEER_LIST:
@@ -1576,61 +2077,52 @@ class ChordTasks(object):
         "Returns the inner most packet and the path stored in the relay"\
         " packets."
 
-        path = []
         invalid = False
 
-        while True:
-            msg = cp.ChordRelay(pkt)
-            path.append(msg.index)
-            pkts = msg.packets
-
-            if len(pkts) == 1:
-                pkt = pkts[0]
-
-                packet_type = cp.ChordMessage.parse_type(pkt)
-                if packet_type == cp.CHORD_MSG_RELAY:
-                    continue
-                elif packet_type == cp.CHORD_MSG_PEER_LIST\
-                        or (data_mode is cp.DataMode.get\
-                            and (packet_type == cp.CHORD_MSG_DATA_RESPONSE\
-                                or packet_type == cp.CHORD_MSG_DATA_PRESENCE))\
-                        or (data_mode is cp.DataMode.store\
-                            and (packet_type == cp.CHORD_MSG_DATA_STORED\
-                                or packet_type\
-                                    == cp.CHORD_MSG_STORAGE_INTEREST)):
-                    # Break as we reached deepest packet.
-                    break
-                else:
-                    log.warning("Unexpected packet_type [{}]; ignoring."\
-                        .format(packet_type))
+        # Walk the nested relay headers in place; only the deepest packets
+        # are copied out.
+        path, pkts = cp.ChordRelay.unwrap(pkt)
+
+        if len(pkts) == 1:
+            pkt = pkts[0]
+
+            packet_type = cp.ChordMessage.parse_type(pkt) if pkt else None
+            if packet_type == cp.CHORD_MSG_PEER_LIST\
+                    or (data_mode is cp.DataMode.get\
+                        and (packet_type == cp.CHORD_MSG_DATA_RESPONSE\
+                            or packet_type == cp.CHORD_MSG_DATA_PRESENCE))\
+                    or (data_mode is cp.DataMode.store\
+                        and (packet_type == cp.CHORD_MSG_DATA_STORED\
+                            or packet_type\
+                                == cp.CHORD_MSG_STORAGE_INTEREST)):
+                # We reached deepest packet.
+                pass
+            else:
+                log.warning("Unexpected packet_type [{}]; ignoring."\
+                    .format(packet_type))
+                invalid = True
+        elif len(pkts) > 1:
+            # In data mode, PeerS return their storage intent, as well as a
+            # list of their connected PeerS.
+            if data_mode.value:
+                if data_mode is cp.DataMode.get\
+                        and (cp.ChordMessage.parse_type(pkts[0])\
+                                != cp.CHORD_MSG_DATA_PRESENCE\
+                            or cp.ChordMessage.parse_type(pkts[1])\
+                                != cp.CHORD_MSG_PEER_LIST):
                     invalid = True
-                    break
-            elif len(pkts) > 1:
-                # In data mode, PeerS return their storage intent, as well as a
-                # list of their connected PeerS.
-                if data_mode.value:
-                    if data_mode is cp.DataMode.get\
-                            and (cp.ChordMessage.parse_type(pkts[0])\
-                                    != cp.CHORD_MSG_DATA_PRESENCE\
-                                or cp.ChordMessage.parse_type(pkts[1])\
-                                    != cp.CHORD_MSG_PEER_LIST):
-                        invalid = True
-                    elif data_mode is cp.DataMode.store\
-                            and (cp.ChordMessage.parse_type(pkts[0])\
-                                    != cp.CHORD_MSG_STORAGE_INTEREST\
-                                or cp.ChordMessage.parse_type(pkts[1])\
-                                    != cp.CHORD_MSG_PEER_LIST):
-                        invalid = True
-                else:
+                elif data_mode is cp.DataMode.store\
+                        and (cp.ChordMessage.parse_type(pkts[0])\
+                                != cp.CHORD_MSG_STORAGE_INTEREST\
+                            or cp.ChordMessage.parse_type(pkts[1])\
+                                != cp.CHORD_MSG_PEER_LIST):
                     invalid = True
-
-                # Break as we reached deepest packets.
-                break
             else:
-                # There should never be an empty relay packet embedded when
-                # this method is called.
                 invalid = True
-                break
+        else:
+            # There should never be an empty relay packet embedded when
+            # this method is called.
+            invalid = True
 
         if invalid:
             #FIXME: We should probably update the hostility tracking of both
@@ -1712,31 +2204,17 @@ class ChordTasks(object):
         "Process an incoming FindNode request."\
         " The channel will be closed before this method returns."
 
-        pt = bittrie.BitTrie()
-
-        for cpeer in self.engine.peers.values():
-            if cpeer == peer:
-                # Don't include asking peer.
-                continue
-            if not cpeer.full_node:
-                continue
-            if not cpeer.ready:
-                continue
-
-            pt[bittrie.XorKey(fnmsg.node_id, cpeer.node_id)] = cpeer
-
-#        # We don't want to deal with further nodes than ourselves.
-#        pt[bittrie.XorKey(fnmsg.node_id, self.engine.node_id)] = True
+        if fnmsg.data_mode.value:
+            peer.protocol.set_channel_priority(local_cid, mn1.PRIORITY_DATA)
 
-        cnt = 20
-        rlist = []
+        def accept(cpeer):
+            # Don't include asking peer.
+            return cpeer is not peer and cpeer.full_node and cpeer.ready()
 
-        for r in pt:
-#            if r is True:
-#                log.info("No more nodes closer than ourselves.")
-#                break
+        rlist = self.engine.routing_table.closest(fnmsg.node_id, 20, accept)
 
-            if log.isEnabledFor(logging.DEBUG):
+        if log.isEnabledFor(logging.DEBUG):
+            for r in rlist:
                 log.debug("nn: {} FOUND: {:7} {:22} node_id=[{}] diff=[{}]"\
                     .format(self.engine.node.instance, r.dbid, r.address,\
                         mbase32.encode(r.node_id),\
@@ -1744,19 +2222,19 @@ class ChordTasks(object):
                             mutil.calc_raw_distance(\
                                 r.node_id, fnmsg.node_id))))
 
-            rlist.append(r)
-
-            cnt -= 1
-            if not cnt:
-                break
-
-        # Free memory? We no longer need this, and we may be tunneling for
-        # some time.
-        pt = None
-
         will_store = False
         need_pruning = False
         data_present = False
+
+        # Set if we relay-cache data for this request. We can't verify the
+        # data against its key, so we never claim to have it ourselves; the
+        # cache only answers GetData on behalf of a tunnel Peer that did.
+        cache_id = None
+        if self.relay_cache is not None\
+                and fnmsg.data_mode is cp.DataMode.get\
+                and not fnmsg.significant_bits:
+            cache_id = bytes(fnmsg.node_id)
+
         if fnmsg.data_mode.value:
             # In for_data mode we respond with two packets.
             if fnmsg.data_mode is cp.DataMode.get:
@@ -1916,7 +2394,7 @@ class ChordTasks(object):
                 asyncio.async(\
                     self._process_find_node_tunnel(\
                         peer, local_cid, rmsg.index, tun_meta, tun_cntr,\
-                        fnmsg.data_mode),\
+                        fnmsg.data_mode, cache_id),\
                     loop=self.loop)
                 yield from tun_meta.jobs.put(fndata)
             elif tun_meta.jobs:
@@ -1943,6 +2421,25 @@ class ChordTasks(object):
                     # else: It is likely a {Get,Store}Data message, which is
                     # ok.
 
+                if cache_id\
+                        and cp.ChordMessage.parse_type(e_pkt)\
+                            == cp.CHORD_MSG_GET_DATA:
+                    pkt = self.relay_cache.get(tun_meta.peer.node_id, cache_id)
+                    if pkt:
+                        # Answer for the tunnel Peer with what it sent us
+                        # before, saving the round trip.
+                        if log.isEnabledFor(logging.INFO):
+                            log.info("Answering GetData for tunnel [{}] from"\
+                                " our relay cache.".format(rmsg.index))
+
+                        msg = cp.ChordRelay()
+                        msg.index = rmsg.index
+                        msg.packets = [pkt]
+
+                        peer.protocol.write_channel_data(\
+                            local_cid, msg.encode())
+                        continue
+
                 # If all good, tell tunnel process to forward embedded packet.
                 yield from tun_meta.jobs.put(e_pkt)
             else:
@@ -1955,7 +2452,8 @@ class ChordTasks(object):
 
     @asyncio.coroutine
     def _process_find_node_tunnel(\
-            self, rpeer, rlocal_cid, index, tun_meta, tun_cntr, data_mode):
+            self, rpeer, rlocal_cid, index, tun_meta, tun_cntr, data_mode,\
+            cache_id=None):
         assert type(rpeer) is mnpeer.Peer
 
         "Start a tunnel to the Peer in tun_meta by opening a channel and then"
@@ -1981,11 +2479,16 @@ class ChordTasks(object):
                     rpeer, rlocal_cid, index, job_cnt)
             return
 
+        if data_mode.value:
+            tun_meta.peer.protocol.set_channel_priority(\
+                tun_meta.local_cid, mn1.PRIORITY_DATA)
+
         req_cntr = Counter(0)
 
         asyncio.async(\
             self._process_find_node_tunnel_responses(\
-                rpeer, rlocal_cid, index, tun_meta, req_cntr, data_mode),
+                rpeer, rlocal_cid, index, tun_meta, req_cntr, data_mode,\
+                cache_id),
             loop=self.loop)
 
         jobs = tun_meta.jobs
@@ -2006,10 +2509,17 @@ class ChordTasks(object):
 
             req_cntr.value += 1
 
+            # Don't relay faster than the next Peer accepts.
+            yield from\
+                tun_meta.peer.protocol.drain_channel(tun_meta.local_cid)
+
     @asyncio.coroutine
     def _process_find_node_tunnel_responses(\
-            self, rpeer, rlocal_cid, index, tun_meta, req_cntr, data_mode):
-        "Process the responses from a tunnel and relay them back to rpeer."
+            self, rpeer, rlocal_cid, index, tun_meta, req_cntr, data_mode,\
+            cache_id=None):
+        "Process the responses from a tunnel and relay them back to rpeer."\
+        " If cache_id is set, a DataResponse from the immediate Peer is kept"\
+        " in self.relay_cache under it and that Peer's node_id."
 
         tunnel_closed = False
 
@@ -2033,7 +2543,8 @@ class ChordTasks(object):
                         and pkt_type == cp.CHORD_MSG_DATA_RESPONSE:
                     #TODO: Verify the data matches the key before relaying.
                     # Relay the DataResponse from immediate Peer.
-                    pass
+                    if cache_id:
+                        self._cache_relayed_data(tun_meta.peer, cache_id, pkt)
                 elif data_mode is cp.DataMode.store\
                         and pkt_type == cp.CHORD_MSG_DATA_STORED:
                     # Relay the DataStored from immediate Peer.
@@ -2072,6 +2583,10 @@ class ChordTasks(object):
 
             req_cntr.value -= 1
 
+            # Stop reading the tunnel while rpeer is slower than it, so that
+            # its window closes in turn.
+            yield from rpeer.protocol.drain_channel(rlocal_cid)
+
             if tunnel_closed:
                 break
 
@@ -2084,6 +2599,22 @@ class ChordTasks(object):
         tun_meta.jobs = None
         yield from jobs.put(None)
 
+    def _cache_relayed_data(self, peer, cache_id, pkt):
+        drmsg = cp.ChordDataResponse(pkt)
+
+        if not drmsg.data or drmsg.version is not None:
+            # Updateable key data changes, so only immutable blocks are safe
+            # to serve from the cache. The requester verifies the data against
+            # its key either way.
+            return
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Caching relayed data (data_id=[{}], size=[{}],"\
+                " Peer.dbid=[{}])."\
+                    .format(mbase32.encode(cache_id), len(pkt), peer.dbid))
+
+        self.relay_cache.put(peer.node_id, cache_id, pkt)
+
     @asyncio.coroutine
     def _signal_find_node_tunnel_closed(self, rpeer, rlocal_cid, index, cnt):
         rmsg = cp.ChordRelay()
@@ -2139,6 +2670,10 @@ class ChordTasks(object):
             if distance > self.engine.furthest_data_block:
                 return False
 
+            if self.data_cache is not None\
+                    and bytes(data_id) in self.data_cache:
+                return True
+
         def dbcall():
             with self.engine.node.db.open_session() as sess:
                 if significant_bits and significant_bits >= min_sig_bits:
@@ -2231,14 +2766,29 @@ class ChordTasks(object):
         if distance > self.engine.furthest_data_block:
             return False, False
 
-        current_datastore_size = self.engine.node.datastore_size
-        current_datastore_max_size = self.engine.node.datastore_max_size
+        # If there is space contention, then we check if pruning blocks that
+        # are further than this one would free enough space to store it.
+        # We don't worry about inaccuracy caused by padding for now.
+        needed_space = self.engine.node.datastore_size\
+            - (self.engine.node.datastore_max_size\
+                - mnnode.MAX_DATA_BLOCK_SIZE)
+
+        blocks_to_prune, freeable_space =\
+            self.engine.node.distance_index.select_prunable(\
+                distance, needed_space)
+
+        if freeable_space < needed_space:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Not enough purgable blocks to fit new proposed"\
+                    " block.")
+            return False, True
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Found enough purgable blocks to fit new proposed"\
+                " block.")
 
-        # If there is space contention, then we do a more complex algorithm
-        # in order to see if we want to store it.
         def dbcall():
             with self.engine.node.db.open_session() as sess:
-                # First check if we have this block already.
                 q = sess.query(func.count("*")).select_from(DataBlock)
                 q = q.filter(DataBlock.data_id == data_id)
 
@@ -2246,31 +2796,7 @@ class ChordTasks(object):
                     # We already have this block.
                     return False
 
-                # We don't worry about inaccuracy caused by padding for now.
-                q = sess.query(DataBlock.original_size)\
-                    .filter(DataBlock.distance > distance)\
-                    .filter(DataBlock.original_size != 0)\
-                    .order_by(DataBlock.distance.desc())
-
-                freeable_space = 0
-                for block in mutil.page_query(q):
-                    freeable_space += block.original_size
-
-                    if current_datastore_size - freeable_space\
-                            <= current_datastore_max_size\
-                                - mnnode.MAX_DATA_BLOCK_SIZE:
-                        if log.isEnabledFor(logging.DEBUG):
-                            log.debug("Found enough purgable blocks to fit"\
-                                " new proposed block.")
-                        return True
-
-                assert current_datastore_size - freeable_space\
-                    > current_datastore_max_size - mnnode.MAX_DATA_BLOCK_SIZE
-
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("Not enough purgable blocks to fit new"\
-                        " proposed block.")
-                return False
+                return True
 
         return (yield from self.loop.run_in_executor(None, dbcall)), True
 
@@ -2376,6 +2902,14 @@ class ChordTasks(object):
         "   original_size is the size of the data before it was encrypted."\
         "   version, Etc. are for updateable keys."
 
+        data_cache = self.data_cache
+        if data_cache is not None:
+            cache_id = bytes(data_id)
+            entry = data_cache.get(cache_id)
+            if entry is not None:
+                return entry
+            generation = data_cache.generation
+
         def dbcall():
             with self.engine.node.db.open_session() as sess:
                 data_block = sess.query(DataBlock).filter(\
@@ -2393,18 +2927,8 @@ class ChordTasks(object):
         if not data_block:
             return None, None, None, None, None, None
 
-        def iocall():
-            filename = self.engine.node.data_block_file_path.format(\
-                self.engine.node.instance, data_block.id)
-
-            try:
-                with open(filename, "rb") as data_file:
-                    data = data_file.read()
-                    return data
-            except FileNotFoundError:
-                return None
-
-        enc_data = yield from self.loop.run_in_executor(None, iocall)
+        enc_data = yield from self.loop.run_in_executor(\
+            None, self.engine.node.data_store.get, data_block.id)
 
         if enc_data is None:
             log.warning("Block id=[{}] was missing; Removing DB entry."\
@@ -2412,21 +2936,58 @@ class ChordTasks(object):
 
             def dbcall_prune():
                 with self.engine.node.db.open_session() as sess:
-                    sess.query(DataBlock)\
+                    self.engine.node.db.lock_table(sess, DataBlock)
+
+                    q = sess.query(func.count("*"))\
+                        .select_from(DataBlockJournal)\
+                        .filter(DataBlockJournal.data_block_id\
+                            == data_block.id)\
+                        .filter(DataBlockJournal.storing == True)
+
+                    if q.scalar() > 0:
+                        # Its data is still being written (or will be
+                        # dropped at startup if that was interrupted).
+                        if log.isEnabledFor(logging.INFO):
+                            log.info("Block id=[{}] is being stored; not"\
+                                " removing it.".format(data_block.id))
+                        return False
+
+                    cnt = sess.query(DataBlock)\
                         .filter(DataBlock.id == data_block.id)\
                         .delete(synchronize_session=False)
+
+                    if not cnt:
+                        # Already removed, by a prune for instance.
+                        return False
+
+                    self._update_nodestate(sess, -data_block.original_size)
+
                     sess.commit()
 
-            yield from self.loop.run_in_executor(None, dbcall_prune)
+                    return True
+
+            r = yield from self.loop.run_in_executor(None, dbcall_prune)
+
+            if r:
+                self.engine.node.datastore_size -= data_block.original_size
+
+                index = self.engine.node.distance_index
+                index.remove(data_block.id)
+                self.engine.furthest_data_block = index.furthest()
 
             return None, None, None, None, None, None
 
         version =\
             int(data_block.version) if data_block.version is not None else None
 
-        return enc_data, data_block.original_size, version,\
+        entry = enc_data, data_block.original_size, version,\
             data_block.signature, data_block.epubkey, data_block.pubkeylen
 
+        if data_cache is not None:
+            data_cache.put(cache_id, entry, generation)
+
+        return entry
+
     @asyncio.coroutine
     def _store_key(self, peer, data_id, dmsg):
         if dmsg.targeted:
@@ -2478,6 +3039,8 @@ class ChordTasks(object):
 
             return False
 
+        self.engine.node.distance_index.add(data_block_id, distance, 0)
+
         if distance > self.engine.furthest_data_block:
             self.engine.furthest_data_block = distance
 
@@ -2492,23 +3055,81 @@ class ChordTasks(object):
         "Store the data block on disk and meta in the database. Returns True"
         " if the data was stored, False otherwise."
 
-        #TODO: I now realize that this whole method should probably run in a
-        # separate thread that is passed to run_in_executor(..), instead of
-        # breaking it up into many such calls. Just for efficiency and since
-        # there is probably no reason not to.
-        #FIXME: This code needs to be fixed to use an additional table,
-        # something like DataBlockJournal, which tracks pending deletes or
-        # creations, thus ensuring the filesystem is kept in sync, even if
-        # crashes, Etc.
+        # Checks and encryption run in the executor, concurrently for
+        # concurrent stores. The rest is queued for _process_store_queue(..),
+        # which writes all the stores that queued up meanwhile in a single
+        # executor call and transaction.
+        # The DataBlock changes are committed along with DataBlockJournal
+        # rows which are only removed once the data store matches, so that
+        # Node.init_store(..) can finish what a crash interrupted.
 
         peer_dbid = peer.dbid if peer else "<self>"
 
+        job = StoreJob(data_id, dmsg, need_pruning)
+
+        yield from self.loop.run_in_executor(\
+            None, self._prepare_store, job, peer_dbid)
+
+        job.future = asyncio.futures.Future(loop=self.loop)
+
+        self._store_queue.append(job)
+        if not self._processing_store_queue:
+            self._processing_store_queue = True
+            asyncio.async(self._process_store_queue(), loop=self.loop)
+
+        try:
+            yield from job.future
+        finally:
+            if self.data_cache is not None:
+                for pruned_data_id in job.pruned_data_ids:
+                    self.data_cache.remove(bytes(pruned_data_id))
+
+        if not job.data_block_id:
+            if log.isEnabledFor(logging.INFO):
+                if job.data_block_id is False:
+                    log.info("Not storing block we said we would as we"\
+                        " can won't free up enough space for it. (Some"\
+                        " other block upload must have beaten this one to"\
+                        " us.")
+                else:
+                    log.info("Not storing data that we already have"\
+                        " (data_id=[{}])."\
+                        .format(mbase32.encode(data_id)))
+            return False
+
+        self.engine.node.datastore_size += job.size_diff
+        self.engine.furthest_data_block =\
+            self.engine.node.distance_index.furthest()
+
+        if self.data_cache is not None and (dmsg.pubkey or job.failed):
+            # Don't serve the previous version anymore.
+            self.data_cache.remove(bytes(data_id))
+
+        if job.failed:
+            log.warning("There was an exception attempting to store the data"\
+                " on disk.")
+            return False
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Stored data for data_id=[{}] as block id=[{}]."\
+                .format(mbase32.encode(data_id), job.data_block_id))
+
+        if need_pruning or dmsg.pubkey:
+            # Pruned or replaced blocks leave space to reclaim.
+            self._check_compact_data_store()
+
+        return True
+
+    def _prepare_store(self, job, peer_dbid):
+        "Runs in the executor. Checks that the ChordStoreData of job is valid"\
+        " and encrypts its data, raising ChordException if it isn't."
+
+        dmsg = job.dmsg
+        data_id = job.data_id
         data = dmsg.data
-        targeted = dmsg.targeted
 
-        pubkey = None
         if dmsg.pubkey:
-            if targeted:
+            if dmsg.targeted:
                 errmsg = "Targeted updateable key is not implemented."
                 log.warning(errmsg)
                 raise ChordException(errmsg)
@@ -2543,9 +3164,13 @@ class ChordTasks(object):
                     .format(peer_dbid)
                 log.warning(errmsg)
                 raise ChordException(errmsg)
+
+            a, b = enc.encrypt_data_block(dmsg.pubkey, data_key)
+            job.epubkey = a + b
         else:
-            if targeted:
+            if dmsg.targeted:
                 tb, data_key = self._check_store_targeted_block(data)
+                job.target_key = tb.target_key
             else:
                 data_key = enc.generate_ID(data)
 
@@ -2555,222 +3180,310 @@ class ChordTasks(object):
                 log.warning(errmsg)
                 raise ChordException(errmsg)
 
-        distance = mutil.calc_raw_distance(self.engine.node_id, data_id)
-        original_size = len(data)
+        job.distance = mutil.calc_raw_distance(self.engine.node_id, data_id)
+        job.original_size = len(data)
 
-        def dbcall():
-            with self.engine.node.db.open_session() as sess:
-                self.engine.node.db.lock_table(sess, DataBlock)
+        if log.isEnabledFor(logging.INFO):
+            log.info("Encrypting [{}] bytes of data.".format(len(data)))
+
+        #TODO: If not too much a performance cost: Hash encrypted data
+        # block and store hash in the db so we can verify it didn't become
+        # corrupted on the filesystem. This is because we will be penalized
+        # by the network if we give invalid data when asked for.
+        #NOTE: Actually, it should be fine as we can do it in another
+        # thread and thus not impact our eventloop thread. We can do it
+        # concurrently with encryption!
+
+        # PyCrypto works in blocks, so extra than round block size goes
+        # into enc_data_remainder.
+        enc_data, enc_data_remainder = enc.encrypt_data_block(data, data_key)
+
+        if enc_data_remainder:
+            job.datas = (enc_data, enc_data_remainder)
+        else:
+            job.datas = (enc_data,)
 
-                old_entry = None
-                if pubkey:
-                    old_entry = sess.query(DataBlock)\
-                        .filter(DataBlock.data_id == data_id)\
-                        .first()
-                    if old_entry:
-                        vint = int(old_entry.version)
-                        if vint >= dmsg.version:
-                            # We only want to store newer versions.
-                            return None, None
-                else:
-                    q = sess.query(func.count("*")).select_from(DataBlock)
-                    q = q.filter(DataBlock.data_id == data_id)
+    @asyncio.coroutine
+    def _process_store_queue(self):
+        queue = self._store_queue
 
-                    if q.scalar() > 0:
-                        # We already have this block.
-                        return None, None
+        try:
+            while queue:
+                batch = queue[:MAX_STORE_BATCH]
+                del queue[:MAX_STORE_BATCH]
 
-                if need_pruning:
-                    freeable_space = 0
-                    blocks_to_prune = []
+                try:
+                    yield from self.loop.run_in_executor(\
+                        None, self._write_store_batch, batch)
+                except Exception as e:
+                    log.exception("_write_store_batch(..)")
+                    for job in batch:
+                        if not job.future.done():
+                            job.future.set_exception(e)
+                    continue
 
-                    q = sess.query(DataBlock.id, DataBlock.original_size)\
-                        .filter(DataBlock.distance > distance)\
-                        .filter(DataBlock.original_size != 0)\
-                        .order_by(DataBlock.distance.desc())
+                for job in batch:
+                    if job.future.done():
+                        continue
+                    if job.error:
+                        job.future.set_exception(job.error)
+                    else:
+                        job.future.set_result(None)
+        finally:
+            self._processing_store_queue = False
+
+    def _write_store_batch(self, batch):
+        "Runs in the executor. Commits the DataBlock rows of all the"\
+        " StoreJobS in batch in one transaction, then puts their data in the"\
+        " data store. The outcome is set on each StoreJob. If the"\
+        " transaction fails, the StoreJobS are retried one at a time so that"\
+        " only the failing ones fail."
+
+        if len(batch) > 1:
+            try:
+                self._commit_store_batch(batch)
+                return
+            except _StoreBatchAborted:
+                for job in batch:
+                    job.reset()
 
-                    for block in mutil.page_query(q):
-                        freeable_space += block.original_size
-                        blocks_to_prune.append(block.id)
+        for job in batch:
+            try:
+                self._commit_store_batch([job])
+            except _StoreBatchAborted as e:
+                job.error = e.__cause__
 
-                        if freeable_space >= original_size:
-                            break
+    def _commit_store_batch(self, batch):
+        db = self.engine.node.db
+        data_store = self.engine.node.data_store
+        index = self.engine.node.distance_index
 
-                    if freeable_space < original_size:
-                        return False, None
+        with db.open_session() as sess:
+            db.lock_table(sess, DataBlock)
 
-                    if log.isEnabledFor(logging.INFO):
-                        log.info("Pruning {} blocks to make room."\
-                            .format(len(blocks_to_prune)))
-
-                    for anid in blocks_to_prune:
-                        sess.query(DataBlock)\
-                            .filter(DataBlock.id == anid)\
-                            .delete(synchronize_session=False)
-
-                updateable_size_diff = None
-                if old_entry:
-                    data_block = old_entry
-                    assert data_block.data_id == data_id
-                    updateable_size_diff =\
-                        original_size - data_block.original_size
-                else:
-                    data_block = DataBlock()
-                    data_block.data_id = data_id
-                    data_block.distance = distance
-
-                if pubkey:
-                    data_block.version = str(dmsg.version)
-                    data_block.signature = dmsg.signature
-
-                    a, b = enc.encrypt_data_block(dmsg.pubkey, data_key)
-                    data_block.epubkey = a + b
-                    data_block.pubkeylen = len(dmsg.pubkey)
-
-                if targeted:
-                    if log.isEnabledFor(logging.DEBUG):
-                        log.debug("Storing TargetedBlock (target_key=[{}])."\
-                            .format(mbase32.encode(tb.target_key)))
-                    # We don't need the following for anything coded yet, but
-                    # doing it for now because then we can tell which are
-                    # targeted blocks as we may want to have code purge them
-                    # with more pressure than normal blocks.
-                    data_block.target_key = tb.target_key
+            stored = [] # [(StoreJob, DataBlockJournal)]
+            # Blocks stored or pruned by this batch, which the index will
+            # only reflect once it is committed.
+            exclude = set()
+            prune_entries = []
+            size_diff = 0
 
-                data_block.original_size = original_size
-                data_block.insert_timestamp = mutil.utc_datetime()
+            try:
+                for job in batch:
+                    journal_entry = self._add_data_block(\
+                        sess, job, exclude, prune_entries)
 
-                if not old_entry:
-                    sess.add(data_block)
+                    if not journal_entry:
+                        continue
 
-                if updateable_size_diff is not None:
-                    size_diff = updateable_size_diff
-                else:
-                    size_diff = original_size
+                    stored.append((job, journal_entry))
+                    exclude.add(job.data_block_id)
+                    exclude.update(job.pruned_block_ids)
+                    size_diff += job.size_diff
 
-                if need_pruning:
-                    size_diff -= freeable_space
+                if not stored:
+                    return
 
                 self._update_nodestate(sess, size_diff)
 
                 sess.commit()
+            except Exception as e:
+                # Nothing was committed, so the StoreJobS can be retried.
+                log.exception("Storing DataBlock rows")
+                sess.rollback()
+                raise _StoreBatchAborted() from e
+
+            for job, journal_entry in stored:
+                for anid in job.pruned_block_ids:
+                    index.remove(anid)
+                index.add(job.data_block_id, job.distance, job.original_size)
+
+            for job, journal_entry in stored:
+                for anid in job.pruned_block_ids:
+                    if not data_store.remove(anid):
+                        if log.isEnabledFor(logging.WARNING):
+                            log.warning("Block id=[{}] was missing when"\
+                                " pruning; considered pruned anyways."\
+                                    .format(anid))
+
+            failed = []
+            for job, journal_entry in stored:
+                if log.isEnabledFor(logging.INFO):
+                    log.info("Storing [{}] bytes of data."\
+                        .format(sum(len(x) for x in job.datas)))
 
-                if need_pruning:
-                    for anid in blocks_to_prune:
-                        try:
-                            os.remove(self.engine.node.data_block_file_path\
-                                .format(self.engine.node.instance, anid))
-                        except FileNotFoundError:
-                            if log.isEnabledFor(logging.WARNING):
-                                log.warning("FileNotFoundError pruning block"\
-                                    " id=[{}]; considered pruned anyways."\
-                                        .format(anid))
+                try:
+                    data_store.put(job.data_block_id, job.datas)
+                except Exception:
+                    log.exception("data_store.put(..)")
+                    failed.append((job, journal_entry))
+                    continue
 
-                return data_block.id, size_diff
+                sess.delete(journal_entry)
 
-        data_block_id, size_diff =\
-            yield from self.loop.run_in_executor(None, dbcall)
+            for entry in prune_entries:
+                sess.delete(entry)
 
-        if not data_block_id:
-            if log.isEnabledFor(logging.INFO):
-                if data_block_id is False:
-                    log.info("Not storing block we said we would as we"\
-                        " can won't free up enough space for it. (Some"\
-                        " other block upload must have beaten this one to"\
-                        " us.")
-                else:
-                    log.info("Not storing data that we already have"\
-                        " (data_id=[{}])."\
-                        .format(mbase32.encode(data_id)))
-            return False
+            if failed:
+                db.lock_table(sess, DataBlock)
 
-        self.engine.node.datastore_size += size_diff
+                size_diff = 0
+                for job, journal_entry in failed:
+                    job.failed = True
 
-        try:
-            if log.isEnabledFor(logging.INFO):
-                log.info("Encrypting [{}] bytes of data.".format(len(data)))
+                    sess.query(DataBlock)\
+                        .filter(DataBlock.id == job.data_block_id)\
+                        .delete(synchronize_session=False)
 
-            #TODO: If not too much a performance cost: Hash encrypted data
-            # block and store hash in the db so we can verify it didn't become
-            # corrupted on the filesystem. This is because we will be penalized
-            # by the network if we give invalid data when asked for.
-            #NOTE: Actually, it should be fine as we can do it in another
-            # thread and thus not impact our eventloop thread. We can do it
-            # concurrently with encryption!
+                    job.size_diff -= job.original_size
+                    size_diff -= job.original_size
 
-            # PyCrypto works in blocks, so extra than round block size goes
-            # into enc_data_remainder.
-            def threadcall():
-                return enc.encrypt_data_block(data, data_key)
+                    try:
+                        data_store.remove(job.data_block_id)
+                    except Exception:
+                        # Leave the journal entry for startup to retry.
+                        log.exception("data_store.remove(..)")
+                        continue
 
-            enc_data, enc_data_remainder\
-                = yield from self.loop.run_in_executor(None, threadcall)
+                    sess.delete(journal_entry)
 
-            if log.isEnabledFor(logging.INFO):
-                tlen = len(enc_data)
-                if enc_data_remainder:
-                    tlen += len(enc_data_remainder)
-                log.info("Storing [{}] bytes of data.".format(tlen))
+                self._update_nodestate(sess, size_diff)
 
-            def iocall():
-                filename = self.engine.node.data_block_file_path.format(\
-                    self.engine.node.instance, data_block_id)
+            sess.commit()
 
-                with open(filename, "wb") as new_file:
-                    new_file.write(enc_data)
-                    if enc_data_remainder:
-                        new_file.write(enc_data_remainder)
+            for job, journal_entry in failed:
+                index.remove(job.data_block_id)
 
-            yield from self.loop.run_in_executor(None, iocall)
+    def _add_data_block(self, sess, job, exclude, prune_entries):
+        "Adds or updates the DataBlock of job, pruning if need be. Returns"\
+        " its DataBlockJournal entry, or None if it is not to be stored."
 
-            if distance > self.engine.furthest_data_block:
-                self.engine.furthest_data_block = distance
+        dmsg = job.dmsg
+        data_id = job.data_id
+        distance = job.distance
+        original_size = job.original_size
 
-            if log.isEnabledFor(logging.INFO):
-                log.info("Stored data for data_id=[{}] as [{}.blk]."\
-                    .format(mbase32.encode(data_id), data_block_id))
+        old_entry = None
+        if dmsg.pubkey:
+            old_entry = sess.query(DataBlock)\
+                .filter(DataBlock.data_id == data_id)\
+                .first()
+            if old_entry:
+                vint = int(old_entry.version)
+                if vint >= dmsg.version:
+                    # We only want to store newer versions.
+                    return None
+        else:
+            q = sess.query(func.count("*")).select_from(DataBlock)
+            q = q.filter(DataBlock.data_id == data_id)
 
-            return True
-        except Exception as e:
-            log.exception("encrypt/write_to_disk")
+            if q.scalar() > 0:
+                # We already have this block.
+                return None
 
-            log.warning("There was an exception attempting to store the data"\
-                " on disk.")
+        if job.need_pruning:
+            blocks_to_prune, freeable_space =\
+                self.engine.node.distance_index.select_prunable(\
+                    distance, original_size, exclude)
 
-            def dbcall():
-                with self.engine.node.db.open_session() as sess:
-                    self.engine.node.db.lock_table(sess, DataBlock)
+            if freeable_space < original_size:
+                job.data_block_id = False
+                return None
 
-                    sess.query(DataBlock)\
-                        .filter(DataBlock.id == data_block_id)\
-                        .delete(synchronize_session=False)
+            if log.isEnabledFor(logging.INFO):
+                log.info("Pruning {} blocks to make room."\
+                    .format(len(blocks_to_prune)))
+
+            q = sess.query(DataBlock.data_id)\
+                .filter(DataBlock.id.in_(blocks_to_prune))
+            pruned_data_ids = [block.data_id for block in q]
+
+            for anid in blocks_to_prune:
+                sess.query(DataBlock)\
+                    .filter(DataBlock.id == anid)\
+                    .delete(synchronize_session=False)
+
+                entry = DataBlockJournal()
+                entry.data_block_id = anid
+                entry.storing = False
+                sess.add(entry)
+                prune_entries.append(entry)
+
+            job.pruned_block_ids = blocks_to_prune
+            job.pruned_data_ids = pruned_data_ids
+
+        updateable_size_diff = None
+        if old_entry:
+            data_block = old_entry
+            assert data_block.data_id == data_id
+            updateable_size_diff = original_size - data_block.original_size
+        else:
+            data_block = DataBlock()
+            data_block.data_id = data_id
+            data_block.distance = distance
 
-                    # Rule: only update this NodeState row when holding a lock
-                    # on the DataBlock table.
-                    node_state = sess.query(NodeState)\
-                        .filter(NodeState.key == mnnode.NSK_DATASTORE_SIZE)\
-                        .first()
+        if dmsg.pubkey:
+            data_block.version = str(dmsg.version)
+            data_block.signature = dmsg.signature
+            data_block.epubkey = job.epubkey
+            data_block.pubkeylen = len(dmsg.pubkey)
 
-                    node_state.value =\
-                        str(int(node_state.value) - original_size)
+        if job.target_key:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Storing TargetedBlock (target_key=[{}])."\
+                    .format(mbase32.encode(job.target_key)))
+            # We don't need the following for anything coded yet, but
+            # doing it for now because then we can tell which are
+            # targeted blocks as we may want to have code purge them
+            # with more pressure than normal blocks.
+            data_block.target_key = job.target_key
+
+        data_block.original_size = original_size
+        data_block.insert_timestamp = mutil.utc_datetime()
+
+        if not old_entry:
+            sess.add(data_block)
+            sess.flush() # Assign data_block.id.
+
+        journal_entry = DataBlockJournal()
+        journal_entry.data_block_id = data_block.id
+        journal_entry.storing = True
+        sess.add(journal_entry)
+
+        if updateable_size_diff is not None:
+            size_diff = updateable_size_diff
+        else:
+            size_diff = original_size
 
-                    sess.commit()
+        if job.need_pruning:
+            size_diff -= freeable_space
 
-            yield from self.loop.run_in_executor(None, dbcall)
+        job.data_block_id = data_block.id
+        job.size_diff = size_diff
 
-            self.engine.node.datastore_size -= original_size
+        return journal_entry
 
-            def iocall():
-                os.remove(self.engine.node.data_block_file_path\
-                    .format(self.engine.node.instance, data_block_id))
+    def _check_compact_data_store(self):
+        if self._compacting_data_store\
+                or not self.engine.node.data_store.wants_compaction():
+            return
 
-            try:
-                yield from self.loop.run_in_executor(None, iocall)
-            except Exception:
-                log.exception("os.remove(..)")
-                pass
+        self._compacting_data_store = True
 
-            return False
+        asyncio.async(self._compact_data_store(), loop=self.loop)
+
+    @asyncio.coroutine
+    def _compact_data_store(self):
+        data_store = self.engine.node.data_store
+
+        try:
+            while (yield from\
+                    self.loop.run_in_executor(None, data_store.compact)):
+                pass
+        except Exception:
+            log.exception("data_store.compact()")
+        finally:
+            self._compacting_data_store = False
 
     def _check_store_targeted_block(self, data):
         tb = mp.TargetedBlock(data)
@@ -0,0 +1,549 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+import llog
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+
+FORMAT_FILES = "files"
+FORMAT_SEGMENTS = "segments"
+
+BLOCK_FILE_SUFFIX = ".blk"
+SEGMENT_FILE_SUFFIX = ".seg"
+SEGMENT_MAGIC = b"MSEG0001"
+
+# Once the active segment has grown past this, a new one is started.
+SEGMENT_SIZE = 64 << 20
+# A sealed segment is compacted once at least this fraction of it is space
+# that compacting would free.
+COMPACT_RATIO = 0.5
+# Anything bigger is a corrupt header; blocks are far smaller.
+MAX_RECORD_LENGTH = 1 << 24
+
+# block_id, flags, length, crc32 of the data that follows.
+RECORD_HEADER = struct.Struct(">QBII")
+RECORD_DELETED = 0x01
+
+class FileDataStore(object):
+    "The original layout; one file per block, named after its DataBlock id."\
+    " The methods block, so call them through run_in_executor(..)."
+
+    def __init__(self, path):
+        self.path = path
+        self.file_path = path + "/{}" + BLOCK_FILE_SUFFIX
+
+    def get(self, block_id):
+        "Returns the stored data, or None if there is none."
+        try:
+            with open(self.file_path.format(block_id), "rb") as data_file:
+                return data_file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, block_id, datas):
+        "Stores the concatenation of datas, replacing any previous data."
+        with open(self.file_path.format(block_id), "wb") as new_file:
+            for data in datas:
+                new_file.write(data)
+
+    def remove(self, block_id):
+        "Returns False if there was nothing stored for block_id."
+        try:
+            os.remove(self.file_path.format(block_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def wants_compaction(self):
+        return False
+
+    def compact(self):
+        return False
+
+    def close(self):
+        pass
+
+class Segment(object):
+    __slots__ = ("number", "filename", "size", "end", "live", "tombstones",\
+        "mmap")
+
+    def __init__(self, number, filename):
+        self.number = number
+        self.filename = filename
+        self.size = 0
+        # End of the valid records; only short of size if corrupt.
+        self.end = 0
+        # Bytes (headers included) of records that the index points to.
+        self.live = 0
+        # Bytes of deletion records, which may still be needed to hide an
+        # older record of the same block.
+        self.tombstones = 0
+        self.mmap = None
+
+    def unmap(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+class SegmentDataStore(object):
+    "Blocks appended to a few large segment files, instead of a file each."\
+    " An in memory index maps each block to its offset; it is rebuilt by"\
+    " scanning the segments when opened. Removing a block appends a"\
+    " deletion record, and compact(..) later rewrites the live blocks of"\
+    " mostly dead segments so that they can be deleted. Reads go through"\
+    " mmap. The methods block, so call them through run_in_executor(..);"\
+    " they are thread safe."
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+
+        self._lock = threading.Lock()
+        self._segments = {} # {number: Segment}
+        self._index = {} # {block_id: (segment_number, offset, length)}
+        self._active = None
+        self._active_file = None
+
+        self._open()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _segment_filename(self, number):
+        return os.path.join(\
+            self.path, "{:08d}{}".format(number, SEGMENT_FILE_SUFFIX))
+
+    def _open(self):
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.endswith(SEGMENT_FILE_SUFFIX):
+                numbers.append(int(name[:-len(SEGMENT_FILE_SUFFIX)]))
+        numbers.sort()
+
+        valid = False
+        for number in numbers:
+            segment = Segment(number, self._segment_filename(number))
+            self._segments[number] = segment
+            valid = self._scan(segment, number == numbers[-1])
+
+        if valid:
+            self._active = self._segments[numbers[-1]]
+            self._active_file = open(self._active.filename, "r+b", 0)
+            self._active_file.seek(self._active.size)
+        else:
+            self._new_segment()
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Opened [{}] segments holding [{}] blocks in [{}]."\
+                .format(len(self._segments), len(self._index), self.path))
+
+    def _scan(self, segment, last):
+        "Adds the records of segment to the index, truncating a partially"\
+        " written one at the end of the last segment. Returns False if the"\
+        " segment is not one, in which case it is left for compact(..) to"\
+        " delete."
+
+        size = os.path.getsize(segment.filename)
+
+        if size < len(SEGMENT_MAGIC):
+            mm = None
+        else:
+            with open(segment.filename, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm is None or mm[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            log.warning("Segment [{}] has no valid header; ignoring it."\
+                .format(segment.filename))
+            if mm is not None:
+                mm.close()
+            segment.size = max(size, 1)
+            segment.end = len(SEGMENT_MAGIC)
+            return False
+
+        header_size = RECORD_HEADER.size
+        index = self._index
+        segments = self._segments
+
+        offset = len(SEGMENT_MAGIC)
+        while offset + header_size <= size:
+            block_id, flags, length, crc =\
+                RECORD_HEADER.unpack_from(mm, offset)
+
+            end = offset + header_size + length
+            if flags & ~RECORD_DELETED or length > MAX_RECORD_LENGTH\
+                    or end > size:
+                break
+
+            old = index.pop(block_id, None)
+            if old:
+                segments[old[0]].live -= header_size + old[2]
+
+            if flags & RECORD_DELETED:
+                segment.tombstones += header_size
+            else:
+                index[block_id] =\
+                    (segment.number, offset + header_size, length)
+                segment.live += header_size + length
+
+            offset = end
+
+        mm.close()
+
+        if offset != size:
+            if last:
+                log.warning("Truncating partially written record at [{}]"\
+                    " of segment [{}]."\
+                        .format(offset, segment.filename))
+                with open(segment.filename, "r+b") as f:
+                    f.truncate(offset)
+                size = offset
+            else:
+                log.warning("Segment [{}] is corrupt after [{}]; the rest"\
+                    " of it is ignored."\
+                        .format(segment.filename, offset))
+
+        segment.size = size
+        segment.end = offset
+
+        return True
+
+    def _new_segment(self):
+        number = max(self._segments) + 1 if self._segments else 0
+
+        segment = Segment(number, self._segment_filename(number))
+
+        if self._active_file:
+            # Sealed segments may hold blocks compact(..) moved there.
+            os.fsync(self._active_file.fileno())
+            self._active_file.close()
+
+        self._active_file = open(segment.filename, "w+b", 0)
+        self._active_file.write(SEGMENT_MAGIC)
+        segment.size = segment.end = len(SEGMENT_MAGIC)
+
+        self._segments[number] = segment
+        self._active = segment
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Started segment [{}].".format(segment.filename))
+
+    def _map(self, segment, end):
+        "Returns an mmap of segment covering at least upto end."
+
+        mm = segment.mmap
+        if mm is None or len(mm) < end:
+            segment.unmap()
+            with open(segment.filename, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            segment.mmap = mm
+
+        return mm
+
+    def _append(self, block_id, flags, datas, length, crc):
+        "Returns the segment and offset the data was written at."
+
+        if self._active.size >= self.segment_size:
+            self._new_segment()
+
+        segment = self._active
+        offset = segment.size + RECORD_HEADER.size
+
+        f = self._active_file
+        try:
+            f.write(RECORD_HEADER.pack(block_id, flags, length, crc))
+            for data in datas:
+                f.write(data)
+        except Exception:
+            # Don't leave a partial record for the next one to follow.
+            f.seek(segment.size)
+            f.truncate()
+            raise
+
+        segment.size = segment.end = offset + length
+
+        return segment, offset
+
+    def _set(self, block_id, segment, offset, length):
+        old = self._index.get(block_id)
+        if old:
+            self._segments[old[0]].live -= RECORD_HEADER.size + old[2]
+
+        self._index[block_id] = (segment.number, offset, length)
+        segment.live += RECORD_HEADER.size + length
+
+    def get(self, block_id):
+        "Returns the stored data, or None if there is none (or it is"\
+        " corrupt, in which case it is removed)."
+
+        with self._lock:
+            loc = self._index.get(block_id)
+            if loc is None:
+                return None
+
+            number, offset, length = loc
+            mm = self._map(self._segments[number], offset + length)
+
+            crc = RECORD_HEADER.unpack_from(mm, offset - RECORD_HEADER.size)[3]
+            data = mm[offset:offset + length]
+
+        if zlib.crc32(data) == crc:
+            return data
+
+        log.warning("Block id=[{}] failed its checksum; removing it."\
+            .format(block_id))
+
+        with self._lock:
+            # Unless it was replaced (or removed) meanwhile.
+            if self._index.get(block_id) == loc:
+                self._remove(block_id)
+
+        return None
+
+    def put(self, block_id, datas):
+        "Stores the concatenation of datas, replacing any previous data."
+
+        length = 0
+        crc = 0
+        for data in datas:
+            length += len(data)
+            crc = zlib.crc32(data, crc)
+
+        with self._lock:
+            segment, offset = self._append(block_id, 0, datas, length, crc)
+            self._set(block_id, segment, offset, length)
+
+    def remove(self, block_id):
+        "Returns False if there was nothing stored for block_id."
+
+        with self._lock:
+            return self._remove(block_id)
+
+    def _remove(self, block_id):
+        loc = self._index.pop(block_id, None)
+        if loc is None:
+            return False
+
+        self._segments[loc[0]].live -= RECORD_HEADER.size + loc[2]
+
+        segment, offset = self._append(block_id, RECORD_DELETED, (), 0, 0)
+        segment.tombstones += RECORD_HEADER.size
+
+        return True
+
+    def _reclaimable(self, segment, oldest):
+        "Bytes compacting segment would free. Deletion records are only"\
+        " dropped from the oldest segment, as there is no older record left"\
+        " for them to hide."
+        r = segment.size - len(SEGMENT_MAGIC) - segment.live
+        if not oldest:
+            r -= segment.tombstones
+        return r
+
+    def _compaction_candidate(self):
+        oldest = min(self._segments)
+
+        best = None
+        best_ratio = COMPACT_RATIO
+        for number, segment in self._segments.items():
+            if segment is self._active:
+                continue
+            ratio =\
+                self._reclaimable(segment, number == oldest) / segment.size
+            if ratio >= best_ratio:
+                best = segment
+                best_ratio = ratio
+
+        return best
+
+    def wants_compaction(self):
+        with self._lock:
+            return self._compaction_candidate() is not None
+
+    def compact(self):
+        "Rewrites the live blocks of the sealed segment with the most space"\
+        " to free into the active segment, then deletes it. Returns True if"\
+        " a segment was compacted."
+
+        with self._lock:
+            segment = self._compaction_candidate()
+            if segment is None:
+                return False
+
+            oldest = segment.number == min(self._segments)
+
+            records = []
+            offset = len(SEGMENT_MAGIC)
+            if offset < segment.end:
+                mm = self._map(segment, segment.end)
+            while offset < segment.end:
+                block_id, flags, length, crc =\
+                    RECORD_HEADER.unpack_from(mm, offset)
+                offset += RECORD_HEADER.size
+                records.append((block_id, flags, offset, length, crc))
+                offset += length
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Compacting segment [{}] ([{}] of [{}] bytes live)."\
+                .format(segment.filename, segment.live, segment.size))
+
+        moved = 0
+        for block_id, flags, offset, length, crc in records:
+            # Take the lock per record so that reads are not held up.
+            with self._lock:
+                if flags & RECORD_DELETED:
+                    if oldest or block_id in self._index:
+                        # Nothing older to hide, or it was stored again since.
+                        continue
+                    nsegment, noffset =\
+                        self._append(block_id, flags, (), 0, 0)
+                    nsegment.tombstones += RECORD_HEADER.size
+                    continue
+
+                if self._index.get(block_id)\
+                        != (segment.number, offset, length):
+                    # Replaced or removed since.
+                    continue
+
+                data = segment.mmap[offset:offset + length]
+                nsegment, noffset =\
+                    self._append(block_id, 0, (data,), length, crc)
+                self._set(block_id, nsegment, noffset, length)
+                moved += 1
+
+        with self._lock:
+            assert segment.live == 0, segment.live
+            # The moved blocks must be on disk before their only other copy
+            # is deleted.
+            os.fsync(self._active_file.fileno())
+            del self._segments[segment.number]
+            segment.unmap()
+            os.remove(segment.filename)
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Compacted segment [{}]; moved [{}] blocks."\
+                .format(segment.filename, moved))
+
+        return True
+
+    def import_block_files(self):
+        "Moves the blocks of a FileDataStore in the same directory into this"\
+        " one. Returns how many there were. Safe to rerun if interrupted."
+
+        cnt = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(BLOCK_FILE_SUFFIX):
+                continue
+
+            block_id = int(name[:-len(BLOCK_FILE_SUFFIX)])
+            filename = os.path.join(self.path, name)
+
+            with open(filename, "rb") as data_file:
+                data = data_file.read()
+
+            self.put(block_id, (data,))
+            os.remove(filename)
+
+            cnt += 1
+
+        return cnt
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.unmap()
+
+            if self._active_file:
+                self._active_file.close()
+                self._active_file = None
+
+def has_segments(path):
+    return any(name.endswith(SEGMENT_FILE_SUFFIX) for name in os.listdir(path))
+
+import random
+import shutil
+import tempfile
+
+def _segment_test(cycles=20000, keyspace=500):
+    print("segments..")
+
+    path = tempfile.mkdtemp()
+    try:
+        # Small segments so that there are many to roll over and compact.
+        store = SegmentDataStore(path, 64 << 10)
+        ref = {}
+
+        for i in range(cycles):
+            block_id = random.randrange(keyspace)
+            r = random.random()
+
+            if r < 0.5:
+                data = os.urandom(random.randrange(1, 4096))
+                store.put(block_id, (data[:10], data[10:]))
+                ref[block_id] = data
+            elif r < 0.8:
+                assert store.remove(block_id) == (ref.pop(block_id, None)\
+                    is not None)
+            else:
+                assert store.get(block_id) == ref.get(block_id)
+
+            if not i % 1000:
+                while store.compact():
+                    pass
+
+            if not i % 5000:
+                store.close()
+                store = SegmentDataStore(path, 64 << 10)
+
+        for block_id in range(keyspace):
+            assert store.get(block_id) == ref.get(block_id)
+
+        assert len(store) == len(ref)
+
+        while store.compact():
+            pass
+        live = sum(len(data) + RECORD_HEADER.size for data in ref.values())
+        total = sum(os.path.getsize(os.path.join(path, name))\
+            for name in os.listdir(path))
+        assert total < live * 2 + 2 * store.segment_size, (total, live)
+
+        # A torn write at the end is dropped on reopen.
+        store.close()
+        last = max(os.listdir(path))
+        with open(os.path.join(path, last), "ab") as f:
+            f.write(RECORD_HEADER.pack(keyspace, 0, 100, 0) + b"x" * 10)
+
+        store = SegmentDataStore(path, 64 << 10)
+        assert store.get(keyspace) is None
+        for block_id in range(keyspace):
+            assert store.get(block_id) == ref.get(block_id)
+
+        # Migrate from block files.
+        for block_id in range(keyspace, keyspace + 10):
+            data = os.urandom(100)
+            with open(os.path.join(path, "{}.blk".format(block_id)), "wb")\
+                    as f:
+                f.write(data)
+            ref[block_id] = data
+
+        assert store.import_block_files() == 10
+        for block_id, data in ref.items():
+            assert store.get(block_id) == data
+
+        store.close()
+    finally:
+        shutil.rmtree(path)
+
+    print("segments ok.")
+
+def main():
+    _segment_test()
+
+if __name__ == "__main__":
+    main()
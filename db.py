@@ -22,12 +22,13 @@ import mutil
 
 log = logging.getLogger(__name__)
 
-LATEST_SCHEMA_VERSION = 4
+LATEST_SCHEMA_VERSION = 5
 
 Base = declarative_base()
 
 Peer = None
 DataBlock = None
+DataBlockJournal = None
 NodeState = None
 DmailAddress = None
 DmailKey = None
@@ -96,6 +97,18 @@ def _init_daos(Base, d):
 
     d.DataBlock = DataBlock
 
+    class DataBlockJournal(Base):
+        __tablename__ = "datablockjournal"
+
+        # A row exists while the data of a DataBlock is being written
+        # (storing=True) or deleted (storing=False), so that what a crash
+        # interrupted can be cleaned up at startup.
+        id = Column(Integer, primary_key=True)
+        data_block_id = Column(Integer, nullable=False)
+        storing = Column(Boolean, nullable=False)
+
+    d.DataBlockJournal = DataBlockJournal
+
     class NodeState(Base):
         __tablename__ = "nodestate"
 
@@ -332,6 +345,10 @@ class Db():
 
         if version == 3:
             _upgrade_3_to_4(self)
+            version = 4
+
+        if version == 4:
+            _upgrade_4_to_5(self)
             version = LATEST_SCHEMA_VERSION
 
     def _create_schema(self):
@@ -363,6 +380,7 @@ if Peer is None:
 
     Peer = d.Peer
     DataBlock = d.DataBlock
+    DataBlockJournal = d.DataBlockJournal
     NodeState = d.NodeState
 
     # Maalstroom Dmail Client.
@@ -469,3 +487,24 @@ def _upgrade_3_to_4(db):
         sess.commit()
 
     log.warning("NOTE: Database schema upgraded.")
+
+def _upgrade_4_to_5(db):
+    log.warning("NOTE: Upgrading database schema from version 4 to 5.")
+
+    t_serial = "INTEGER" if db.is_sqlite else "serial"
+    t_integer = "INTEGER" if db.is_sqlite else "integer"
+    t_boolean = "BOOLEAN" if db.is_sqlite else "boolean"
+
+    with db.open_session() as sess:
+        st = "CREATE TABLE datablockjournal (id " + t_serial\
+            + " NOT NULL, data_block_id " + t_integer\
+            + " NOT NULL, storing " + t_boolean\
+            + " NOT NULL, PRIMARY KEY (id))"
+
+        sess.execute(st)
+
+        _update_node_state(sess, 5)
+
+        sess.commit()
+
+    log.warning("NOTE: Database schema upgraded.")
@@ -0,0 +1,226 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+import llog
+
+from bisect import bisect_left, insort
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+class DistanceIndex(object):
+    "The DataBlockS of our data store sorted by distance (from our node_id),"\
+    " so that the furthest ones, which are pruned first, are found without"\
+    " querying the database. Keys (blocks with a size of 0) are included"\
+    " but never pruned. The methods are safe to call from any thread."
+
+    __slots__ = ("_lock", "_keys", "_entries")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = [] # [(distance, block_id)], sorted.
+        self._entries = {} # {block_id: (distance, size)}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, block_id):
+        return block_id in self._entries
+
+    def load(self, rows):
+        "Replace the contents with rows, an iterable of (block_id, distance,"\
+        " size), sorting them once instead of inserting each one."
+
+        entries = {}
+        for block_id, distance, size in rows:
+            entries[block_id] = (bytes(distance), size)
+
+        keys = [(entry[0], block_id) for block_id, entry in entries.items()]
+        keys.sort()
+
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+
+    def add(self, block_id, distance, size):
+        "Add block_id, or update its size if it is already present."
+
+        distance = bytes(distance)
+
+        with self._lock:
+            old = self._entries.get(block_id)
+            if old is not None:
+                if old[0] == distance:
+                    self._entries[block_id] = (distance, size)
+                    return
+                self._remove(block_id, old[0])
+
+            self._entries[block_id] = (distance, size)
+            insort(self._keys, (distance, block_id))
+
+    def remove(self, block_id):
+        "Returns False if block_id was not present."
+
+        with self._lock:
+            old = self._entries.get(block_id)
+            if old is None:
+                return False
+
+            self._remove(block_id, old[0])
+
+            return True
+
+    def _remove(self, block_id, distance):
+        keys = self._keys
+        idx = bisect_left(keys, (distance, block_id))
+        assert keys[idx][1] == block_id
+        del keys[idx]
+        del self._entries[block_id]
+
+    def furthest(self):
+        "Returns the distance of the furthest block, or b\"\" if empty."
+
+        with self._lock:
+            if not self._keys:
+                return b""
+            return self._keys[-1][0]
+
+    def select_prunable(self, distance, needed, exclude=()):
+        "Returns (block_ids, freeable), the furthest blocks that are further"\
+        " than distance, until their sizes add up to needed bytes. freeable"\
+        " is their total size, which is less than needed if there are not"\
+        " enough of them. Blocks in exclude are skipped."
+
+        block_ids = []
+        freeable = 0
+
+        if needed <= 0:
+            return block_ids, freeable
+
+        distance = bytes(distance)
+
+        with self._lock:
+            entries = self._entries
+
+            for key in reversed(self._keys):
+                if key[0] <= distance:
+                    break
+
+                block_id = key[1]
+
+                size = entries[block_id][1]
+                if not size or block_id in exclude:
+                    continue
+
+                block_ids.append(block_id)
+                freeable += size
+
+                if freeable >= needed:
+                    break
+
+        return block_ids, freeable
+
+import os
+import random
+from datetime import datetime
+
+def _validity_test(cycles=100000, keysize=4, keyspace=256):
+    print("validity..")
+
+    di = DistanceIndex()
+    ref = {}
+
+    for i in range(cycles):
+        block_id = random.randrange(keyspace)
+
+        if random.random() < 0.6:
+            distance = os.urandom(keysize)
+            size = random.choice((0, random.randrange(1, 1000)))
+            di.add(block_id, distance, size)
+            ref[block_id] = (distance, size)
+        else:
+            assert di.remove(block_id) == (ref.pop(block_id, None) is not None)
+
+        assert len(di) == len(ref)
+
+        if not i % 1000:
+            expected = sorted(ref, key=lambda x: (ref[x][0], x), reverse=True)
+
+            assert di.furthest()\
+                == (ref[expected[0]][0] if expected else b"")
+
+            distance = os.urandom(keysize)
+            needed = random.randrange(1, 5000)
+            exclude = set(random.sample(sorted(ref), min(len(ref), 10)))
+
+            block_ids = []
+            freeable = 0
+            for block_id in expected:
+                if ref[block_id][0] <= distance:
+                    break
+                size = ref[block_id][1]
+                if not size or block_id in exclude:
+                    continue
+                block_ids.append(block_id)
+                freeable += size
+                if freeable >= needed:
+                    break
+
+            assert di.select_prunable(distance, needed, exclude)\
+                == (block_ids, freeable)
+
+    print("validity ok.")
+
+def _load_test(blocks=1000, keysize=4):
+    print("load..")
+
+    rows = [(block_id, os.urandom(keysize), random.randrange(1000))\
+        for block_id in range(blocks)]
+
+    loaded = DistanceIndex()
+    loaded.load(rows)
+
+    added = DistanceIndex()
+    for row in rows:
+        added.add(*row)
+
+    assert loaded._keys == added._keys
+    assert loaded._entries == added._entries
+
+    print("load ok.")
+
+def _speed_test(blocks=100000, selects=1000):
+    keysize = 512 >> 3
+
+    rows = [(block_id, os.urandom(keysize), random.randrange(1, 32768))\
+        for block_id in range(blocks)]
+
+    now = datetime.today()
+    DistanceIndex().load(rows)
+    took = (datetime.today() - now).total_seconds()
+    print("load: {:.2f}us/block.".format(took / blocks * 1000000))
+
+    di = DistanceIndex()
+
+    now = datetime.today()
+    for block_id in range(blocks):
+        di.add(block_id, os.urandom(keysize), random.randrange(1, 32768))
+    took = (datetime.today() - now).total_seconds()
+    print("add: {:.2f}us/op.".format(took / blocks * 1000000))
+
+    distances = [os.urandom(keysize) for i in range(selects)]
+
+    now = datetime.today()
+    for distance in distances:
+        di.select_prunable(distance, 32768)
+    took = (datetime.today() - now).total_seconds()
+    print("select_prunable: {:.2f}us/op.".format(took / selects * 1000000))
+
+def main():
+    _validity_test()
+    _load_test()
+    _speed_test()
+
+if __name__ == "__main__":
+    main()
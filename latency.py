@@ -0,0 +1,187 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+import llog
+
+from bisect import bisect_left
+import logging
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the LatencyHistogram buckets; the last bucket
+# catches everything slower.
+HISTOGRAM_BOUNDS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 60)
+
+class RttEstimator(object):
+    "Smoothed round trip time and its mean deviation, as TCP keeps them"\
+    " (RFC 6298). Times are in seconds."
+
+    __slots__ = ("srtt", "rttvar", "samples", "initial", "minimum",\
+        "maximum", "_backoff")
+
+    def __init__(self, initial, minimum, maximum):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+        # timeout() until there is a sample, and its bounds.
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+        self._backoff = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+
+        self.samples += 1
+        self._backoff = 0
+
+    def backoff(self):
+        "Double timeout() (up to maximum) until the next sample, as nothing"\
+        " came back in time."
+        if self._timeout() < self.maximum:
+            self._backoff += 1
+
+    def timeout(self):
+        "Time after which the request can be considered lost."
+        return self._clamp(self._timeout())
+
+    def p95(self):
+        "Estimated 95th percentile, ie: when to hedge, or None if there is no"\
+        " sample yet. The mean deviation is about 0.8 standard deviations,"\
+        " so this is about srtt + 1.65 sigma. Unlike timeout(), it is not"\
+        " raised to the minimum."
+        if self.srtt is None:
+            return None
+        return min((self.srtt + 2 * self.rttvar) * (1 << self._backoff),\
+            self.maximum)
+
+    def spread(self, default):
+        "How long after the first of a batch of responses the rest are likely"\
+        " to arrive."
+        if self.srtt is None:
+            return default
+        return min(max(2 * self.rttvar, self.minimum / 10), self.maximum / 10)
+
+    def _timeout(self):
+        if self.srtt is None:
+            return self.initial * (1 << self._backoff)
+        return (self.srtt + 4 * self.rttvar) * (1 << self._backoff)
+
+    def _clamp(self, value):
+        return min(max(value, self.minimum), self.maximum)
+
+    def get_stats(self):
+        return {\
+            "srtt": self.srtt,\
+            "rttvar": self.rttvar,\
+            "samples": self.samples,\
+            "timeout": self.timeout(),\
+            "p95": self.p95()}
+
+class LatencyHistogram(object):
+    "Counts of latencies (in seconds) in the HISTOGRAM_BOUNDS buckets."
+
+    __slots__ = ("counts", "count", "total", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, pct):
+        "Returns the upper bound of the bucket holding the pct percentile, or"\
+        " the maximum if that is the last bucket."
+
+        if not self.count:
+            return None
+
+        rank = self.count * pct / 100
+        seen = 0
+        for i, cnt in enumerate(self.counts):
+            seen += cnt
+            if seen >= rank and cnt:
+                if i == len(HISTOGRAM_BOUNDS):
+                    return self.maximum
+                return min(HISTOGRAM_BOUNDS[i], self.maximum)
+
+        return self.maximum
+
+    def get_stats(self):
+        return {\
+            "count": self.count,\
+            "avg": self.total / self.count if self.count else None,\
+            "max": self.maximum,\
+            "p50": self.percentile(50),\
+            "p95": self.percentile(95),\
+            "p99": self.percentile(99),\
+            "buckets": [[bound, cnt] for bound, cnt\
+                in zip(HISTOGRAM_BOUNDS + (None,), self.counts)]}
+
+import random
+
+def _estimator_test():
+    print("estimator..")
+
+    rtt = RttEstimator(1.0, 0.1, 10)
+    assert rtt.timeout() == 1.0 and rtt.p95() is None
+
+    rtt.backoff()
+    assert rtt.timeout() == 2.0
+
+    for i in range(1000):
+        rtt.sample(random.gauss(0.5, 0.05))
+
+    assert 0.45 < rtt.srtt < 0.55, rtt.srtt
+    assert rtt.srtt < rtt.p95() < rtt.timeout() < 1.0
+
+    for i in range(10):
+        rtt.backoff()
+    assert rtt.timeout() == 10
+
+    rtt.sample(0.5)
+    assert rtt.timeout() < 10
+
+    print("estimator ok.")
+
+def _histogram_test():
+    print("histogram..")
+
+    hist = LatencyHistogram()
+    assert hist.percentile(50) is None
+
+    for i in range(1, 101):
+        hist.add(i / 100)
+
+    assert hist.count == 100
+    assert sum(hist.counts) == 100
+    assert hist.percentile(50) == 0.5, hist.percentile(50)
+    assert hist.percentile(95) == 1, hist.percentile(95)
+    assert hist.percentile(100) == 1
+
+    hist.add(100)
+    assert hist.counts[-1] == 1
+    assert hist.percentile(100) == 100
+
+    print("histogram ok.")
+
+def main():
+    _estimator_test()
+    _histogram_test()
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,8 @@ client_engine = None
 
 dmail_enabled = True
 upload_enabled = True
+# Exposes the addresses of our PeerS, so off unless asked for.
+stats_enabled = False
 
 proxy_url = None
 
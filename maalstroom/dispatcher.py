@@ -4,6 +4,7 @@ import asyncio
 import cgi
 import importlib
 import io
+import json
 import logging
 from threading import Event
 import time
@@ -210,6 +211,16 @@ class MaalstroomDispatcher(object):
         elif rpath.startswith(".dmail") and maalstroom.dmail_enabled:
             yield from maalstroom.dmail.serve_get(self, rpath)
             return
+        elif rpath == ".stats" and maalstroom.stats_enabled:
+            stats = self.node.chord_engine.get_transport_stats()
+            self.send_content(json.dumps(stats).encode(),\
+                content_type="application/json")
+            return
+        elif rpath == ".stats/lookups" and maalstroom.stats_enabled:
+            stats = self.node.chord_engine.tasks.get_lookup_stats()
+            self.send_content(json.dumps(stats).encode(),\
+                content_type="application/json")
+            return
         else:
             self.send_error(errcode=400)
 
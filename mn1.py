@@ -4,10 +4,13 @@
 import llog
 
 import asyncio
+from collections import deque, OrderedDict
 from enum import Enum
 import struct
 import logging
 import os
+import time
+import zlib
 
 from Crypto.Cipher import AES
 from hashlib import sha1
@@ -23,6 +26,66 @@ from mutil import hex_dump
 
 MAX_PACKET_LENGTH = 35000
 
+RECEIVE_BUFFER_INITIAL_SIZE = 65536
+
+CIPHER_AES256_CBC = "aes256-cbc"
+CIPHER_AES256_GCM = "aes256-gcm@openssh.com"
+
+GCM_TAG_SIZE = 16
+
+# Compressed payloads start with a flag byte saying whether that packet is
+# deflated; each packet is compressed on its own.
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib@mnet"
+
+COMPRESSION_LEVEL = 6
+# Payloads smaller than this are not worth compressing.
+COMPRESSION_THRESHOLD = 256
+# Larger payloads are only compressed if a sample of this size from their end
+# shrinks by at least COMPRESSION_MIN_SAVING; that skips encrypted blocks.
+COMPRESSION_SAMPLE_SIZE = 1024
+COMPRESSION_MIN_SAVING = 0.1
+
+KEX_REKEY_EXTENSION = "rekey@mnet"
+KEX_RESUME_EXTENSION = "resume@mnet"
+KEX_FLOW_CONTROL_EXTENSION = "flowcontrol@mnet"
+
+# Receive window advertised for each channel; the peer is sent a
+# WINDOW_ADJUST each time half of it has been consumed.
+CHANNEL_WINDOW_SIZE = 2 * 1024 * 1024
+CHANNEL_MAXIMUM_PACKET_SIZE = 65535
+
+# Reading from the transport is paused while more than this many bytes of
+# channel data sit unread in channel queues, and resumed once it drops below
+# the low water mark.
+CHANNEL_QUEUE_HIGH_WATER = 4 * 1024 * 1024
+CHANNEL_QUEUE_LOW_WATER = 1024 * 1024
+
+# Outbound priority classes. Transport messages (key exchange, window
+# adjusts, channel open replies) are always control and are never queued;
+# channel traffic is routing unless the channel is set to data.
+PRIORITY_CONTROL = 0
+PRIORITY_ROUTING = 1
+PRIORITY_DATA = 2
+
+# Deficit round robin quantum used between the channels of a class; as large
+# as a packet so one round always lets the channel at the front send.
+SCHEDULER_QUANTUM = MAX_PACKET_LENGTH
+
+# Scheduled packets are handed to the transport in chunks of about this size,
+# so that the transport's own flow control stops us while only this much
+# is ahead of a newly queued higher priority packet.
+WRITE_CHUNK_SIZE = 64 * 1024
+
+RESUMPTION_TICKET_LIFETIME = 60 * 60
+MAX_RESUMPTION_TICKETS = 4096
+
+# Packets allowed to be sent while a key re-exchange is in progress.
+KEX_PACKET_TYPES = (\
+    mnetpacket.SSH_MSG_DISCONNECT, mnetpacket.SSH_MSG_IGNORE,\
+    mnetpacket.SSH_MSG_KEXINIT, mnetpacket.SSH_MSG_NEWKEYS,\
+    mnetpacket.SSH_MSG_KEXDH_INIT, mnetpacket.SSH_MSG_KEXDH_REPLY)
+
 log = logging.getLogger(__name__)
 
 server_key = None
@@ -30,10 +93,442 @@ client_key = None
 
 cleartext_transport_enabled = False
 
+# In order of preference; see enable_compression().
+compressions = [COMPRESSION_NONE, COMPRESSION_ZLIB]
+
+# Protocols created while this is set collect ConnectionMetrics.
+metrics_enabled = False
+
+# Keys are re-exchanged after this many bytes have been sent or received, or
+# once this many seconds have passed, whichever comes first.
+rekey_bytes_limit = 1 << 30
+rekey_time_limit = 60 * 60
+
 def enable_cleartext_transport():
     global cleartext_transport_enabled
     cleartext_transport_enabled = True
 
+def enable_compression():
+    "Prefer compression for the connections we open."
+    global compressions
+    compressions = [COMPRESSION_ZLIB, COMPRESSION_NONE]
+
+def enable_metrics():
+    global metrics_enabled
+    metrics_enabled = True
+
+def _compress(datas):
+    "Returns the datas of a payload for a zlib@mnet connection."
+    length = 0
+    for data in datas:
+        length += len(data)
+
+    if length < COMPRESSION_THRESHOLD:
+        return (b"\x00",) + tuple(datas)
+
+    payload = b"".join(datas)
+
+    if length > COMPRESSION_SAMPLE_SIZE:
+        sample = payload[-COMPRESSION_SAMPLE_SIZE:]
+        if len(zlib.compress(sample, 1))\
+                > COMPRESSION_SAMPLE_SIZE * (1 - COMPRESSION_MIN_SAVING):
+            return (b"\x00", payload)
+
+    cpayload = zlib.compress(payload, COMPRESSION_LEVEL)
+    if len(cpayload) >= length:
+        return (b"\x00", payload)
+
+    return (b"\x01", cpayload)
+
+def _decompress(payload):
+    flag = payload[0]
+
+    if flag == 0:
+        return payload[1:]
+    if flag != 1:
+        raise SshException("Invalid compression flag [{}].".format(flag))
+
+    d = zlib.decompressobj()
+    try:
+        r = d.decompress(memoryview(payload)[1:], MAX_PACKET_LENGTH)
+    except zlib.error as e:
+        raise SshException("Invalid compressed payload: {}".format(e))
+
+    if not d.eof or d.unconsumed_tail:
+        raise SshException("Compressed payload too large or truncated.")
+
+    return r
+
+def _check_cipher_output_support():
+    "Newer Crypto libraries can decrypt into a caller supplied buffer."
+    try:
+        cipher = AES.new(bytes(32), AES.MODE_CBC, bytes(16))
+        cipher.decrypt(bytes(16), output=bytearray(16))
+        return True
+    except TypeError:
+        return False
+
+cipher_output_supported = _check_cipher_output_support()
+
+# Ciphers we offer in order of preference. The AEAD cipher needs a Crypto
+# library with GCM support (pycryptodome); CBC+HMAC is always available so
+# that we can still talk to older peers.
+if hasattr(AES, "MODE_GCM"):
+    ciphers = [CIPHER_AES256_GCM, CIPHER_AES256_CBC]
+else:
+    ciphers = [CIPHER_AES256_CBC]
+
+def negotiate_algorithm(client_list, server_list):
+    "Returns the first algorithm of the client's list the server supports."
+    server_algs = server_list.split(',')
+    for alg in client_list.split(','):
+        if alg in server_algs:
+            return alg
+
+    return None
+
+class AesGcmCipher(object):
+    """aes256-gcm@openssh.com (RFC 5647) packet cipher. Encryption and
+        authentication are done in one pass; the packet_length field is
+        authenticated but not encrypted."""
+
+    def __init__(self, key, iv):
+        self.key = key
+        self.fixed_iv = iv[:4]
+        self.invocation_counter = int.from_bytes(iv[4:12], "big")
+
+    def _new_cipher(self, aad):
+        nonce = self.fixed_iv + self.invocation_counter.to_bytes(8, "big")
+        self.invocation_counter =\
+            (self.invocation_counter + 1) & 0xFFFFFFFFFFFFFFFF
+
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(aad)
+
+        return cipher
+
+    def encrypt(self, aad, data):
+        "Returns (ciphertext, tag)."
+        return self._new_cipher(aad).encrypt_and_digest(data)
+
+    def decrypt_into(self, aad, src, dst, tag):
+        "Returns False if the tag does not authenticate the packet."
+        cipher = self._new_cipher(aad)
+
+        if cipher_output_supported:
+            cipher.decrypt(src, output=dst)
+        else:
+            dst[:] = cipher.decrypt(src.tobytes())
+
+        try:
+            cipher.verify(tag)
+        except ValueError:
+            return False
+
+        return True
+
+class ReceiveBuffer(object):
+    """Growable byte buffer that is consumed from the front by advancing an
+        offset instead of reslicing the remaining data. Unconsumed data is
+        only moved to the front when the end of the storage is reached, and
+        the storage is grown so that such moves are amortized O(1) per
+        byte."""
+
+    def __init__(self, size=RECEIVE_BUFFER_INITIAL_SIZE):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def append(self, data):
+        dlen = len(data)
+        if not dlen:
+            return
+
+        if self._end + dlen > len(self._buf):
+            self._make_room(dlen)
+
+        self._buf[self._end:self._end + dlen] = data
+        self._end += dlen
+
+    def view(self, start=0, end=None):
+        "Returns a memoryview of the unconsumed data without copying."
+        if end is None:
+            end = self._end
+        else:
+            end += self._start
+            assert end <= self._end
+
+        return memoryview(self._buf)[self._start + start:end]
+
+    def consume(self, length):
+        assert length <= self._end - self._start
+
+        self._start += length
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def clear(self):
+        self._start = self._end = 0
+
+    def _make_room(self, dlen):
+        used = self._end - self._start
+        needed = used + dlen
+
+        if needed << 1 <= len(self._buf):
+            # Plenty of room; just move the unconsumed data to the front.
+            # Slice assignment of the same length never resizes, so this is
+            # safe even if memoryviews of the storage are still alive.
+            self._buf[:used] = self._buf[self._start:self._end]
+        else:
+            # Replace rather than resize the storage, as outstanding
+            # memoryviews prevent resizing a bytearray.
+            nbuf = bytearray(max(len(self._buf) << 1, needed << 1))
+            nbuf[:used] = memoryview(self._buf)[self._start:self._end]
+            self._buf = nbuf
+
+        self._start = 0
+        self._end = used
+
+class ResumptionTicket(object):
+    def __init__(self):
+        self.ticket_id = None
+        self.secret = None
+        self.peer_key = None # Public key (bytes) of the other end.
+        self.cipher_client_to_server = None
+        self.cipher_server_to_client = None
+        self.compression_client_to_server = None
+        self.compression_server_to_client = None
+        self.expires = None
+
+class ResumptionTickets(object):
+    """Tickets that let a dropped connection be resumed without a new key
+        exchange or authentication. Servers look their tickets up by
+        ticket_id, clients by the server's public key. Tickets are single
+        use. Keys are converted to bytes, as the ids and keys are usually
+        (unhashable) bytearrayS."""
+
+    def __init__(self, max_tickets=MAX_RESUMPTION_TICKETS):
+        self.max_tickets = max_tickets
+
+        self._server_tickets = OrderedDict() # {ticket_id: ResumptionTicket}
+        self._client_tickets = OrderedDict() # {server key: ResumptionTicket}
+
+    def add_server_ticket(self, ticket):
+        self._add(self._server_tickets, ticket.ticket_id, ticket)
+
+    def add_client_ticket(self, ticket):
+        self._add(self._client_tickets, ticket.peer_key, ticket)
+
+    def remove_server_ticket(self, ticket_id):
+        self._server_tickets.pop(bytes(ticket_id), None)
+
+    def take_server_ticket(self, ticket_id):
+        return self._take(self._server_tickets, ticket_id)
+
+    def take_client_ticket(self, server_key):
+        return self._take(self._client_tickets, server_key)
+
+    def _add(self, tickets, key, ticket):
+        key = bytes(key)
+        tickets.pop(key, None)
+        tickets[key] = ticket
+
+        while len(tickets) > self.max_tickets:
+            tickets.popitem(last=False)
+
+    def _take(self, tickets, key):
+        ticket = tickets.pop(bytes(key), None)
+
+        if ticket and ticket.expires < time.time():
+            return None
+
+        return ticket
+
+class ChannelWindow(object):
+    "Send side flow control state of a channel."
+
+    def __init__(self, send_window=0):
+        self.send_window = send_window
+        # Data written while the window was exhausted, in order.
+        self.pending = deque()
+        self.drain_waiters = []
+        # Bytes of received data consumed since our last WINDOW_ADJUST.
+        self.consumed = 0
+        # Only counted when metrics are enabled.
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def blocked(self):
+        return bool(self.pending) or self.send_window <= 0
+
+    def wake_waiters(self, result=True):
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(result)
+        self.drain_waiters.clear()
+
+class ChannelQueue(asyncio.Queue):
+    """Channel queue that reports the data taken out of it to the protocol so
+        that the peer's window is only reopened as the data is consumed."""
+
+    def __init__(self, protocol, local_cid):
+        super().__init__()
+
+        self.protocol = protocol
+        self.local_cid = local_cid
+        self.queued_bytes = 0
+
+    def detach(self):
+        "Stops accounting, ie: once the channel is closed."
+        if self.protocol:
+            self.protocol._channel_data_dequeued(self.queued_bytes)
+            self.protocol = None
+        self.queued_bytes = 0
+
+    def _put(self, item):
+        super()._put(item)
+
+        if type(item) is bytes and self.protocol:
+            self.queued_bytes += len(item)
+            self.protocol._channel_data_queued(len(item))
+
+    def _get(self):
+        item = super()._get()
+
+        if type(item) is bytes and self.protocol:
+            self.queued_bytes -= len(item)
+            self.protocol._channel_data_dequeued(len(item))
+            self.protocol._channel_data_consumed(self.local_cid, len(item))
+
+        return item
+
+class ConnectionMetrics(object):
+    """Transport counters of a connection. Times are in seconds; the
+        processing time includes the time spent in the handlers."""
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.packets_in = 0
+        self.packets_out = 0
+        self.encrypt_time = 0.0
+        self.decrypt_time = 0.0
+        self.processing_time = 0.0
+        # An explicit channel is open when confirmed, an implicit one when
+        # the first reply arrives; both are about one round trip.
+        self.channels_opened = 0
+        self.channel_open_time = 0.0
+        self.channel_open_max = 0.0
+        self.channel_open_starts = {} # {local_cid, time}
+
+    def channel_open_started(self, local_cid):
+        self.channel_open_starts[local_cid] = time.perf_counter()
+
+    def channel_open_done(self, local_cid):
+        start = self.channel_open_starts.pop(local_cid, None)
+        if start is None:
+            return
+
+        latency = time.perf_counter() - start
+
+        self.channels_opened += 1
+        self.channel_open_time += latency
+        if latency > self.channel_open_max:
+            self.channel_open_max = latency
+
+    def to_dict(self):
+        return {\
+            "bytes_in": self.bytes_in,\
+            "bytes_out": self.bytes_out,\
+            "packets_in": self.packets_in,\
+            "packets_out": self.packets_out,\
+            "encrypt_time": self.encrypt_time,\
+            "decrypt_time": self.decrypt_time,\
+            "processing_time": self.processing_time,\
+            "channels_opened": self.channels_opened,\
+            "channel_open_latency_avg":\
+                self.channel_open_time / self.channels_opened\
+                    if self.channels_opened else None,\
+            "channel_open_latency_max": self.channel_open_max}
+
+class ScheduledChannel(object):
+    def __init__(self, priority):
+        self.priority = priority
+        self.packets = deque() # (size, datas)
+        self.deficit = 0
+
+class OutboundScheduler(object):
+    """Holds channel packets waiting to be written. Classes are served in
+        strict priority order, and the channels within a class by deficit
+        round robin so that each gets an equal share of the bytes. Packets
+        of a channel always stay in the order they were pushed."""
+
+    def __init__(self, quantum=SCHEDULER_QUANTUM):
+        self.quantum = quantum
+        self._classes = [OrderedDict() for _ in range(PRIORITY_DATA + 1)]
+        self._channels = {} # {local_cid, ScheduledChannel}
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def push(self, local_cid, priority, datas):
+        entry = self._channels.get(local_cid)
+        if entry is None:
+            entry = ScheduledChannel(priority)
+            self._channels[local_cid] = entry
+            self._classes[priority][local_cid] = entry
+
+        size = 0
+        for data in datas:
+            size += len(data)
+
+        entry.packets.append((size, datas))
+        self._length += 1
+
+    def pop(self):
+        "Returns the datas of the next packet to write, or None."
+        for channels in self._classes:
+            if channels:
+                break
+        else:
+            return None
+
+        while True:
+            local_cid, entry = next(iter(channels.items()))
+
+            size, datas = entry.packets[0]
+            if size <= entry.deficit:
+                break
+
+            entry.deficit += self.quantum
+            channels.move_to_end(local_cid)
+
+        entry.packets.popleft()
+        entry.deficit -= size
+        self._length -= 1
+
+        if not entry.packets:
+            del channels[local_cid]
+            del self._channels[local_cid]
+
+        return datas
+
+    def set_priority(self, local_cid, priority):
+        "Moves the packets already queued for the channel as well."
+        entry = self._channels.get(local_cid)
+        if entry is None or entry.priority == priority:
+            return
+
+        del self._classes[entry.priority][local_cid]
+        entry.priority = priority
+        self._classes[priority][local_cid] = entry
+
 class Status(Enum):
     new = 0
     ready = 10
@@ -55,12 +550,17 @@ class SshProtocol(asyncio.Protocol):
 
         self._next_channel_id = 0
         self.channel_queues = {}
+        self._channel_windows = {} # {local_cid, ChannelWindow}
+        self._queued_bytes = 0
+        self._reading_paused = False
 
         self.channel_handler = None
         self.connection_handler = None
 
         self.server_mode = None
 
+        self.metrics = ConnectionMetrics() if metrics_enabled else None
+
         self.binaryMode = False
         self.inboundEnabled = True
 
@@ -73,17 +573,53 @@ class SshProtocol(asyncio.Protocol):
         self.session_id = None
         self.inCipher = None
         self.outCipher = None
+        self.inCipherName = CIPHER_AES256_CBC
+        self.outCipherName = CIPHER_AES256_CBC
+        self.inAead = False
+        self.outAead = False
+        self.inCompressionName = COMPRESSION_NONE
+        self.outCompressionName = COMPRESSION_NONE
+        self.inCompression = False
+        self.outCompression = False
         self.inHmacKey = None
         self.outHmacKey = None
         self.inHmacSize = 0
         self.outHmacSize = 0
         self.waitingForNewKeys = False
+        self._new_inbound_keys_ready = False
+
+        self.local_kex_init = None
+        self.peer_rekey_supported = False
+        self.peer_resume_supported = False
+        self.peer_flow_control_supported = False
+
+        # Set to a ResumptionTickets to enable session resumption.
+        self.resumption_tickets = None
+        self._resume_ticket = None
+        self._resume_nonce = None
+        self._issued_ticket_id = None
+        # Set once the session was resumed instead of a full key exchange.
+        self.session_resumed = False
+        self._rekeying = False
+        self._rekey_queue = []
+        self._rekey_bytes = 0
+        self._rekey_time = None
 
         self.waiter = None
         self.ready_waiters = []
-        self.buf = bytearray()
-        self.cbuf = self.buf
-        self.packet = None
+        self._write_buffer = bytearray()
+        self._write_scheduled = False
+        self._writing_paused = False
+        self._scheduler = OutboundScheduler()
+        self._channel_priorities = {} # {local_cid, priority}
+        self.buf = ReceiveBuffer()
+        # Clear text of the packet being decrypted; preallocated for the
+        # largest legal packet (plus one block of slack) so that decryption
+        # never has to reallocate or reslice it.
+        self.cbuf = bytearray(MAX_PACKET_LENGTH + 4 + 16)
+        self.cbufLength = 0
+        # Payloads of the packets received but not yet read_packet(..)'d.
+        self._packets = deque()
         self.bpLength = None
 
         self.inPacketId = 0
@@ -109,6 +645,7 @@ class SshProtocol(asyncio.Protocol):
 
     def close(self):
         if self.transport:
+            self.flush_writes(True)
             self.transport.close()
         self.status = Status.closed
 
@@ -138,9 +675,20 @@ class SshProtocol(asyncio.Protocol):
         else:
             local_cid = self._open_channel(channel_type)
 
-        queue = self._create_channel_queue()
+        if self.metrics:
+            self.metrics.channel_open_started(local_cid)
+
+        queue = self._create_channel_queue(local_cid)
         self.channel_queues[local_cid] = queue
 
+        if self._implicit_channels_enabled:
+            # There is no confirmation to tell us the peer's window, but it
+            # is of our version if it supports flow control at all.
+            self._channel_windows[local_cid] =\
+                ChannelWindow(CHANNEL_WINDOW_SIZE)
+        else:
+            self._channel_windows[local_cid] = ChannelWindow()
+
         if self._implicit_channels_enabled:
             yield from self.channel_handler.channel_opened(\
                 self, None, local_cid, queue)
@@ -163,8 +711,8 @@ class SshProtocol(asyncio.Protocol):
         msg = mnetpacket.SshChannelOpenMessage()
         msg.channel_type = channel_type
         msg.sender_channel = local_cid
-        msg.initial_window_size = 65535
-        msg.maximum_packet_size = 65535
+        msg.initial_window_size = CHANNEL_WINDOW_SIZE
+        msg.maximum_packet_size = CHANNEL_MAXIMUM_PACKET_SIZE
 
         self._channel_map[local_cid] = msg
 
@@ -180,8 +728,8 @@ class SshProtocol(asyncio.Protocol):
         msg = mnetpacket.SshChannelOpenMessage()
         msg.channel_type = channel_type
         msg.sender_channel = local_cid
-        msg.initial_window_size = 65535
-        msg.maximum_packet_size = 65535
+        msg.initial_window_size = CHANNEL_WINDOW_SIZE
+        msg.maximum_packet_size = CHANNEL_MAXIMUM_PACKET_SIZE
         msg.encode()
 
         self.write_packet(msg)
@@ -198,9 +746,11 @@ class SshProtocol(asyncio.Protocol):
 
         if remote_cid is ChannelStatus.implicit_data_sent:
             if data:
-                self.write_data((edmsg.encode(), msg.encode(), data))
+                self._write_channel_packet(\
+                    local_cid, (edmsg.encode(), msg.encode(), data))
             else:
-                self.write_data((edmsg.encode(), msg.encode()))
+                self._write_channel_packet(\
+                    local_cid, (edmsg.encode(), msg.encode()))
         else:
             assert type(remote_cid) is mnetpacket.SshChannelOpenMessage,\
                 type(remote_cid)
@@ -210,12 +760,91 @@ class SshProtocol(asyncio.Protocol):
 
             # Chain data message to end of open msg that was stored.
             if data:
-                self.write_data(\
+                self._write_channel_packet(local_cid,\
                     (remote_cid.encode(), edmsg.encode(), msg.encode(), data))
             else:
-                self.write_data(\
+                self._write_channel_packet(local_cid,\
                     (remote_cid.encode(), edmsg.encode(), msg.encode()))
 
+    def _count_channel_data_in(self, local_cid, data):
+        self.metrics.channel_open_done(local_cid)
+
+        window = self._channel_windows.get(local_cid)
+        if window:
+            window.bytes_in += len(data)
+
+    def get_stats(self):
+        """Returns a JSON serializable dict of the connection's state and,
+            if enabled, its metrics."""
+        stats = {\
+            "address": "{}:{}".format(*self.address[:2])\
+                if self.address else None,\
+            "status": self.status.name,\
+            "cipher_in": self.inCipherName if self.inCipher else None,\
+            "cipher_out": self.outCipherName if self.outCipher else None,\
+            "compression_in": self.inCompressionName,\
+            "compression_out": self.outCompressionName,\
+            "scheduled_packets": len(self._scheduler),\
+            "queued_bytes": self._queued_bytes,\
+            "reading_paused": self._reading_paused,\
+            "write_buffer_size": self.transport.get_write_buffer_size()\
+                if self.transport else 0}
+
+        if self.metrics:
+            stats.update(self.metrics.to_dict())
+
+        channels = []
+        for local_cid, remote_cid in self._channel_map.items():
+            cstats = {\
+                "local_cid": local_cid,\
+                "remote_cid": remote_cid if type(remote_cid) is int\
+                    else None,\
+                "priority": self._channel_priorities.get(\
+                    local_cid, PRIORITY_ROUTING)}
+
+            queue = self.channel_queues.get(local_cid)
+            if queue:
+                cstats["queue_packets"] = queue.qsize()
+                cstats["queue_bytes"] = queue.queued_bytes
+
+            window = self._channel_windows.get(local_cid)
+            if window:
+                cstats["send_window"] = window.send_window
+                pending_bytes = 0
+                for data in window.pending:
+                    pending_bytes += len(data)
+                cstats["pending_bytes"] = pending_bytes
+                if self.metrics:
+                    cstats["bytes_in"] = window.bytes_in
+                    cstats["bytes_out"] = window.bytes_out
+
+            channels.append(cstats)
+
+        stats["channels"] = channels
+
+        return stats
+
+    def set_channel_priority(self, local_cid, priority):
+        """Sets the outbound priority class of the channel, ie:
+            PRIORITY_DATA for channels carrying bulk data."""
+        if local_cid not in self._channel_map:
+            return
+
+        self._channel_priorities[local_cid] = priority
+        self._scheduler.set_priority(local_cid, priority)
+
+    def _write_channel_packet(self, local_cid, datas):
+        "Queues a packet of the channel in the outbound scheduler."
+        if self.status in [Status.closed, Status.disconnected]:
+            log.info("ProtocolHandler closed, ignoring write_data(..) call.")
+            return
+
+        priority = self._channel_priorities.get(local_cid, PRIORITY_ROUTING)
+
+        self._scheduler.push(local_cid, priority, datas)
+
+        self._schedule_flush()
+
     def send_channel_request(self, local_cid, request_type, want_reply=False,\
             payload=None):
         remote_cid = self._channel_map.get(local_cid)
@@ -278,6 +907,9 @@ class SshProtocol(asyncio.Protocol):
         if type(remote_cid) is mnetpacket.SshChannelOpenMessage:
             del self._channel_map[local_cid]
         else:
+            # Data held for lack of window must not be overtaken by the close.
+            self._flush_channel_window(local_cid, True)
+
             msg = mnetpacket.SshChannelCloseMessage()
 
             if remote_cid is ChannelStatus.implicit_data_sent:
@@ -287,14 +919,15 @@ class SshProtocol(asyncio.Protocol):
             msg.recipient_channel = remote_cid
             msg.encode()
 
-            self.write_packet(msg)
+            # Queued behind the channel's data so as not to overtake it.
+            self._write_channel_packet(local_cid, (msg.buf,))
 
             self._channel_map[local_cid] = ChannelStatus.closing
 
         yield from self.channel_handler.channel_closed(self, local_cid)
 
-    def _create_channel_queue(self):
-        return asyncio.Queue()
+    def _create_channel_queue(self, local_cid):
+        return ChannelQueue(self, local_cid)
 
     def _allocate_channel_id(self):
         nid = self._next_channel_id
@@ -317,6 +950,10 @@ class SshProtocol(asyncio.Protocol):
 
         log.info("Signature validated correctly!")
 
+        if self.status is Status.ready:
+            # This is a key re-exchange; the peer is already authenticated.
+            return True
+
         r = yield from self.connection_handler.peer_authenticated(self)
 
         return r
@@ -331,6 +968,97 @@ class SshProtocol(asyncio.Protocol):
     def set_inbound_enabled(self, val):
         self.inboundEnabled = val
 
+        if val and self.binaryMode and len(self.buf):
+            self.process_buffer()
+
+    def enable_new_inbound_keys(self):
+        "Called by the client once it has calculated the new keys."
+        if self.waitingForNewKeys:
+            # NEWKEYS hasn't arrived yet; _process_buffer() will switch to the
+            # new keys when it does.
+            self._new_inbound_keys_ready = True
+            return
+
+        self.init_inbound_encryption()
+        self.set_inbound_enabled(True)
+
+    def reset_rekey_limits(self):
+        self._rekey_bytes = 0
+        self._rekey_time = time.time()
+
+    def rekey(self):
+        """Starts a key re-exchange. Packets written while it is in progress
+            are queued and sent with the new keys, so callers never block."""
+        if self.status is not Status.ready or self._rekeying\
+                or not self.outCipher or not self.peer_rekey_supported:
+            return False
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Starting key re-exchange (address=[{}])."\
+                .format(self.address))
+
+        self._rekeying = True
+        _send_kex_init(self)
+
+        return True
+
+    def _check_rekey_limits(self, length):
+        self._rekey_bytes += length
+
+        if self._rekey_bytes < rekey_bytes_limit\
+                and time.time() - self._rekey_time < rekey_time_limit:
+            return
+
+        self.rekey()
+
+    @asyncio.coroutine
+    def _process_rekey(self, packet):
+        "Handles a KEXINIT received on an established connection."
+        if not self._rekeying:
+            # The peer started it.
+            if log.isEnabledFor(logging.INFO):
+                log.info("Peer started key re-exchange (address=[{}])."\
+                    .format(self.address))
+
+            self._rekeying = True
+            _send_kex_init(self)
+
+        try:
+            r = yield from _perform_kex(self, packet)
+        except Exception as e:
+            log.warning("Exception during key re-exchange: {}".format(e))
+            r = False
+
+        if not r:
+            log.warning("Key re-exchange failed (address=[{}]); closing."\
+                .format(self.address))
+            self.close()
+            return
+
+        # Our NEWKEYS has been sent and outbound encryption switched, so what
+        # was queued in the meantime can go out now.
+        self._rekeying = False
+
+        _issue_resumption_ticket(self)
+
+        queued = self._rekey_queue
+        self._rekey_queue = []
+        for datas in queued:
+            self.write_data(datas)
+
+        # Scheduled channel packets were held back as well.
+        self._schedule_flush()
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Key re-exchange done; sent [{}] queued packets"\
+                " (address=[{}]).".format(len(queued), self.address))
+
+    @property
+    def implicit_channels(self):
+        "True if channels are opened by their first packet, without waiting"\
+        " for a confirmation."
+        return self._implicit_channels_enabled
+
     @property
     def local_banner(self):
         if cleartext_transport_enabled:
@@ -353,7 +1081,18 @@ class SshProtocol(asyncio.Protocol):
         if log.isEnabledFor(logging.DEBUG):
             log.debug("ekey=[{}], iiv=[{}].".format(ekey, iiv))
 
+        self.outCompression = self.outCompressionName == COMPRESSION_ZLIB
+
+        if self.outCipherName == CIPHER_AES256_GCM:
+            # The AEAD tag replaces the MAC.
+            self.outCipher = AesGcmCipher(ekey, iiv[:12])
+            self.outAead = True
+            self.outHmacKey = None
+            self.outHmacSize = 0
+            return
+
         self.outCipher = AES.new(ekey, AES.MODE_CBC, iiv)
+        self.outAead = False
         self.outHmacKey = ikey
         self.outHmacSize = 20
 
@@ -372,7 +1111,17 @@ class SshProtocol(asyncio.Protocol):
         if log.isEnabledFor(logging.DEBUG):
             log.debug("ekey=[{}], iiv=[{}].".format(ekey, iiv))
 
+        self.inCompression = self.inCompressionName == COMPRESSION_ZLIB
+
+        if self.inCipherName == CIPHER_AES256_GCM:
+            self.inCipher = AesGcmCipher(ekey, iiv[:12])
+            self.inAead = True
+            self.inHmacKey = None
+            self.inHmacSize = 0
+            return
+
         self.inCipher = AES.new(ekey, AES.MODE_CBC, iiv)
+        self.inAead = False
         self.inHmacKey = ikey
         self.inHmacSize = 20
 
@@ -452,7 +1201,12 @@ class SshProtocol(asyncio.Protocol):
             if not packet:
                 return
 
-            yield from self._process_ssh_packet(packet)
+            if self.metrics:
+                start = time.perf_counter()
+                yield from self._process_ssh_packet(packet)
+                self.metrics.processing_time += time.perf_counter() - start
+            else:
+                yield from self._process_ssh_packet(packet)
 
     def _fix_implicit_msg(self, msg):
         "Returns remote_cid."
@@ -503,8 +1257,10 @@ class SshProtocol(asyncio.Protocol):
                     log.info("Channel [{}] opened (address=[{}])."\
                         .format(local_cid, self.address))
 
-                queue = self._create_channel_queue()
+                queue = self._create_channel_queue(local_cid)
                 self.channel_queues[local_cid] = queue
+                self._channel_windows[local_cid] =\
+                    ChannelWindow(msg.initial_window_size)
 
                 yield from self.channel_handler.channel_opened(\
                     self, msg.channel_type, local_cid, queue)
@@ -542,6 +1298,13 @@ class SshProtocol(asyncio.Protocol):
 
             self._channel_map[msg.recipient_channel] = msg.sender_channel
 
+            window = self._channel_windows.get(msg.recipient_channel)
+            if window:
+                window.send_window = msg.initial_window_size
+
+            if self.metrics:
+                self.metrics.channel_open_done(msg.recipient_channel)
+
             if log.isEnabledFor(logging.INFO):
                 log.info("Channel [{}] opened (address=[{}])."\
                     .format(msg.recipient_channel, self.address))
@@ -587,10 +1350,16 @@ class SshProtocol(asyncio.Protocol):
                 raise SshException(\
                     "Received data for unmapped channel.")
 
+            if self.metrics:
+                self._count_channel_data_in(msg.recipient_channel, msg.data)
+
             r = yield from self.channel_handler.channel_data(\
                 self, msg.recipient_channel, msg.data)
 
-            if not r:
+            if r:
+                self._channel_data_consumed(\
+                    msg.recipient_channel, len(msg.data))
+            else:
                 log.info(\
                     "Adding protocol (address={}) channel [{}] data"\
                     " to queue (remote_cid=[{}])."\
@@ -598,6 +1367,23 @@ class SshProtocol(asyncio.Protocol):
                 yield from self.channel_queues[msg.recipient_channel]\
                     .put(msg.data)
 
+        elif t == mnetpacket.SSH_MSG_CHANNEL_WINDOW_ADJUST:
+            msg = mnetpacket.SshChannelWindowAdjustMessage(packet, offset)
+
+            if offset:
+                # Wrapped by the opener of an implicit channel, and so
+                # addressed with its channel id.
+                local_cid =\
+                    self._reverse_channel_map.get(msg.recipient_channel)
+            else:
+                local_cid = msg.recipient_channel
+
+            if log.isEnabledFor(logging.INFO):
+                log.info("P: Received CHANNEL_WINDOW_ADJUST local_cid=[{}],"\
+                    " bytes_to_add=[{}].".format(local_cid, msg.bytes_to_add))
+
+            self._channel_window_adjusted(local_cid, msg.bytes_to_add)
+
         elif t == mnetpacket.SSH_MSG_CHANNEL_CLOSE:
             msg = mnetpacket.SshChannelCloseMessage(packet)
 
@@ -622,6 +1408,11 @@ class SshProtocol(asyncio.Protocol):
                 yield from self.channel_handler.channel_closed(\
                         self, local_cid)
 
+        elif t == mnetpacket.SSH_MSG_KEXINIT:
+            yield from self._process_rekey(packet)
+        elif t == mnetpacket.SSH_MSG_NEWKEYS:
+            # Inbound keys were already switched by _process_buffer().
+            log.info("P: Received NEWKEYS; key re-exchange complete.")
         elif t == mnetpacket.SSH_MSG_CHANNEL_REQUEST:
             msg = mnetpacket.SshChannelRequest(packet, offset)
 
@@ -655,8 +1446,8 @@ class SshProtocol(asyncio.Protocol):
         cm = mnetpacket.SshChannelOpenConfirmationMessage()
         cm.recipient_channel = req_msg.sender_channel
         cm.sender_channel = local_cid
-        cm.initial_window_size = 65535
-        cm.maximum_packet_size = 65535
+        cm.initial_window_size = CHANNEL_WINDOW_SIZE
+        cm.maximum_packet_size = CHANNEL_MAXIMUM_PACKET_SIZE
 
         cm.encode()
 
@@ -703,10 +1494,20 @@ class SshProtocol(asyncio.Protocol):
 
             msg.recipient_channel = remote_cid
             msg.encode()
-            self.write_packet(msg)
+            self._write_channel_packet(local_cid, (msg.buf,))
+
+        self._channel_priorities.pop(local_cid, None)
+
+        if self.metrics:
+            self.metrics.channel_open_starts.pop(local_cid, None)
+
+        window = self._channel_windows.pop(local_cid, None)
+        if window:
+            window.wake_waiters(False)
 
         queue = self.channel_queues.pop(local_cid, None)
         if queue:
+            queue.detach()
             yield from queue.put(None)
 
         if log.isEnabledFor(logging.INFO):
@@ -716,6 +1517,9 @@ class SshProtocol(asyncio.Protocol):
         return True
 
     def data_received(self, data):
+        if self.metrics:
+            self.metrics.bytes_in += len(data)
+
         try:
             self._data_received(data)
         except Exception:
@@ -732,6 +1536,10 @@ class SshProtocol(asyncio.Protocol):
 
         self._channel_map.clear()
 
+        for window in self._channel_windows.values():
+            window.wake_waiters(False)
+        self._channel_windows.clear()
+
         self._close_queues()
 
         if self.waiter != None:
@@ -755,8 +1563,8 @@ class SshProtocol(asyncio.Protocol):
             log.debug("X: Received: [\n{}].".format(hex_dump(data)))
 
         if self.binaryMode:
-            self.buf += data
-            if not self.packet and self.inboundEnabled:
+            self.buf.append(data)
+            if self.inboundEnabled:
                 self.process_buffer()
             log.debug("data_received(..): end (binaryMode).")
             return
@@ -764,21 +1572,21 @@ class SshProtocol(asyncio.Protocol):
         # Handle handshake packet, detect end.
         end = data.find(b"\r\n")
         if end != -1:
-            self.buf += data[0:end]
-            self.packet = self.buf
-            self.buf = data[end+2:]
+            self.buf.append(data[0:end])
+            self._packets.append(self.buf.view().tobytes())
+            self.buf.clear()
+            self.buf.append(memoryview(data)[end+2:])
             self.binaryMode = True
 
+            # Any packets following the banner are only processed once it
+            # has been read, as the connect task may need to act on it
+            # first (ie: _send_resume(..)); see read_packet(..).
+
             if self.waiter != None:
                 self.waiter.set_result(False)
                 self.waiter = None
-
-            # The following would overwrite packet if it were a complete
-            # packet in the buf.
-#            if len(self.buf) > 0:
-#                self.process_buffer()
         else:
-            self.buf += data
+            self.buf.append(data)
 
         log.debug("data_received(..): end.")
 
@@ -806,39 +1614,24 @@ class SshProtocol(asyncio.Protocol):
             log.debug(errstr)
             raise SshException(errstr)
 
-        if self.packet != None:
-            packet = self.packet
-            self.packet = None
-
-            if packet[0] == 0x01:
-                yield from\
-                    self._peer_disconnected(\
-                        mnetpacket.SshDisconnectMessage(packet))
+        if not self._packets:
+            if self.status is Status.closed\
+                    or self.status is Status.disconnected:
                 return None
 
-            log.info("P: Returning next packet.")
-
-            #asyncio.call_soon(self.process_buffer())
-            # For now, call process_buffer in this event.
-            if len(self.buf) > 0:
+            if self.binaryMode and self.inboundEnabled and len(self.buf):
+                # Data that came in with the banner.
                 self.process_buffer()
 
-            return packet
-
-        if self.status is Status.closed or self.status is Status.disconnected:
-            return None
-
-        log.info("P: Waiting for packet.")
-        yield from self.do_wait()
+            while not self._packets:
+                log.info("P: Waiting for packet.")
+                yield from self.do_wait()
 
-        if self.status is Status.closed or self.status is Status.disconnected:
-            return None
-
-        assert self.packet != None
-        packet = self.packet
-        self.packet = None
+                if self.status is Status.closed\
+                        or self.status is Status.disconnected:
+                    return None
 
-        log.info("P: Notified of packet.")
+        packet = self._packets.popleft()
 
         if packet[0] == 0x01:
             yield from\
@@ -846,10 +1639,6 @@ class SshProtocol(asyncio.Protocol):
                     mnetpacket.SshDisconnectMessage(packet))
             return None
 
-        # For now, call process_buffer in this event.
-        if len(self.buf) > 0:
-            self.process_buffer()
-
         return packet
 
     def _peer_disconnected(self, msg):
@@ -872,30 +1661,186 @@ class SshProtocol(asyncio.Protocol):
         self.write_data([packet.buf])
 
     def write_channel_data(self, local_cid, data):
+        """Writes data to the channel. If the peer's window for the channel is
+            exhausted the data is held and sent, in order, once the peer opens
+            it again; callers that can produce data faster than the peer
+            consumes it should yield from drain_channel(..) after writing."""
         log.info("Writing to channel {} with {} bytes of data (address={}).".format(local_cid, len(data), self.address))
 
         remote_cid = self._channel_map.get(local_cid)
         if remote_cid is None:
             return False
 
+        if self.metrics:
+            window = self._channel_windows.get(local_cid)
+            if window:
+                window.bytes_out += len(data)
+
+        if self.peer_flow_control_supported:
+            window = self._channel_windows.get(local_cid)
+            if window:
+                if window.pending or len(data) > window.send_window:
+                    window.pending.append(data)
+                    return True
+
+                window.send_window -= len(data)
+
+        self._write_channel_data(local_cid, remote_cid, data)
+        return True
+
+    def _write_channel_data(self, local_cid, remote_cid, data):
         msg = mnetpacket.SshChannelDataMessage()
 
         if self._implicit_channels_enabled:
             if type(remote_cid) is not int:
                 self._write_implicit_channel_data(\
                     local_cid, remote_cid, msg, data)
-                return True
+                return
 
         msg.recipient_channel = remote_cid
 
-        self.write_data((msg.encode(), data))
-        return True
+        self._write_channel_packet(local_cid, (msg.encode(), data))
+
+    @asyncio.coroutine
+    def drain_channel(self, local_cid):
+        """Waits until the peer's window for the channel has room again.
+            Returns False if the channel or connection closed meanwhile."""
+        if not self.peer_flow_control_supported:
+            return True
+
+        window = self._channel_windows.get(local_cid)
+        if not window or not window.blocked:
+            return True
+
+        waiter = asyncio.futures.Future(loop=self.loop)
+        window.drain_waiters.append(waiter)
+
+        r = yield from waiter
+        return r
+
+    def _flush_channel_window(self, local_cid, force=False):
+        "Sends the held data that fits in the window, or all of it if force."
+        window = self._channel_windows.get(local_cid)
+        if not window:
+            return
+
+        pending = window.pending
+
+        remote_cid = self._channel_map.get(local_cid)
+        if remote_cid is None or remote_cid is ChannelStatus.closing\
+                or remote_cid is ChannelStatus.opening:
+            pending.clear()
+            window.wake_waiters(False)
+            return
+
+        while pending:
+            data = pending[0]
+            if not force and len(data) > window.send_window:
+                break
+
+            pending.popleft()
+            window.send_window -= len(data)
+
+            self._write_channel_data(local_cid, remote_cid, data)
+
+        if not window.blocked:
+            window.wake_waiters()
+
+    def _channel_window_adjusted(self, local_cid, bytes_to_add):
+        window = self._channel_windows.get(local_cid)
+        if not window:
+            if log.isEnabledFor(logging.INFO):
+                log.info("Received CHANNEL_WINDOW_ADJUST for unknown channel"\
+                    " [{}]; ignoring.".format(local_cid))
+            return
+
+        window.send_window += bytes_to_add
+
+        self._flush_channel_window(local_cid)
+
+    def _channel_data_consumed(self, local_cid, length):
+        "Reopens the peer's window once half of it has been consumed."
+        if not self.peer_flow_control_supported:
+            return
+
+        window = self._channel_windows.get(local_cid)
+        if not window:
+            return
+
+        window.consumed += length
+        if window.consumed < CHANNEL_WINDOW_SIZE // 2:
+            return
+
+        remote_cid = self._channel_map.get(local_cid)
+
+        msg = mnetpacket.SshChannelWindowAdjustMessage()
+        msg.bytes_to_add = window.consumed
+
+        if remote_cid is ChannelStatus.implicit_data_sent:
+            # Control; not queued behind the channel's own data.
+            msg.recipient_channel = local_cid
+            edmsg = mnetpacket.SshChannelImplicitWrapper()
+            self.write_data((edmsg.encode(), msg.encode()))
+        elif type(remote_cid) is int:
+            msg.recipient_channel = remote_cid
+            msg.encode()
+            self.write_packet(msg)
+        else:
+            # Closing.
+            return
+
+        window.consumed = 0
+
+    def _channel_data_queued(self, length):
+        self._queued_bytes += length
+
+        if self._queued_bytes <= CHANNEL_QUEUE_HIGH_WATER\
+                or self._reading_paused or not self.transport:
+            return
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Channel queues hold [{}] bytes; pausing reading"\
+                " (address=[{}]).".format(self._queued_bytes, self.address))
+
+        self._reading_paused = True
+        self.transport.pause_reading()
+
+    def _channel_data_dequeued(self, length):
+        self._queued_bytes -= length
+
+        if not self._reading_paused\
+                or self._queued_bytes >= CHANNEL_QUEUE_LOW_WATER:
+            return
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Channel queues drained; resuming reading"\
+                " (address=[{}]).".format(self.address))
+
+        self._reading_paused = False
+
+        if self.status is not Status.closed\
+                and self.status is not Status.disconnected:
+            self.transport.resume_reading()
 
     def write_data(self, datas):
         if self.status in [Status.closed, Status.disconnected]:
             log.info("ProtocolHandler closed, ignoring write_data(..) call.")
             return
 
+        if self._rekeying and datas[0][0] not in KEX_PACKET_TYPES:
+            # Only key exchange packets may be sent until our NEWKEYS is.
+            self._rekey_queue.append((b"".join(datas),))
+            return
+
+        self._write_frame(datas)
+
+        self._schedule_flush()
+
+    def _write_frame(self, datas):
+        "Frames (and encrypts) the packet into _write_buffer."
+        if self.outCompression:
+            datas = _compress(datas)
+
         mod_size = None
         if self.outCipher == None:
             mod_size = 8 # RFC says 8 minimum.
@@ -910,7 +1855,12 @@ class SshProtocol(asyncio.Protocol):
             log.info("Writing {} bytes of data to connection (address=[{}])."\
                 .format(length, self.address))
 
-        extra = (length + 5) % mod_size;
+        if self.outAead:
+            # The packet_length field is not encrypted and so is excluded
+            # from the block alignment.
+            extra = (length + 1) % mod_size
+        else:
+            extra = (length + 5) % mod_size;
         if extra != 0:
             padding = mod_size - extra
             if padding < 4:
@@ -918,13 +1868,15 @@ class SshProtocol(asyncio.Protocol):
         else:
             padding = mod_size; #Minimum padding is 4.
 
+        # Framed packets are appended to _write_buffer and all packets
+        # written during this loop iteration go out in one transport write.
+        wbuf = self._write_buffer
+
         if self.outCipher == None:
-            self.transport.write(struct.pack(">L", 1 + length + padding))
-            self.transport.write(struct.pack("B", padding & 0xff))
+            wbuf += struct.pack(">LB", 1 + length + padding, padding & 0xff)
             for data in datas:
-                self.transport.write(data)
-            for i in range(0, padding):
-                self.transport.write(struct.pack("B", 0))
+                wbuf += data
+            wbuf += bytes(padding)
         else:
             buf = bytearray()
             buf += struct.pack(">L", 1 + length + padding)
@@ -936,18 +1888,86 @@ class SshProtocol(asyncio.Protocol):
             if log.isEnabledFor(logging.DEBUG):
                 log.debug("len(buf)=[{}], padding=[{}].".format(len(buf), padding))
 
-            if self.outHmacSize != 0:
+            if self.metrics:
+                start = time.perf_counter()
+
+            if self.outAead:
+                aad = bytes(buf[:4])
+                out, tag = self.outCipher.encrypt(aad, bytes(buf[4:]))
+
+                wbuf += aad
+                wbuf += out
+                wbuf += tag
+            elif self.outHmacSize != 0:
                 tmac = hmac.new(self.outHmacKey, digestmod=sha1)
                 tmac.update(struct.pack(">L", self.outPacketId))
                 tmac.update(buf)
 
                 out = self.outCipher.encrypt(bytes(buf))
 
-                self.transport.write(out)
-                self.transport.write(tmac.digest())
+                wbuf += out
+                wbuf += tmac.digest()
+
+            if self.metrics:
+                self.metrics.encrypt_time += time.perf_counter() - start
+
+        if self.metrics:
+            self.metrics.packets_out += 1
 
         self.outPacketId = (self.outPacketId + 1) & 0xFFFFFFFF
 
+        if self._rekey_time is not None:
+            self._check_rekey_limits(length)
+
+    def _schedule_flush(self):
+        if not self._write_scheduled:
+            self._write_scheduled = True
+            self.loop.call_soon(self.flush_writes)
+
+    def flush_writes(self, force=False):
+        """Writes out all packets written by write_data(..) so far, followed
+            by as many scheduled channel packets as the transport will take
+            before it asks us to pause, or all of them if force."""
+        self._write_scheduled = False
+
+        if not self.transport:
+            return
+
+        scheduler = self._scheduler
+
+        while scheduler and (force or not self._writing_paused)\
+                and not self._rekeying\
+                and self.status is not Status.closed\
+                and self.status is not Status.disconnected:
+            self._write_frame(scheduler.pop())
+
+            if len(self._write_buffer) >= WRITE_CHUNK_SIZE:
+                # This can call pause_writing().
+                self._write_out()
+
+        self._write_out()
+
+    def _write_out(self):
+        wbuf = self._write_buffer
+        if not wbuf:
+            return
+
+        self._write_buffer = bytearray()
+
+        if self.metrics:
+            self.metrics.bytes_out += len(wbuf)
+
+        self.transport.write(wbuf)
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+
+        if self._scheduler:
+            self._schedule_flush()
+
     def process_buffer(self):
         try:
             self._process_buffer()
@@ -957,27 +1977,47 @@ class SshProtocol(asyncio.Protocol):
             return
 
     def _process_buffer(self):
+        "Decrypts and queues every complete packet in the buffer."
         if log.isEnabledFor(logging.DEBUG):
-            log.debug("P: process_buffer(): called (binaryMode={}), buf=[\n{}].".format(self.binaryMode, hex_dump(self.buf)))
+            log.debug("P: process_buffer(): called (binaryMode={}), buf=[\n{}].".format(self.binaryMode, hex_dump(self.buf.view().tobytes())))
 
         assert self.binaryMode
 
-        r = self._process_encrypted_buffer()
-        if not r:
-            return
+        packets = self._packets
+        count = len(packets)
 
-        # cbuf is clear text buf.
-        while True:
-            if self.bpLength is None:
-                assert not self.inCipher
+        try:
+            # Stops when the inbound keys aren't ready for the packets
+            # following a NEWKEYS; see set_inbound_enabled(..).
+            while self.inboundEnabled:
+                payload = self._process_packet()
+                if payload is None:
+                    break
+
+                packets.append(payload)
+        finally:
+            if len(packets) != count and self.waiter != None:
+                self.waiter.set_result(False)
+                self.waiter = None
 
-                if len(self.cbuf) < 4:
-                    return
+    def _process_packet(self):
+        "Returns the payload of the next packet, or None if incomplete."
+        if self.metrics and self.inCipher:
+            start = time.perf_counter()
+            r = self._process_encrypted_buffer()
+            self.metrics.decrypt_time += time.perf_counter() - start
+        else:
+            r = self._process_encrypted_buffer()
+        if not r:
+            return None
 
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("t=[{}].".format(self.cbuf[:4]))
+        if self.inCipher is None:
+            # Clear text is read straight out of buf.
+            if self.bpLength is None:
+                if len(self.buf) < 4:
+                    return None
 
-                packet_length = struct.unpack(">L", self.cbuf[:4])[0]
+                packet_length = struct.unpack_from(">L", self.buf.view(0, 4))[0]
 
                 if log.isEnabledFor(logging.DEBUG):
                     log.debug("packet_length=[{}].".format(packet_length))
@@ -989,130 +2029,188 @@ class SshProtocol(asyncio.Protocol):
                     raise SshException(errmsg)
 
                 self.bpLength = packet_length + 4 # Add size of packet_length as we leave it in buf.
-            else:
-                if len(self.cbuf) < self.bpLength or len(self.buf) < self.inHmacSize:
-                    return;
 
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("PACKET READ (bpLength={}, inHmacSize={}, len(self.cbuf)={}, len(self.buf)={})".format(self.bpLength, self.inHmacSize, len(self.cbuf), len(self.buf)))
+            if len(self.buf) < self.bpLength + self.inHmacSize:
+                return None
+
+            cbuf = self.buf.view(0, self.bpLength)
+            mac = self.buf.view(self.bpLength, self.bpLength + self.inHmacSize)
+            consumed = self.bpLength + self.inHmacSize
+        else:
+            if self.cbufLength < self.bpLength\
+                    or len(self.buf) < self.inHmacSize:
+                return None
+
+            cbuf = memoryview(self.cbuf)[:self.bpLength]
+            mac = self.buf.view(0, self.inHmacSize)
+            consumed = self.inHmacSize
 
-                padding_length = struct.unpack("B", self.cbuf[4:5])[0]
-                log.debug("padding_length=[{}].".format(padding_length))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("PACKET READ (bpLength={}, inHmacSize={}, cbufLength={}, len(self.buf)={})".format(self.bpLength, self.inHmacSize, self.cbufLength, len(self.buf)))
 
-                padding_offset = self.bpLength - padding_length
+        padding_length = cbuf[4]
+        log.debug("padding_length=[{}].".format(padding_length))
 
-                payload = self.cbuf[5:padding_offset]
-                padding = self.cbuf[padding_offset:self.bpLength]
-#                mac = self.cbuf[self.bpLength:self.bpLength + self.inHmacSize]
-                mac = self.buf[:self.inHmacSize]
+        padding_offset = self.bpLength - padding_length
 
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("payload=[\n{}], padding=[\n{}], mac=[\n{}] len(mac)={}.".format(hex_dump(payload), hex_dump(padding), hex_dump(mac), len(mac)))
-
-                if self.inHmacSize != 0:
-                    self.buf = self.buf[self.inHmacSize:]
-
-                    mbuf = struct.pack(">L", self.inPacketId)
-                    tmac = hmac.new(self.inHmacKey, digestmod=sha1)
-                    tmac.update(mbuf)
-                    tmac.update(self.cbuf)
-                    cmac = tmac.digest()
-                    if log.isEnabledFor(logging.DEBUG):
-                        log.debug("inPacketId={} len(cmac)={}, cmac=[\n{}].".format(self.inPacketId, len(cmac), hex_dump(cmac)))
-                    r = hmac.compare_digest(cmac, mac)
-                    log.info("HMAC check result: [{}].".format(r))
-                    if not r:
-                        raise SshException("HMAC check failure, packetId={}.".format(self.inPacketId))
-
-                newbuf = self.cbuf[self.bpLength + self.inHmacSize:]
-                if self.cbuf == self.buf:
-                    self.cbuf = bytearray()
-                    self.buf = newbuf
+        # The payload is the only copy made; cbuf is reused for the next
+        # packet.
+        payload = cbuf[5:padding_offset].tobytes()
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("payload=[\n{}], padding=[\n{}], mac=[\n{}] len(mac)={}.".format(hex_dump(payload), hex_dump(cbuf[padding_offset:].tobytes()), hex_dump(mac.tobytes()), len(mac)))
+
+        if self.inHmacSize != 0:
+            mbuf = struct.pack(">L", self.inPacketId)
+            tmac = hmac.new(self.inHmacKey, digestmod=sha1)
+            tmac.update(mbuf)
+            tmac.update(cbuf)
+            cmac = tmac.digest()
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("inPacketId={} len(cmac)={}, cmac=[\n{}].".format(self.inPacketId, len(cmac), hex_dump(cmac)))
+            r = hmac.compare_digest(cmac, mac.tobytes())
+            log.info("HMAC check result: [{}].".format(r))
+            if not r:
+                raise SshException("HMAC check failure, packetId={}.".format(self.inPacketId))
+
+        self.buf.consume(consumed)
+        self.cbufLength = 0
+
+        if self.inCompression:
+            payload = _decompress(payload)
+
+        if self.waitingForNewKeys:
+            packet_type = mnetpacket.SshPacket.parse_type(payload)
+            if packet_type == mnetpacket.SSH_MSG_NEWKEYS:
+                if self.server_mode or self._new_inbound_keys_ready:
+                    self.init_inbound_encryption()
+                    self._new_inbound_keys_ready = False
                 else:
-                    self.cbuf = newbuf
+                    # Disable further processing until inbound
+                    # encryption is setup. It may not have yet as
+                    # parameters and newkeys may have come in same tcp
+                    # packet.
+                    self.set_inbound_enabled(False)
+                self.waitingForNewKeys = False
 
-                if self.waitingForNewKeys:
-                    packet_type = mnetpacket.SshPacket.parse_type(payload)
-                    if packet_type == mnetpacket.SSH_MSG_NEWKEYS:
-                        if self.server_mode:
-                            self.init_inbound_encryption()
-                        else:
-                            # Disable further processing until inbound
-                            # encryption is setup. It may not have yet as
-                            # parameters and newkeys may have come in same tcp
-                            # packet.
-                            self.set_inbound_enabled(False)
-                        self.waitingForNewKeys = False
+        self.inPacketId = (self.inPacketId + 1) & 0xFFFFFFFF
 
-                self.packet = payload
-                self.inPacketId = (self.inPacketId + 1) & 0xFFFFFFFF
+        if self.metrics:
+            self.metrics.packets_in += 1
 
-                self.bpLength = None
+        if self._rekey_time is not None and self.status is Status.ready:
+            self._check_rekey_limits(self.bpLength)
 
-                if self.waiter != None:
-                    self.waiter.set_result(False)
-                    self.waiter = None
+        self.bpLength = None
 
-                break;
+        return payload
 
     def _process_encrypted_buffer(self):
         blksize = 16
 
-        if self.inCipher != None:
-#            if len(self.buf) > 20: # max(blksize, 20): bs, hmacSize
+        if self.inCipher is None:
+            return True
+
+        if self.inAead:
+            return self._process_aead_buffer()
+
+        if self.cbufLength == 0:
             if len(self.buf) < blksize:
                 return False
 
-            if len(self.cbuf) == 0:
-                out = self.inCipher.decrypt(self.buf[:blksize])
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("Decrypted [\n{}] to [\n{}]."\
-                        .format(hex_dump(self.buf[:blksize]), hex_dump(out)))
-                self.cbuf += out
-                packet_length = struct.unpack(">L", out[:4])[0]
-                log.debug("packet_length=[{}].".format(packet_length))
-                if packet_length > MAX_PACKET_LENGTH:
-                    errmsg = "Illegal packet_length [{}] received."\
-                        .format(packet_length)
-                    log.warning(errmsg)
-                    raise SshException(errmsg)
+            out = memoryview(self.cbuf)[:blksize]
+            self._decrypt_into(self.buf.view(0, blksize), out)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Decrypted [\n{}] to [\n{}]."\
+                    .format(hex_dump(self.buf.view(0, blksize).tobytes()),\
+                        hex_dump(out.tobytes())))
+            self.cbufLength = blksize
+            packet_length = struct.unpack_from(">L", self.cbuf)[0]
+            log.debug("packet_length=[{}].".format(packet_length))
+            if packet_length > MAX_PACKET_LENGTH:
+                errmsg = "Illegal packet_length [{}] received."\
+                    .format(packet_length)
+                log.warning(errmsg)
+                raise SshException(errmsg)
+
+            # Add size of packet_length as we leave it in buf.
+            self.bpLength = packet_length + 4
+
+            self.buf.consume(blksize)
+
+            if self.bpLength == blksize:
+                return True
 
-                # Add size of packet_length as we leave it in buf.
-                self.bpLength = packet_length + 4
+        if len(self.buf) < min(\
+                1024, self.bpLength - self.cbufLength + self.inHmacSize):
+            return True
 
-                self.buf = self.buf[blksize:]
+        l = min(len(self.buf), self.bpLength - self.cbufLength)
+        if not l:
+            return True
 
-                if self.bpLength == blksize:
-                    return True
+        dsize = l - (l % blksize)
+        if not dsize:
+            return True
 
-            if len(self.buf) < min(\
-                    1024, self.bpLength - len(self.cbuf) + self.inHmacSize):
-                return True
+        out = memoryview(self.cbuf)[self.cbufLength:self.cbufLength + dsize]
+        self._decrypt_into(self.buf.view(0, dsize), out)
+        self.buf.consume(dsize)
+        self.cbufLength += dsize
 
-            l = min(len(self.buf), self.bpLength - len(self.cbuf))
-            if not l:
-                return True
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Decrypted [{}] bytes to cbuf.".format(dsize))
+            log.debug("cbufLength={}, cbuf=[\n{}]".format(self.cbufLength, hex_dump(self.cbuf[:self.cbufLength])))
 
-            dsize = l - (l % blksize)
-            blks = self.buf[:dsize]
-            self.buf = self.buf[dsize:]
-            assert len(blks) % blksize == 0,\
-                "len(blks)=[{}], dsize=[{}], l=[{}],"\
-                " len(self.buf)=[{}], len(self.cbuf)=[{}], blksize=[{}],"\
-                " self.bpLength=[{}], type(blks)=[{}]."\
-                    .format(len(blks), dsize, l, len(self.buf),\
-                        len(self.cbuf), blksize, self.bpLength, type(blks))
-            out = self.inCipher.decrypt(blks)
-            self.cbuf += out
+        return True
 
-            if log.isEnabledFor(logging.DEBUG):
-                log.debug("Decrypted [\n{}] to [\n{}].".format(hex_dump(blks), hex_dump(out)))
-                log.debug("len(cbuf)={}, cbuf=[\n{}]".format(len(self.cbuf), hex_dump(self.cbuf)))
-        else:
-            self.cbuf = self.buf
+    def _process_aead_buffer(self):
+        # With an AEAD cipher the packet can only be decrypted once it has
+        # been fully received, as the tag covers all of it.
+        if self.bpLength is None:
+            if len(self.buf) < 4:
+                return False
+
+            packet_length = struct.unpack_from(">L", self.buf.view(0, 4))[0]
+            if packet_length > MAX_PACKET_LENGTH:
+                errmsg = "Illegal packet_length [{}] received."\
+                    .format(packet_length)
+                log.warning(errmsg)
+                raise SshException(errmsg)
+
+            # Add size of packet_length as we leave it in buf.
+            self.bpLength = packet_length + 4
+
+        if len(self.buf) < self.bpLength + GCM_TAG_SIZE:
+            return False
+
+        aad = self.buf.view(0, 4)
+        cbuf = memoryview(self.cbuf)
+        cbuf[:4] = aad
+
+        r = self.inCipher.decrypt_into(\
+            aad.tobytes(),\
+            self.buf.view(4, self.bpLength),\
+            cbuf[4:self.bpLength],\
+            self.buf.view(self.bpLength, self.bpLength + GCM_TAG_SIZE)\
+                .tobytes())
+
+        if not r:
+            raise SshException("AEAD tag check failure, packetId={}."\
+                .format(self.inPacketId))
+
+        self.buf.consume(self.bpLength + GCM_TAG_SIZE)
+        self.cbufLength = self.bpLength
 
         return True
 
+    def _decrypt_into(self, src, dst):
+        "Decrypts the src memoryview into the same sized dst memoryview."
+        if cipher_output_supported:
+            self.inCipher.decrypt(src, output=dst)
+        else:
+            dst[:] = self.inCipher.decrypt(src.tobytes())
+
 class SshServerProtocol(SshProtocol):
     def __init__(self, loop):
         super().__init__(loop)
@@ -1157,6 +2255,11 @@ def connectTaskCommon(protocol, server_mode):
     log.info("X: Sending banner.")
     protocol.transport.write((protocol.local_banner + "\r\n").encode(encoding="UTF-8"))
 
+    if not server_mode:
+        # Sent before waiting for the server's banner so that a resumed
+        # session costs no more round trips than the banner exchange.
+        _send_resume(protocol)
+
     # Read banner.
     packet = yield from protocol.read_packet()
 
@@ -1211,46 +2314,36 @@ def connectTaskInsecure(protocol, server_mode):
 
     return True
 
-# Returns True on success, False on failure.
-@asyncio.coroutine
-def connectTaskSecure(protocol, server_mode):
-    # Send KexInit packet.
+def _send_kex_init(protocol):
     opobj = mnetpacket.SshKexInitMessage()
     opobj.cookie = os.urandom(16)
 #    opobj.kex_algorithms = "diffie-hellman-group-exchange-sha256"
-    opobj.kex_algorithms = "diffie-hellman-group14-sha1"
+    # The rekey, resume and flowcontrol pseudo-algorithms are never chosen;
+    # they only advertise that we handle a KEXINIT on an established
+    # connection, session resumption and channel WINDOW_ADJUST respectively.
+    opobj.kex_algorithms = "diffie-hellman-group14-sha1,"\
+        + KEX_REKEY_EXTENSION + ',' + KEX_RESUME_EXTENSION + ','\
+        + KEX_FLOW_CONTROL_EXTENSION
     opobj.server_host_key_algorithms = "ssh-rsa"
-    opobj.encryption_algorithms_client_to_server = "aes256-cbc"
-    opobj.encryption_algorithms_server_to_client = "aes256-cbc"
+    opobj.encryption_algorithms_client_to_server = ','.join(ciphers)
+    opobj.encryption_algorithms_server_to_client = ','.join(ciphers)
 #    opobj.mac_algorithms_client_to_server = "hmac-sha2-512"
 #    opobj.mac_algorithms_server_to_client = "hmac-sha2-512"
     opobj.mac_algorithms_client_to_server = "hmac-sha1"
     opobj.mac_algorithms_server_to_client = "hmac-sha1"
-    opobj.compression_algorithms_client_to_server = "none"
-    opobj.compression_algorithms_server_to_client = "none"
+    opobj.compression_algorithms_client_to_server = ','.join(compressions)
+    opobj.compression_algorithms_server_to_client = ','.join(compressions)
     opobj.encode()
 
     protocol.local_kex_init_message = opobj.buf
+    protocol.local_kex_init = opobj
 
     protocol.write_packet(opobj)
 
-    # Read KexInit packet.
-    packet = yield from protocol.read_packet()
-    if not packet:
-        return False
-
-    if log.isEnabledFor(logging.DEBUG):
-        log.debug("X: Received packet [{}].".format(hex_dump(packet)))
-
-    packet_type = mnetpacket.SshPacket.parse_type(packet)
-
-    if log.isEnabledFor(logging.INFO):
-        log.info("packet_type=[{}].".format(packet_type))
-
-    if packet_type != 20:
-        log.warning("Peer sent unexpected packet_type[{}], disconnecting.".format(packet_type))
-        protocol.close()
-        return False
+# Returns True on success, False on failure.
+@asyncio.coroutine
+def _perform_kex(protocol, packet):
+    "Runs the key exchange given the peer's KEXINIT packet."
 
     protocol.remote_kex_init_message = packet
 
@@ -1260,6 +2353,15 @@ def connectTaskSecure(protocol, server_mode):
     if log.isEnabledFor(logging.INFO):
         log.info("keyExchangeAlgorithms=[{}].".format(pobj.kex_algorithms))
 
+    kex_algorithms = pobj.kex_algorithms.split(',')
+    protocol.peer_rekey_supported = KEX_REKEY_EXTENSION in kex_algorithms
+    protocol.peer_resume_supported = KEX_RESUME_EXTENSION in kex_algorithms
+    protocol.peer_flow_control_supported =\
+        KEX_FLOW_CONTROL_EXTENSION in kex_algorithms
+
+    _negotiate_ciphers(protocol, protocol.local_kex_init, pobj)
+    _negotiate_compression(protocol, protocol.local_kex_init, pobj)
+
     protocol.waitingForNewKeys = True
 
 #    ke = kex.KexGroup14(protocol)
@@ -1270,11 +2372,10 @@ def connectTaskSecure(protocol, server_mode):
     r = yield from ke.run()
 
     if not r:
-        # Client is rejected for some reason by higher level.
-        protocol.close()
         return False
 
-    # Setup encryption now that keys are exchanged.
+    # Setup encryption now that keys are exchanged. Our NEWKEYS was the last
+    # packet written by ke.run().
     protocol.init_outbound_encryption()
 
     if not protocol.server_mode:
@@ -1283,8 +2384,263 @@ def connectTaskSecure(protocol, server_mode):
             message may come in the same tcppacket, so the auto part just turns
             off inbound processing and waits for us to call
             init_inbound_encryption when we have the parameters ready. """
-        protocol.init_inbound_encryption()
-        protocol.set_inbound_enabled(True)
+        protocol.enable_new_inbound_keys()
+
+    protocol.reset_rekey_limits()
+
+    return True
+
+def _issue_resumption_ticket(protocol):
+    "Derives a resumption ticket from the current K and H."
+    if not protocol.resumption_tickets or not protocol.peer_resume_supported:
+        return
+
+    ticket = ResumptionTicket()
+    # A through F are used for the transport keys.
+    ticket.ticket_id = bytes(protocol.generateKey(b'G', 32))
+    ticket.secret = protocol.generateKey(b'H', 32)
+    ticket.expires = time.time() + RESUMPTION_TICKET_LIFETIME
+
+    if protocol.server_mode:
+        ticket.peer_key = bytes(protocol.client_key.asbytes())
+        ticket.cipher_client_to_server = protocol.inCipherName
+        ticket.cipher_server_to_client = protocol.outCipherName
+        ticket.compression_client_to_server = protocol.inCompressionName
+        ticket.compression_server_to_client = protocol.outCompressionName
+
+        if protocol._issued_ticket_id:
+            protocol.resumption_tickets.remove_server_ticket(\
+                protocol._issued_ticket_id)
+        protocol._issued_ticket_id = ticket.ticket_id
+
+        protocol.resumption_tickets.add_server_ticket(ticket)
+    else:
+        ticket.peer_key = bytes(protocol.server_key.asbytes())
+        ticket.cipher_client_to_server = protocol.outCipherName
+        ticket.cipher_server_to_client = protocol.inCipherName
+        ticket.compression_client_to_server = protocol.outCompressionName
+        ticket.compression_server_to_client = protocol.inCompressionName
+
+        protocol.resumption_tickets.add_client_ticket(ticket)
+
+def _send_resume(protocol):
+    if not protocol.resumption_tickets or not protocol.server_key\
+            or cleartext_transport_enabled:
+        return
+
+    ticket = protocol.resumption_tickets.take_client_ticket(\
+        bytes(protocol.server_key.asbytes()))
+    if not ticket:
+        return
+
+    if log.isEnabledFor(logging.INFO):
+        log.info("Attempting to resume session (address=[{}])."\
+            .format(protocol.address))
+
+    protocol._resume_ticket = ticket
+    protocol._resume_nonce = os.urandom(32)
+
+    # The server's NEWKEYS will follow its RESUME_ACCEPT directly.
+    protocol.waitingForNewKeys = True
+
+    m = mnetpacket.SshResumeMessage()
+    m.ticket_id = ticket.ticket_id
+    m.nonce = protocol._resume_nonce
+    m.encode()
+
+    protocol.write_packet(m)
+
+def _set_resumed_keys(protocol, ticket, client_nonce, server_nonce):
+    k = int.from_bytes(ticket.secret, "big")
+
+    hm = bytearray()
+    hm += sshtype.encodeBinary(ticket.ticket_id)
+    hm += sshtype.encodeBinary(client_nonce)
+    hm += sshtype.encodeBinary(server_nonce)
+    hm += sshtype.encodeMpint(k)
+
+    protocol.set_K_H(k, sha1(hm).digest())
+    protocol.session_resumed = True
+
+    if protocol.server_mode:
+        protocol.inCipherName = ticket.cipher_client_to_server
+        protocol.outCipherName = ticket.cipher_server_to_client
+        protocol.inCompressionName = ticket.compression_client_to_server
+        protocol.outCompressionName = ticket.compression_server_to_client
+    else:
+        protocol.inCipherName = ticket.cipher_server_to_client
+        protocol.outCipherName = ticket.cipher_client_to_server
+        protocol.inCompressionName = ticket.compression_server_to_client
+        protocol.outCompressionName = ticket.compression_client_to_server
+
+    # Only peers of this version or newer issue tickets.
+    protocol.peer_rekey_supported = True
+    protocol.peer_resume_supported = True
+    protocol.peer_flow_control_supported = True
+
+# Returns (True/False, None) on success/failure, (None, kex_init_packet) if
+# the server rejected our ticket and a full key exchange must be done.
+@asyncio.coroutine
+def _resume_session_client(protocol):
+    ticket = protocol._resume_ticket
+    protocol._resume_ticket = None
+
+    # The server sends its KEXINIT before it knows we are resuming.
+    kex_init_packet = yield from protocol.read_packet()
+    if not kex_init_packet:
+        return False, None
+
+    packet = yield from protocol.read_packet()
+    if not packet:
+        return False, None
+
+    packet_type = mnetpacket.SshPacket.parse_type(packet)
+
+    if packet_type == mnetpacket.SSH_MSG_MNET_RESUME_FAILURE:
+        if log.isEnabledFor(logging.INFO):
+            log.info("Server rejected our resumption ticket (address=[{}]);"\
+                " doing full key exchange.".format(protocol.address))
+        protocol.waitingForNewKeys = False
+        return None, kex_init_packet
+
+    m = mnetpacket.SshResumeAcceptMessage(packet)
+
+    _set_resumed_keys(protocol, ticket, protocol._resume_nonce, m.nonce)
+
+    m = mnetpacket.SshNewKeysMessage()
+    m.encode()
+    protocol.write_packet(m)
+
+    protocol.init_outbound_encryption()
+    protocol.enable_new_inbound_keys()
+
+    packet = yield from protocol.read_packet()
+    if not packet:
+        return False, None
+
+    m = mnetpacket.SshNewKeysMessage(packet)
+
+    r = yield from protocol.connection_handler.peer_authenticated(protocol)
+    if not r:
+        protocol.close()
+        return False, None
+
+    protocol.reset_rekey_limits()
+    _issue_resumption_ticket(protocol)
+
+    log.info("Session resumed (server=False).")
+
+    return True, None
+
+# Returns True on success, False on failure, None if the ticket was rejected
+# and a full key exchange must be done.
+@asyncio.coroutine
+def _resume_session_server(protocol, packet):
+    m = mnetpacket.SshResumeMessage(packet)
+
+    ticket = None
+    if protocol.resumption_tickets:
+        ticket = protocol.resumption_tickets.take_server_ticket(\
+            bytes(m.ticket_id))
+
+    if not ticket or (protocol.client_key\
+            and protocol.client_key.asbytes() != ticket.peer_key):
+        if log.isEnabledFor(logging.INFO):
+            log.info("Rejecting resumption ticket (address=[{}])."\
+                .format(protocol.address))
+
+        mr = mnetpacket.SshResumeFailureMessage()
+        mr.encode()
+        protocol.write_packet(mr)
+        return None
+
+    if not protocol.client_key:
+        protocol.client_key = rsakey.RsaKey(ticket.peer_key)
+
+    server_nonce = os.urandom(32)
+
+    _set_resumed_keys(protocol, ticket, m.nonce, server_nonce)
+
+    protocol.waitingForNewKeys = True
+
+    mr = mnetpacket.SshResumeAcceptMessage()
+    mr.nonce = server_nonce
+    mr.encode()
+    protocol.write_packet(mr)
+
+    mr = mnetpacket.SshNewKeysMessage()
+    mr.encode()
+    protocol.write_packet(mr)
+
+    protocol.init_outbound_encryption()
+
+    # Inbound keys are switched by _process_buffer() upon the NEWKEYS.
+    packet = yield from protocol.read_packet()
+    if not packet:
+        return False
+
+    m = mnetpacket.SshNewKeysMessage(packet)
+
+    r = yield from protocol.connection_handler.peer_authenticated(protocol)
+    if not r:
+        protocol.close()
+        return False
+
+    protocol.reset_rekey_limits()
+    _issue_resumption_ticket(protocol)
+
+    log.info("Session resumed (server=True).")
+
+    return True
+
+# Returns True on success, False on failure.
+@asyncio.coroutine
+def connectTaskSecure(protocol, server_mode):
+    if protocol._resume_ticket:
+        r, packet = yield from _resume_session_client(protocol)
+        if r is not None:
+            return r
+
+        _send_kex_init(protocol)
+    else:
+        # Send KexInit packet.
+        _send_kex_init(protocol)
+
+        # Read KexInit packet.
+        packet = yield from protocol.read_packet()
+        if not packet:
+            return False
+
+        if server_mode and mnetpacket.SshPacket.parse_type(packet)\
+                == mnetpacket.SSH_MSG_MNET_RESUME:
+            r = yield from _resume_session_server(protocol, packet)
+            if r is not None:
+                return r
+
+            # Ticket rejected; the client now sends its KEXINIT.
+            packet = yield from protocol.read_packet()
+            if not packet:
+                return False
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("X: Received packet [{}].".format(hex_dump(packet)))
+
+    packet_type = mnetpacket.SshPacket.parse_type(packet)
+
+    if log.isEnabledFor(logging.INFO):
+        log.info("packet_type=[{}].".format(packet_type))
+
+    if packet_type != 20:
+        log.warning("Peer sent unexpected packet_type[{}], disconnecting.".format(packet_type))
+        protocol.close()
+        return False
+
+    r = yield from _perform_kex(protocol, packet)
+
+    if not r:
+        # Client is rejected for some reason by higher level.
+        protocol.close()
+        return False
 
     packet = yield from protocol.read_packet()
     if not packet:
@@ -1436,6 +2792,8 @@ def connectTaskSecure(protocol, server_mode):
         m = mnetpacket.SshUserauthSuccessMessage(packet)
         log.info("Userauth accepted.")
 
+    _issue_resumption_ticket(protocol)
+
     log.info("Connect task done (server={}).".format(server_mode))
 
 #    if not server_mode:
@@ -1443,6 +2801,59 @@ def connectTaskSecure(protocol, server_mode):
 
     return True
 
+def _negotiate_ciphers(protocol, local_kex_init, remote_kex_init):
+    if protocol.server_mode:
+        client_kex_init, server_kex_init = remote_kex_init, local_kex_init
+    else:
+        client_kex_init, server_kex_init = local_kex_init, remote_kex_init
+
+    c2s = negotiate_algorithm(\
+        client_kex_init.encryption_algorithms_client_to_server,\
+        server_kex_init.encryption_algorithms_client_to_server)
+    s2c = negotiate_algorithm(\
+        client_kex_init.encryption_algorithms_server_to_client,\
+        server_kex_init.encryption_algorithms_server_to_client)
+
+    if not c2s or not s2c:
+        raise SshException("No matching cipher found (address=[{}])."\
+            .format(protocol.address))
+
+    if protocol.server_mode:
+        protocol.inCipherName, protocol.outCipherName = c2s, s2c
+    else:
+        protocol.inCipherName, protocol.outCipherName = s2c, c2s
+
+    if log.isEnabledFor(logging.INFO):
+        log.info("Negotiated ciphers: in=[{}], out=[{}] (address=[{}])."\
+            .format(protocol.inCipherName, protocol.outCipherName,\
+                protocol.address))
+
+def _negotiate_compression(protocol, local_kex_init, remote_kex_init):
+    if protocol.server_mode:
+        client_kex_init, server_kex_init = remote_kex_init, local_kex_init
+    else:
+        client_kex_init, server_kex_init = local_kex_init, remote_kex_init
+
+    # Older peers send "none" or nothing at all.
+    c2s = negotiate_algorithm(\
+        client_kex_init.compression_algorithms_client_to_server,\
+        server_kex_init.compression_algorithms_client_to_server)\
+            or COMPRESSION_NONE
+    s2c = negotiate_algorithm(\
+        client_kex_init.compression_algorithms_server_to_client,\
+        server_kex_init.compression_algorithms_server_to_client)\
+            or COMPRESSION_NONE
+
+    if protocol.server_mode:
+        protocol.inCompressionName, protocol.outCompressionName = c2s, s2c
+    else:
+        protocol.inCompressionName, protocol.outCompressionName = s2c, c2s
+
+    if log.isEnabledFor(logging.INFO):
+        log.info("Negotiated compression: in=[{}], out=[{}] (address=[{}])."\
+            .format(protocol.inCompressionName, protocol.outCompressionName,\
+                protocol.address))
+
 class ConnectionHandler(object):
     def connection_made(self, protocol):
         pass
@@ -0,0 +1,157 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# Transport throughput benchmark: pushes ChordStoreData packets through a
+# loopback SshServerProtocol/SshClientProtocol pair and reports MiB/s.
+
+import llog
+
+import argparse
+import asyncio
+from datetime import datetime
+import logging
+import os
+
+import chord_packet as cp
+import mn1
+import rsakey
+
+log = logging.getLogger(__name__)
+
+class BenchConnectionHandler(mn1.ConnectionHandler):
+    def __init__(self, ready):
+        self.ready = ready
+
+    @asyncio.coroutine
+    def peer_authenticated(self, protocol):
+        return True
+
+    @asyncio.coroutine
+    def connection_ready(self, protocol):
+        self.ready.set()
+
+class BenchChannelHandler(mn1.ChannelHandler):
+    def __init__(self, total, done):
+        self.total = total
+        self.received = 0
+        self.packets = 0
+        self.done = done
+
+    @asyncio.coroutine
+    def request_open_channel(self, protocol, message):
+        return True
+
+    @asyncio.coroutine
+    def channel_data(self, protocol, local_cid, data):
+        pkt = cp.ChordStoreData(data)
+        self.received += len(pkt.data)
+        self.packets += 1
+
+        if self.received >= self.total:
+            self.done.set()
+
+        return True
+
+@asyncio.coroutine
+def _run(loop, args):
+    server_key = rsakey.RsaKey.generate(bits=args.keybits)
+    client_key = rsakey.RsaKey.generate(bits=args.keybits)
+
+    total = args.size << 20
+    done = asyncio.Event(loop=loop)
+    server_ready = asyncio.Event(loop=loop)
+    client_ready = asyncio.Event(loop=loop)
+
+    channel_handler = BenchChannelHandler(total, done)
+
+    def create_server_protocol():
+        ph = mn1.SshServerProtocol(loop)
+        ph.server_key = server_key
+        ph.connection_handler = BenchConnectionHandler(server_ready)
+        ph.channel_handler = channel_handler
+        return ph
+
+    def create_client_protocol():
+        ph = mn1.SshClientProtocol(loop)
+        ph.client_key = client_key
+        ph.server_key = server_key
+        ph.connection_handler = BenchConnectionHandler(client_ready)
+        ph.channel_handler = mn1.ChannelHandler()
+        return ph
+
+    server = yield from loop.create_server(\
+        create_server_protocol, "127.0.0.1", args.port)
+
+    transport, protocol = yield from loop.create_connection(\
+        create_client_protocol, "127.0.0.1", args.port)
+
+    yield from client_ready.wait()
+
+    local_cid, queue = yield from protocol.open_channel("mpeer", True)
+
+    msg = cp.ChordStoreData()
+    msg.data = os.urandom(args.block_size)
+    pkt = msg.encode()
+
+    print("Sending {} MiB in {} byte ChordStoreData packets (packet size={},"\
+        " cipher={})."\
+            .format(args.size, args.block_size, len(pkt),\
+                protocol.outCipherName if protocol.outCipher else None))
+
+    start = datetime.today()
+
+    sent = 0
+    while sent < total:
+        protocol.write_channel_data(local_cid, pkt)
+        sent += args.block_size
+
+        yield from protocol.drain_channel(local_cid)
+
+        # Keep the outbound transport buffer bounded.
+        while transport.get_write_buffer_size() > 1 << 20:
+            yield from asyncio.sleep(0, loop=loop)
+
+    yield from done.wait()
+
+    elapsed = (datetime.today() - start).total_seconds()
+
+    print("Received {} packets ({} bytes) in {}s: {:.2f} MiB/s."\
+        .format(channel_handler.packets, channel_handler.received, elapsed,\
+            channel_handler.received / elapsed / (1 << 20)))
+
+    protocol.close()
+    server.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100,\
+        help="MiB of data to send.")
+    parser.add_argument("--block-size", type=int, default=32768,\
+        help="Size of the data in each ChordStoreData packet.")
+    parser.add_argument("--port", type=int, default=4299)
+    parser.add_argument("--keybits", type=int, default=2048)
+    parser.add_argument("--cleartext", action="store_true",\
+        help="Benchmark framing only, with the transport unencrypted.")
+    parser.add_argument("--cipher",\
+        help="Only offer this cipher (ie: {} or {}) during KEX."\
+            .format(mn1.CIPHER_AES256_GCM, mn1.CIPHER_AES256_CBC))
+
+    args = parser.parse_args()
+
+    if args.cipher:
+        mn1.ciphers = [args.cipher]
+
+    if args.cleartext:
+        mn1.enable_cleartext_transport()
+
+    loop = asyncio.get_event_loop()
+
+    try:
+        loop.run_until_complete(_run(loop, args))
+    except KeyboardInterrupt:
+        log.info("Got KeyboardInterrupt; shutting down.")
+
+    loop.close()
+
+if __name__ == "__main__":
+    main()
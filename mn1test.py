@@ -0,0 +1,116 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+# Loopback tests of the transport: connects a SshClientProtocol to a
+# SshServerProtocol, disconnects, and checks the reconnect resumes the
+# session from the ticket issued by the first connection.
+
+import llog
+
+import argparse
+import asyncio
+import logging
+
+import mn1
+import rsakey
+
+log = logging.getLogger(__name__)
+
+class TestConnectionHandler(mn1.ConnectionHandler):
+    def __init__(self, loop):
+        self.ready = asyncio.Event(loop=loop)
+
+    @asyncio.coroutine
+    def peer_authenticated(self, protocol):
+        return True
+
+    @asyncio.coroutine
+    def connection_ready(self, protocol):
+        self.ready.set()
+
+@asyncio.coroutine
+def _connect(loop, port, client_key, server_key, tickets):
+    handler = TestConnectionHandler(loop)
+
+    def create_client_protocol():
+        ph = mn1.SshClientProtocol(loop)
+        ph.client_key = client_key
+        ph.server_key = server_key
+        ph.resumption_tickets = tickets
+        ph.connection_handler = handler
+        ph.channel_handler = mn1.ChannelHandler()
+        return ph
+
+    transport, protocol = yield from loop.create_connection(\
+        create_client_protocol, "127.0.0.1", port)
+
+    yield from asyncio.wait_for(handler.ready.wait(), 30, loop=loop)
+
+    return protocol
+
+@asyncio.coroutine
+def _resume_test(loop, args):
+    print("resume..")
+
+    server_key = rsakey.RsaKey.generate(bits=args.keybits)
+    client_key = rsakey.RsaKey.generate(bits=args.keybits)
+
+    server_tickets = mn1.ResumptionTickets()
+    client_tickets = mn1.ResumptionTickets()
+
+    server_protocols = []
+
+    def create_server_protocol():
+        ph = mn1.SshServerProtocol(loop)
+        ph.server_key = server_key
+        ph.resumption_tickets = server_tickets
+        ph.connection_handler = TestConnectionHandler(loop)
+        ph.channel_handler = mn1.ChannelHandler()
+        server_protocols.append(ph)
+        return ph
+
+    server = yield from loop.create_server(\
+        create_server_protocol, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    try:
+        protocol = yield from _connect(\
+            loop, port, client_key, server_key, client_tickets)
+
+        assert not protocol.session_resumed
+        # Both ends derive the ticket from the key exchange; the server may
+        # only get there just after we are ready.
+        yield from asyncio.sleep(0.1, loop=loop)
+        assert len(client_tickets._client_tickets) == 1
+        assert len(server_tickets._server_tickets) == 1
+
+        protocol.close()
+        yield from asyncio.sleep(0.1, loop=loop)
+
+        protocol = yield from _connect(\
+            loop, port, client_key, server_key, client_tickets)
+
+        assert protocol.session_resumed
+        assert server_protocols[-1].session_resumed
+
+        protocol.close()
+    finally:
+        server.close()
+
+    print("resume ok.")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keybits", type=int, default=2048)
+
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+
+    try:
+        loop.run_until_complete(_resume_test(loop, args))
+    finally:
+        loop.close()
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ import rsakey
 import mn1
 from mutil import hex_dump, hex_string
 import chord
+import datastore
+import distanceindex
 import peer
 import db
 
@@ -51,6 +53,8 @@ class Node():
         self.data_block_path = "data/store-{}"
         self.data_block_file_path =\
             self.data_block_path + "/{}.blk"
+        self.data_store = None # See init_store(..).
+        self.distance_index = distanceindex.DistanceIndex()
 
         self.datastore_max_size = 0 # In bytes.
         self.datastore_size = 0 # In bytes.
@@ -102,7 +106,12 @@ class Node():
         self._db_initialized = True
 
     @asyncio.coroutine
-    def init_store(self, max_size, reinit):
+    def init_store(self, max_size, reinit,\
+            store_format=datastore.FORMAT_FILES):
+        "store_format is datastore.FORMAT_FILES for a file per block or"\
+        " datastore.FORMAT_SEGMENTS for packed segment files. Blocks in"\
+        " files are moved into segments when the latter is selected."
+
         self.datastore_max_size = max_size
 
         d = self.data_block_path.format(self.instance)
@@ -128,6 +137,8 @@ class Node():
                     sess.execute(stmt)
 
                     sess.query(db.DataBlock).delete(synchronize_session=False)
+                    sess.query(db.DataBlockJournal)\
+                        .delete(synchronize_session=False)
 
                     sess.commit()
 
@@ -151,29 +162,134 @@ class Node():
                         .first()
 
                     if node_state:
-                        datastore_size = int(node_state.value)
+                        return int(node_state.value)
                     else:
-                        datastore_size = 0
+                        return 0
+
+            self.datastore_size =\
+                yield from self.loop.run_in_executor(None, dbcall)
+
+        if store_format == datastore.FORMAT_SEGMENTS:
+            def iocall():
+                store = datastore.SegmentDataStore(d)
+                return store, store.import_block_files()
+
+            self.data_store, cnt =\
+                yield from self.loop.run_in_executor(None, iocall)
+
+            if cnt and log.isEnabledFor(logging.INFO):
+                log.info("Moved [{}] block files into segments.".format(cnt))
+        else:
+            assert store_format == datastore.FORMAT_FILES
+
+            if datastore.has_segments(d):
+                errmsg = "Data store directory [{}] holds segment files;"\
+                    " refusing to start in an inconsistent state. Rerun"\
+                    " with --dsformat {}."\
+                        .format(d, datastore.FORMAT_SEGMENTS)
+                log.warning(errmsg)
+                raise Exception(errmsg)
+
+            self.data_store = datastore.FileDataStore(d)
+
+        yield from self._recover_data_store()
+
+        yield from self._load_distance_index()
+
+    @asyncio.coroutine
+    def _load_distance_index(self):
+        "Fills self.distance_index from the DataBlock table, which the"\
+        " ChordTasks then keep up to date."
+
+        index = self.distance_index
+
+        def dbcall():
+            with self.db.open_session() as sess:
+                q = sess.query(db.DataBlock.id, db.DataBlock.distance,\
+                        db.DataBlock.original_size)\
+                    .yield_per(1000)
+
+                index.load(q)
+
+        yield from self.loop.run_in_executor(None, dbcall)
+
+        max_distance = index.furthest()
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Indexed [{}] blocks; max_distance=[{}]."\
+                .format(len(index), hex_string(max_distance)))
+
+        self.chord_engine.furthest_data_block = max_distance
+
+    @asyncio.coroutine
+    def _recover_data_store(self):
+        "Finishes the DataBlock changes that a crash interrupted, as recorded"\
+        " in the DataBlockJournal. Blocks that were being written are"\
+        " dropped, as their data may be incomplete, and blocks that were"\
+        " being deleted are removed from the data store. Only the journal is"\
+        " read, so this takes no time however big the data store is."
 
-                    max_distance = sess.query(db.DataBlock.distance)\
-                        .order_by(db.DataBlock.distance.desc())\
+        def dbcall():
+            with self.db.open_session() as sess:
+                self.db.lock_table(sess, db.DataBlock)
+
+                entries = sess.query(db.DataBlockJournal).all()
+                if not entries:
+                    return None, None, 0
+
+                size_diff = 0
+                for entry in entries:
+                    if not entry.storing:
+                        continue
+
+                    data_block = sess.query(db.DataBlock)\
+                        .filter(db.DataBlock.id == entry.data_block_id)\
                         .first()
 
-                    if max_distance:
-                        max_distance = max_distance[0]
-                    else:
-                        max_distance = b""
+                    if data_block:
+                        size_diff -= data_block.original_size
+                        sess.delete(data_block)
 
-                    if log.isEnabledFor(logging.INFO):
-                        log.info("max_distance=[{}]."\
-                            .format(hex_string(max_distance)))
+                if size_diff:
+                    # Rule: only update this NodeState row when holding a
+                    # lock on the DataBlock table.
+                    node_state = sess.query(db.NodeState)\
+                        .filter(db.NodeState.key == NSK_DATASTORE_SIZE)\
+                        .first()
+                    node_state.value = str(int(node_state.value) + size_diff)
+
+                sess.commit()
 
-                    return datastore_size, max_distance
+                return [entry.id for entry in entries],\
+                    [entry.data_block_id for entry in entries], size_diff
 
-            self.datastore_size, self.chord_engine.furthest_data_block =\
-                yield from self.loop.run_in_executor(None, dbcall)
+        entry_ids, block_ids, size_diff =\
+            yield from self.loop.run_in_executor(None, dbcall)
 
-        assert type(self.chord_engine.furthest_data_block) is bytes
+        if not entry_ids:
+            return
+
+        if log.isEnabledFor(logging.WARNING):
+            log.warning("Recovering [{}] interrupted DataBlock changes."\
+                .format(len(entry_ids)))
+
+        self.datastore_size += size_diff
+
+        def iocall():
+            for block_id in block_ids:
+                self.data_store.remove(block_id)
+
+        yield from self.loop.run_in_executor(None, iocall)
+
+        def dbcall():
+            with self.db.open_session() as sess:
+                sess.query(db.DataBlockJournal)\
+                    .filter(db.DataBlockJournal.id.in_(entry_ids))\
+                    .delete(synchronize_session=False)
+
+                sess.commit()
+
+        yield from self.loop.run_in_executor(None, dbcall)
 
     @asyncio.coroutine
     def start(self):
@@ -300,6 +416,13 @@ def __main():
         help="Specify bind address (host:port).")
     parser.add_argument("--cleartexttransport", action="store_true",\
         help="Clear text transport and no authentication.")
+    parser.add_argument("--compress", action="store_true",\
+        help="Prefer compressed connections to other nodes. This is always"\
+            " enabled in --tormode.")
+    parser.add_argument("--datacache", type=int,\
+        help="Specify how many MBs of the blocks in the datastore to cache in"\
+            " memory, so that popular ones are served faster (default is 16,"\
+            " 0 disables it).")
     parser.add_argument("--dbpoolsize", type=int,\
         help="Specify the maximum amount of database connections.")
     parser.add_argument("--dburl",\
@@ -320,6 +443,13 @@ def __main():
     parser.add_argument("--dontuseseed", action="store_true",\
         help="Instruct the node to not attempt to connect to the official"\
             " MORPHiS seed node in the case that you have no peers.")
+    parser.add_argument("--dsformat",\
+        choices=[datastore.FORMAT_FILES, datastore.FORMAT_SEGMENTS],\
+        default=datastore.FORMAT_FILES,\
+        help="Specify how the datastore keeps blocks on disk: a file each"\
+            " (default), or packed into large segment files. Switching to"\
+            " segments moves the existing block files into them; there is"\
+            " no way back.")
     parser.add_argument("--dssize", type=int,\
         help="Specify the datastore size in standard non-IEC-redefined JEDEC"\
             " MBs (default is one gigabyte, as in 1024^3 bytes). Morphis does"\
@@ -337,6 +467,9 @@ def __main():
             " FIRST PARAMETER!].")
     parser.add_argument("--maxconn", type=int,\
         help="Specify the maximum connections to seek.")
+    parser.add_argument("--metrics", action="store_true",\
+        help="Collect transport metrics of each connection; see the stats"\
+            " shell command and, with Maalstroom, /.stats (JSON).")
     parser.add_argument("--nodecount", type=int,\
         help="Specify amount of nodes to start.")
     parser.add_argument("--offline", action="store_true",\
@@ -345,6 +478,16 @@ def __main():
         help="Enable parallel launch of the nodecount nodes.")
     parser.add_argument("--proxyurl",\
         help="Specify the proxy URL to rewrite URLs to for proxy requests.")
+    parser.add_argument("--rekeybytes", type=int,\
+        help="Specify after how many MBs sent or received on a connection its"\
+            " keys are re-exchanged (default is 1024).")
+    parser.add_argument("--rekeyinterval", type=int,\
+        help="Specify after how many seconds the keys of a connection are"\
+            " re-exchanged (default is 3600).")
+    parser.add_argument("--relaycache", type=int,\
+        help="Specify how many MBs of the data relayed for other nodes to"\
+            " cache, in order to serve it directly if it is requested again"\
+            " through the node that sent it (default is 0, disabled).")
     parser.add_argument("--reinitds", action="store_true",\
         help="Allow reinitialization of the Datastore. This will only happen"\
             " if the Datastore directory has already been manually deleted.")
@@ -373,8 +516,14 @@ def __main():
     if args.cleartexttransport:
         log.info("Enabling cleartext transport.")
         mn1.enable_cleartext_transport()
+    if args.metrics:
+        mn1.enable_metrics()
+    if args.compress or args.tormode:
+        log.info("Enabling compression.")
+        mn1.enable_compression()
     db_pool_size = args.dbpoolsize
     dburl = args.dburl
+    datacache = args.datacache if args.datacache is not None else 16
     dssize = args.dssize if args.dssize else 1024
     dumptasksonexit = args.dumptasksonexit
     instanceoffset = args.instanceoffset
@@ -389,6 +538,10 @@ def __main():
         nodecount = 1
     parallel_launch = args.parallellaunch
     reinitds = args.reinitds
+    if args.rekeybytes:
+        mn1.rekey_bytes_limit = args.rekeybytes << 20
+    if args.rekeyinterval:
+        mn1.rekey_time_limit = args.rekeyinterval
 
     morphis_version = open("VERSION").read().strip()
 
@@ -425,6 +578,8 @@ def __main():
                     maalstroom.upload_enabled = False
                 if args.proxyurl:
                     maalstroom.proxy_url = args.proxyurl
+                if args.metrics:
+                    maalstroom.stats_enabled = True
 
                 yield from maalstroom.start_maalstroom_server(node)
 
@@ -440,8 +595,15 @@ def __main():
 
             node.init_chord()
 
-            yield from\
-                node.init_store(dssize << 20, reinitds) # Convert MBs to bytes.
+            yield from node.init_store(\
+                dssize << 20, reinitds, args.dsformat) # Convert MBs to bytes.
+
+            if args.relaycache:
+                node.chord_engine.tasks.enable_relay_cache(\
+                    args.relaycache << 20)
+
+            if datacache:
+                node.chord_engine.tasks.enable_data_cache(datacache << 20)
 
             if args.maxconn:
                 node.chord_engine.maximum_connections = args.maxconn
@@ -16,6 +16,8 @@ SSH_MSG_SERVICE_REQUEST = 5
 SSH_MSG_SERVICE_ACCEPT = 6
 SSH_MSG_KEXINIT = 20
 SSH_MSG_NEWKEYS = 21
+SSH_MSG_KEXDH_INIT = 30
+SSH_MSG_KEXDH_REPLY = 31
 
 SSH_MSG_USERAUTH_REQUEST = 50
 SSH_MSG_USERAUTH_FAILURE = 51
@@ -40,6 +42,9 @@ SSH_MSG_CHANNEL_SUCCESS = 99
 SSH_MSG_CHANNEL_FAILURE = 100
 
 SSH_MSG_CHANNEL_IMPLICIT_WRAPPER = 200
+SSH_MSG_MNET_RESUME = 201
+SSH_MSG_MNET_RESUME_ACCEPT = 202
+SSH_MSG_MNET_RESUME_FAILURE = 203
 
 log = logging.getLogger(__name__)
 
@@ -107,6 +112,35 @@ class SshKexInitMessage(SshPacket):
         l, v = sshtype.parseNameList(self.buf[i:])
         self.kex_algorithms = v
         i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.server_host_key_algorithms = v
+        i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.encryption_algorithms_client_to_server = v
+        i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.encryption_algorithms_server_to_client = v
+        i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.mac_algorithms_client_to_server = v
+        i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.mac_algorithms_server_to_client = v
+        i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.compression_algorithms_client_to_server = v
+        i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.compression_algorithms_server_to_client = v
+        i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.languages_client_to_server = v
+        i += l
+        l, v = sshtype.parseNameList(self.buf[i:])
+        self.languages_server_to_client = v
+        i += l
+        self.first_kex_packet_follows =\
+            struct.unpack_from("?", self.buf, i)[0]
 
     def encode(self):
         nbuf = super().encode()
@@ -485,6 +519,28 @@ class SshChannelCloseMessage(SshPacket):
 
         return nbuf
 
+class SshChannelWindowAdjustMessage(SshPacket):
+    def __init__(self, buf=None, offset=0):
+        self.recipient_channel = None
+        self.bytes_to_add = None
+
+        super().__init__(SSH_MSG_CHANNEL_WINDOW_ADJUST, buf, offset)
+
+    def parse(self):
+        i = super().parse()
+
+        self.recipient_channel = struct.unpack_from(">L", self.buf, i)[0]
+        i += 4
+        self.bytes_to_add = struct.unpack_from(">L", self.buf, i)[0]
+
+    def encode(self):
+        nbuf = super().encode()
+
+        nbuf += struct.pack(">L", self.recipient_channel)
+        nbuf += struct.pack(">L", self.bytes_to_add)
+
+        return nbuf
+
 class SshChannelDataMessage(SshPacket):
     def __init__(self, buf=None, offset=0):
         self.recipient_channel = None
@@ -578,3 +634,49 @@ class SshChannelImplicitWrapper(SshPacket):
 
     def __init__(self, buf=None, offset=0):
         super().__init__(SSH_MSG_CHANNEL_IMPLICIT_WRAPPER, buf, offset)
+
+class SshResumeMessage(SshPacket):
+    def __init__(self, buf=None):
+        self.ticket_id = None
+        self.nonce = None
+
+        super().__init__(SSH_MSG_MNET_RESUME, buf)
+
+    def parse(self):
+        super().parse()
+
+        i = 1
+        l, self.ticket_id = sshtype.parseBinary(self.buf[i:])
+        i += l
+        l, self.nonce = sshtype.parseBinary(self.buf[i:])
+
+    def encode(self):
+        nbuf = super().encode()
+
+        nbuf += sshtype.encodeBinary(self.ticket_id)
+        nbuf += sshtype.encodeBinary(self.nonce)
+
+        return nbuf
+
+class SshResumeAcceptMessage(SshPacket):
+    def __init__(self, buf=None):
+        self.nonce = None
+
+        super().__init__(SSH_MSG_MNET_RESUME_ACCEPT, buf)
+
+    def parse(self):
+        super().parse()
+
+        i = 1
+        l, self.nonce = sshtype.parseBinary(self.buf[i:])
+
+    def encode(self):
+        nbuf = super().encode()
+
+        nbuf += sshtype.encodeBinary(self.nonce)
+
+        return nbuf
+
+class SshResumeFailureMessage(SshPacket):
+    def __init__(self, buf=None):
+        super().__init__(SSH_MSG_MNET_RESUME_FAILURE, buf)
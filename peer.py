@@ -6,6 +6,7 @@ import llog
 import asyncio
 import logging
 
+import latency
 import packet as mnpacket
 import rsakey
 import mn1
@@ -34,6 +35,11 @@ class Peer():
 
         self.connection_coop_lock = asyncio.Lock()
 
+        # Time for a root level FindNode to this Peer to be answered. Until
+        # we know better, allow the minute that opening a channel used to
+        # be given. Timing out closes the connection, so never below 10s.
+        self.rtt = latency.RttEstimator(60, 10, 60)
+
         if dbpeer:
             self.dbid = dbpeer.id
             if dbpeer.pubkey:
@@ -0,0 +1,266 @@
+# Copyright (c) 2014-2015  Sam Maloney.
+# License: GPL v2.
+
+import llog
+
+import heapq
+import logging
+import random
+
+log = logging.getLogger(__name__)
+
+class RoutingTable(object):
+    "Connected peers indexed by node_id for k-closest queries."
+
+    __slots__ = ("_ids", "_peers", "_index")
+
+    def __init__(self):
+        # Parallel arrays; node ids are stored as ints so that the distance
+        # to a target is a single big-int XOR in C.
+        self._ids = []
+        self._peers = []
+        self._index = {} # {node_id: position}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, node_id):
+        return node_id in self._index
+
+    def add(self, node_id, peer):
+        idx = self._index.get(node_id)
+
+        if idx is not None:
+            self._peers[idx] = peer
+            return
+
+        self._index[node_id] = len(self._ids)
+        self._ids.append(int.from_bytes(node_id, "big"))
+        self._peers.append(peer)
+
+    def remove(self, node_id, peer=None):
+        "Remove node_id, only if it still maps to peer when one is given."
+
+        idx = self._index.get(node_id)
+
+        if idx is None:
+            return None
+
+        if peer is not None and self._peers[idx] is not peer:
+            return None
+
+        del self._index[node_id]
+
+        # Move the last entry into the hole to keep the arrays packed.
+        ids = self._ids
+        peers = self._peers
+
+        r = peers[idx]
+
+        last_id = ids.pop()
+        last_peer = peers.pop()
+
+        if idx < len(ids):
+            ids[idx] = last_id
+            peers[idx] = last_peer
+            self._index[last_id.to_bytes(len(node_id), "big")] = idx
+
+        return r
+
+    def closest(self, node_id, count, accept=None):
+        "Returns up to count peers, closest to node_id first, for which"\
+        " accept(peer) is True (or all if accept is None)."
+
+        ids = self._ids
+        peers = self._peers
+        total = len(ids)
+
+        if not total or count <= 0:
+            return []
+
+        target = int.from_bytes(node_id, "big")
+        distance = lambda i: ids[i] ^ target
+
+        want = count
+        while True:
+            if want >= total:
+                order = sorted(range(total), key=distance)
+            else:
+                order = heapq.nsmallest(want, range(total), key=distance)
+
+            if accept is None:
+                return [peers[i] for i in order[:count]]
+
+            r = []
+            for i in order:
+                peer = peers[i]
+                if not accept(peer):
+                    continue
+                r.append(peer)
+                if len(r) == count:
+                    return r
+
+            if want >= total:
+                return r
+
+            # Too many were rejected; widen the selection and retry.
+            want <<= 1
+
+class KBucketTable(object):
+    "Known PeerS (detached db.Peer objects) bucketed by log distance, used"\
+    " to pick connection candidates without querying the database."
+
+    __slots__ = ("buckets", "_entries", "_connected")
+
+    def __init__(self, bits):
+        self.buckets = [{} for i in range(bits)] # [{dbid: dbpeer}]
+        self._entries = {} # {dbid: dbpeer}
+        self._connected = set() # {dbid}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, dbid):
+        return dbid in self._entries
+
+    def get(self, dbid):
+        return self._entries.get(dbid)
+
+    def add(self, dbpeer):
+        "Add or replace dbpeer. Returns False if it has no distance (yet)."
+
+        if not dbpeer.distance:
+            return False
+
+        self.remove(dbpeer.id)
+
+        self._entries[dbpeer.id] = dbpeer
+        self.buckets[dbpeer.distance - 1][dbpeer.id] = dbpeer
+
+        return True
+
+    def remove(self, dbid):
+        dbpeer = self._entries.pop(dbid, None)
+
+        if dbpeer:
+            del self.buckets[dbpeer.distance - 1][dbid]
+
+        return dbpeer
+
+    def set_connected(self, dbid, connected):
+        if connected:
+            self._connected.add(dbid)
+        else:
+            self._connected.discard(dbid)
+
+    def is_connected(self, dbid):
+        return dbid in self._connected
+
+    def select(self, needs, grace, now):
+        "Returns connection candidates, closest buckets first. needs(distance)"\
+        " returns how many are wanted from that bucket. Each candidate is"\
+        " stamped with now as its last_connect_attempt, so that it will not"\
+        " be picked again until it is older than grace."
+
+        connected = self._connected
+        candidates = []
+
+        for distance, bucket in enumerate(self.buckets, 1):
+            if not bucket:
+                continue
+
+            cnt = needs(distance)
+            if cnt <= 0:
+                continue
+
+            eligible = [dbpeer for dbid, dbpeer in bucket.items()\
+                if dbid not in connected\
+                    and (dbpeer.last_connect_attempt is None\
+                        or dbpeer.last_connect_attempt < grace)]
+
+            if len(eligible) > cnt:
+                # Random, but those never tried before first.
+                random.shuffle(eligible)
+                eligible.sort(key=lambda x: x.last_connect_attempt is not None)
+                del eligible[cnt:]
+
+            for dbpeer in eligible:
+                dbpeer.last_connect_attempt = now
+
+            candidates.extend(eligible)
+
+        return candidates
+
+import os
+from datetime import datetime
+
+def _validity_test(cycles=100000, keysize=4, keyspace=256):
+    print("validity..")
+
+    rt = RoutingTable()
+    ref = {}
+
+    keys = [os.urandom(keysize) for i in range(keyspace)]
+
+    for i in range(cycles):
+        k = random.choice(keys)
+
+        if random.random() < 0.5:
+            rt.add(k, k)
+            ref[k] = k
+        else:
+            assert rt.remove(k) == ref.pop(k, None)
+
+        assert len(rt) == len(ref)
+
+        if not i % 1000:
+            target = os.urandom(keysize)
+            tint = int.from_bytes(target, "big")
+            expected = sorted(ref,\
+                key=lambda x: int.from_bytes(x, "big") ^ tint)
+
+            assert rt.closest(target, 20) == expected[:20]
+
+            accept = lambda x: x[0] & 1
+            assert rt.closest(target, 20, accept)\
+                == [x for x in expected if accept(x)][:20]
+
+    print("validity ok.")
+
+def _speed_test(peers=512, count=20, finds=1000):
+    import bittrie
+
+    keysize = 512 >> 3
+
+    rt = RoutingTable()
+    ids = [os.urandom(keysize) for i in range(peers)]
+    for node_id in ids:
+        rt.add(node_id, node_id)
+
+    targets = [os.urandom(keysize) for i in range(finds)]
+
+    now = datetime.today()
+    for target in targets:
+        pt = bittrie.BitTrie()
+        for node_id in ids:
+            pt[bittrie.XorKey(target, node_id)] = node_id
+        cnt = count
+        for r in pt:
+            cnt -= 1
+            if not cnt:
+                break
+    took = (datetime.today() - now).total_seconds()
+    print("BitTrie per request: {:.2f}us/op.".format(took / finds * 1000000))
+
+    now = datetime.today()
+    for target in targets:
+        rt.closest(target, count, lambda x: True)
+    took = (datetime.today() - now).total_seconds()
+    print("RoutingTable: {:.2f}us/op.".format(took / finds * 1000000))
+
+def main():
+    _validity_test()
+    _speed_test()
+
+if __name__ == "__main__":
+    main()
@@ -660,6 +660,112 @@ class Shell(cmd.Cmd):
                     mbase32.encode(engine.node_id), engine._bind_port,\
                     len(engine.peers)))
 
+        data_cache = engine.tasks.data_cache
+        if data_cache is not None:
+            cstats = data_cache.get_stats()
+            hit_rate = cstats["hit_rate"]
+            self.writeln("Data cache:\n\tblocks={}\n\tsize={}/{}\n"\
+                "\thits={}\n\tmisses={}\n\thit_rate={}"\
+                    .format(cstats["entries"], cstats["size"],\
+                        cstats["max_size"], cstats["hits"], cstats["misses"],\
+                        "{:.1%}".format(hit_rate) if hit_rate is not None\
+                            else None))
+
+    @asyncio.coroutine
+    def do_stats(self, arg):
+        "[peer_id] Report transport stats of each connected Peer, or the"\
+        " channels of the given Peer."
+
+        stats = self.peer.engine.get_transport_stats()
+
+        if not mn1.metrics_enabled:
+            self.writeln("Metrics are disabled (start with --metrics);"\
+                " only showing queue depths.")
+
+        if arg:
+            stats = [pstats for pstats in stats\
+                if str(pstats["peer_id"]) == arg]
+            if not stats:
+                self.writeln("No connected Peer with id [{}].".format(arg))
+                return
+
+        for pstats in stats:
+            self.writeln("Peer: (id={} addr={} status={}) in={}B/{}p"\
+                " out={}B/{}p encrypt={}s decrypt={}s processing={}s"\
+                " channel_open_latency={}s queued={}B scheduled={}p"\
+                " channels={}."\
+                    .format(pstats["peer_id"], pstats["address"],\
+                        pstats["status"], pstats.get("bytes_in"),\
+                        pstats.get("packets_in"), pstats.get("bytes_out"),\
+                        pstats.get("packets_out"),\
+                        _fmt_time(pstats.get("encrypt_time")),\
+                        _fmt_time(pstats.get("decrypt_time")),\
+                        _fmt_time(pstats.get("processing_time")),\
+                        _fmt_time(pstats.get("channel_open_latency_avg")),\
+                        pstats["queued_bytes"], pstats["scheduled_packets"],\
+                        len(pstats["channels"])))
+
+            if not arg:
+                continue
+
+            for cstats in pstats["channels"]:
+                self.writeln("\tChannel: (local_cid={} remote_cid={}"\
+                    " priority={}) queue={}p/{}B send_window={}"\
+                    " pending={}B in={}B out={}B."\
+                        .format(cstats["local_cid"], cstats["remote_cid"],\
+                            cstats["priority"], cstats.get("queue_packets"),\
+                            cstats.get("queue_bytes"),\
+                            cstats.get("send_window"),\
+                            cstats.get("pending_bytes"),\
+                            cstats.get("bytes_in"), cstats.get("bytes_out")))
+
+        self.writeln("Count: {}.".format(len(stats)))
+
+    @asyncio.coroutine
+    def do_latency(self, arg):
+        "Report FindNode latency histograms and round trip estimates."
+
+        engine = self.peer.engine
+        stats = engine.tasks.get_lookup_stats()
+
+        def write_histogram(name, hstats):
+            self.writeln("{}: count={} avg={}s p50={}s p95={}s p99={}s"\
+                " max={}s."\
+                    .format(name, hstats["count"], _fmt_time(hstats["avg"]),\
+                        _fmt_time(hstats["p50"]), _fmt_time(hstats["p95"]),\
+                        _fmt_time(hstats["p99"]), _fmt_time(hstats["max"])))
+
+            if not hstats["count"]:
+                return
+
+            for bound, cnt in hstats["buckets"]:
+                self.writeln("\t{}: {}".format(\
+                    "<={}s".format(bound) if bound else "slower", cnt))
+
+        for mode, hstats in sorted(stats["lookups"].items()):
+            write_histogram("Lookup (data_mode={})".format(mode), hstats)
+
+        write_histogram("Root level FindNode", stats["root_hops"])
+
+        for depth, rstats in enumerate(stats["relay_rtts"], 1):
+            if not rstats["samples"]:
+                continue
+            self.writeln("Relay depth {}: srtt={}s rttvar={}s p95={}s"\
+                " samples={}."\
+                    .format(depth, _fmt_time(rstats["srtt"]),\
+                        _fmt_time(rstats["rttvar"]), _fmt_time(rstats["p95"]),\
+                        rstats["samples"]))
+
+        for peer in engine.peers.values():
+            rstats = peer.rtt.get_stats()
+            if not rstats["samples"]:
+                continue
+            self.writeln("Peer (id={}): srtt={}s rttvar={}s timeout={}s"\
+                " samples={}."\
+                    .format(peer.dbid, _fmt_time(rstats["srtt"]),\
+                        _fmt_time(rstats["rttvar"]),\
+                        _fmt_time(rstats["timeout"]), rstats["samples"]))
+
     @asyncio.coroutine
     def do_time(self, arg):
         "Time the passed command line (wrapping call)."
@@ -675,6 +781,11 @@ class Shell(cmd.Cmd):
     def emptyline(self):
         pass
 
+def _fmt_time(value):
+    if value is None:
+        return None
+    return "{:.6f}".format(value)
+
 class BinaryMessage():
     def __init__(self, buf = None):
         self.buf = buf